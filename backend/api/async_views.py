@@ -0,0 +1,238 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.http import HttpResponse
+from rest_framework import exceptions
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .cache import catalog_key, catalog_response
+from .pagination import CursorPaginator, PageNumberPaginator
+from .views import (CustomUserViewSet, IngredientViewSet, RecipeViewSet,
+                    cached_recipe_detail, merge_user_flags, recipe_user_flags)
+
+# Потоки для запросов к базе. У каждого потока свое постоянное
+# соединение, поэтому пул ограничен: соединений у процесса не больше
+# ASGI_DB_THREADS, сколько бы запросов ни ждало.
+executor = ThreadPoolExecutor(
+    max_workers=settings.ASGI_DB_THREADS, thread_name_prefix='asgi-db'
+)
+
+
+class Fallback(Exception):
+    """Запрос обрабатывает обычный синхронный view."""
+
+
+def in_worker(function):
+    """
+    Функция для пула потоков. Соединения потоков пула не закрываются
+    сигналами запроса, поэтому устаревшие закрываются здесь, как это
+    делают request_started и request_finished.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(wrapper, thread_sensitive=False, executor=executor)
+
+
+async def gather(*functions):
+    """
+    Выполняет независимые запросы к базе одновременно.
+
+    Асинхронные методы ORM Django 4.2 выполняют запросы в одном потоке
+    запроса, поэтому при совместном ожидании они идут друг за другом.
+    Каждая функция здесь получает свой поток пула и свое соединение.
+    """
+    return await asyncio.gather(
+        *(in_worker(function)() for function in functions)
+    )
+
+
+def accepts_json(request):
+    if 'format' in request.GET:
+        return False
+    accept = request.headers.get('Accept', '*/*')
+    return 'text/html' not in accept and 'indent' not in accept
+
+
+def or_fallback(function):
+    """Ошибки DRF (400, 401, 403) возвращает синхронный view."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        except exceptions.APIException:
+            raise Fallback
+    return wrapper
+
+
+@or_fallback
+def init_view(viewset, action, request, **kwargs):
+    """
+    Экземпляр viewset для GET-запроса: аутентификация, права и выбор
+    формата те же, что в dispatch синхронного view.
+    """
+    view = viewset(
+        action_map={'get': action}, args=(), kwargs=kwargs, headers={}
+    )
+    view.request = view.initialize_request(request, **kwargs)
+    view.format_kwarg = view.get_format_suffix(**kwargs)
+    view.initial(view.request, **kwargs)
+    return view
+
+
+def page_params(request):
+    """Номер и размер страницы; все необычное - синхронному view."""
+    if CursorPaginator.cursor_query_param in request.query_params:
+        raise Fallback
+    number = request.query_params.get(PageNumberPaginator.page_query_param)
+    if number is None:
+        number = '1'
+    if not number.isdigit() or int(number) < 1:
+        raise Fallback
+    return int(number), PageNumberPaginator().get_page_size(request)
+
+
+def paginated(request, number, size, count, results):
+    """Тело ответа в формате PageNumberPagination."""
+    if number > 1 and not results:
+        # Несуществующая страница: ответ 404 формирует DRF.
+        raise Fallback
+    url = request.build_absolute_uri()
+    page_query_param = PageNumberPaginator.page_query_param
+    if number * size < count:
+        next_link = replace_query_param(url, page_query_param, number + 1)
+    else:
+        next_link = None
+    if number == 1:
+        previous_link = None
+    elif number == 2:
+        previous_link = remove_query_param(url, page_query_param)
+    else:
+        previous_link = replace_query_param(
+            url, page_query_param, number - 1
+        )
+    return {
+        'count': count,
+        'next': next_link,
+        'previous': previous_link,
+        'results': results,
+    }
+
+
+def json_response(data):
+    response = HttpResponse(
+        JSONRenderer().render(data), content_type='application/json'
+    )
+    response['Vary'] = 'Accept'
+    return response
+
+
+async def recipe_list(request):
+    view = await in_worker(init_view)(RecipeViewSet, 'list', request)
+    number, size = page_params(view.request)
+    queryset = await in_worker(or_fallback(view.filter_queryset))(
+        view.get_queryset()
+    )
+    page = view.page_rows(queryset)[(number - 1) * size:number * size]
+    count, recipes = await gather(
+        queryset.count, functools.partial(list, page)
+    )
+    results = await in_worker(view.serialize_page)(recipes)
+    return json_response(paginated(request, number, size, count, results))
+
+
+async def recipe_detail(request, pk):
+    if request.GET:
+        raise Fallback
+    _, data = await in_worker(cached_recipe_detail)(pk)
+    if data is None:
+        # Карточку соберет и положит в кэш синхронный view.
+        raise Fallback
+    view = await in_worker(init_view)(
+        RecipeViewSet, 'retrieve', request, pk=pk
+    )
+    flags = await in_worker(recipe_user_flags)(pk, view.request.user)
+    if flags is None:
+        raise Fallback
+    return json_response(merge_user_flags(data, flags))
+
+
+async def ingredient_list(request):
+    entry = await cache.aget(catalog_key(IngredientViewSet.queryset.model,
+                                         request))
+    if entry is None:
+        raise Fallback
+    return catalog_response(request, entry)
+
+
+async def subscription_list(request):
+    view = await in_worker(init_view)(
+        CustomUserViewSet, 'subscriptions', request
+    )
+    if not view.request.user.is_authenticated:
+        raise Fallback
+    recipes_limit = or_fallback(view.get_recipes_limit)(view.request)
+    number, size = page_params(view.request)
+    queryset = view.subscription_authors(recipes_limit)
+    page = queryset[(number - 1) * size:number * size]
+    count, results = await gather(
+        queryset.count,
+        functools.partial(
+            view.serialize_subscriptions, page, recipes_limit
+        )
+    )
+    return json_response(paginated(request, number, size, count, results))
+
+
+def async_view(handler, view):
+    """
+    Асинхронная версия GET-запроса view. Остальные методы и запросы,
+    для которых handler вызывает Fallback, обрабатывает сам view.
+    Атрибуты cls и actions копируются для метрик и выбора реплики.
+    """
+    sync_view = sync_to_async(view)
+
+    async def dispatch(request, *args, **kwargs):
+        if request.method == 'GET' and accepts_json(request):
+            try:
+                return await handler(request, *args, **kwargs)
+            except Fallback:
+                pass
+        return await sync_view(request, *args, **kwargs)
+
+    # csrf_exempt Django 4.2 не поддерживает асинхронные view.
+    dispatch.csrf_exempt = True
+    dispatch.cls = view.cls
+    dispatch.initkwargs = view.initkwargs
+    dispatch.actions = view.actions
+    return dispatch
+
+
+recipe_list_view = async_view(
+    recipe_list, RecipeViewSet.as_view({'get': 'list', 'post': 'create'})
+)
+recipe_detail_view = async_view(
+    recipe_detail,
+    RecipeViewSet.as_view({
+        'get': 'retrieve',
+        'put': 'update',
+        'patch': 'partial_update',
+        'delete': 'destroy',
+    })
+)
+ingredient_list_view = async_view(
+    ingredient_list, IngredientViewSet.as_view({'get': 'list'})
+)
+subscription_list_view = async_view(
+    subscription_list, CustomUserViewSet.as_view({'get': 'subscriptions'})
+)
@@ -0,0 +1,113 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.authentication import TokenAuthentication
+
+from foodgram.replicas import read_from_primary
+from users.models import User
+
+# Поля пользователя, нужные запросу; остальные загружаются отложенно.
+SNAPSHOT_FIELDS = frozenset((
+    'id', 'username', 'email', 'first_name', 'last_name',
+    'is_active', 'is_staff', 'is_superuser',
+))
+
+
+def token_cache_key(key):
+    return f'auth:token:{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+class LocalCache:
+    """LRU в памяти процесса с коротким временем жизни записей."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (
+                time.monotonic() + settings.AUTH_TOKEN_LOCAL_CACHE_TIMEOUT,
+                value
+            )
+            self.entries.move_to_end(key)
+            while len(self.entries) > settings.AUTH_TOKEN_LOCAL_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+local_cache = LocalCache()
+
+
+def snapshot_fields():
+    return [
+        field.attname for field in User._meta.concrete_fields
+        if field.attname in SNAPSHOT_FIELDS
+    ]
+
+
+def make_snapshot(user):
+    return tuple(getattr(user, name) for name in snapshot_fields())
+
+
+def restore_user(snapshot):
+    """
+    Пользователь с отложенными остальными полями: save() такого объекта
+    обновляет только загруженные поля и не затирает счетчики и пароль.
+    """
+    return User.from_db(DEFAULT_DB_ALIAS, snapshot_fields(), snapshot)
+
+
+def invalidate_token(key):
+    cache_key = token_cache_key(key)
+    local_cache.delete(cache_key)
+    cache.delete(cache_key)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication без запроса к authtoken_token на каждый запрос.
+
+    Токен разрешается через LRU процесса и общий кэш, где хранится
+    снимок пользователя. Сигналы сбрасывают запись при выходе, изменении
+    и удалении пользователя; LRU других процессов живет не дольше
+    AUTH_TOKEN_LOCAL_CACHE_TIMEOUT.
+    """
+
+    def authenticate_credentials(self, key):
+        cache_key = token_cache_key(key)
+        snapshot = local_cache.get(cache_key)
+        if snapshot is None:
+            snapshot = cache.get(cache_key)
+            if snapshot is None:
+                # Токен, выданный только что, реплика может еще не знать.
+                with read_from_primary():
+                    user, token = super().authenticate_credentials(key)
+                snapshot = make_snapshot(user)
+                cache.set(
+                    cache_key, snapshot,
+                    timeout=settings.AUTH_TOKEN_CACHE_TIMEOUT
+                )
+            local_cache.set(cache_key, snapshot)
+        user = restore_user(snapshot)
+        return user, self.get_model()(key=key, user_id=user.pk)
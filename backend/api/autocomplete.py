@@ -0,0 +1,61 @@
+import threading
+from bisect import bisect_left
+
+from .cache import get_version
+from recipes.models import Ingredient
+
+PREFIX_END = '\U0010ffff'
+
+
+def normalize(text):
+    return text.casefold().replace('ё', 'е').strip()
+
+
+class IngredientIndex:
+    """
+    Префиксный индекс ингредиентов в памяти процесса.
+
+    Хранит отсортированный массив нормализованных названий и ищет префикс
+    через bisect. Индекс строится при первом поиске и перестраивается,
+    когда меняется поколение справочника ингредиентов в кэше.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = (None, [], [])
+
+    def build(self):
+        rows = sorted(
+            Ingredient.objects.values_list('id', 'name', 'measurment_unit'),
+            key=lambda row: (normalize(row[1]), row[0])
+        )
+        keys = [normalize(name) for _, name, _ in rows]
+        items = [
+            {'id': pk, 'name': name, 'measurment_unit': measurment_unit}
+            for pk, name, measurment_unit in rows
+        ]
+        return keys, items
+
+    def refresh(self):
+        version = get_version(Ingredient)
+        if self.snapshot[0] != version:
+            with self.lock:
+                if self.snapshot[0] != version:
+                    self.snapshot = (version, *self.build())
+        return self.snapshot[1:]
+
+    def search(self, query, contains=False):
+        keys, items = self.refresh()
+        prefix = normalize(query)
+        start = bisect_left(keys, prefix)
+        end = bisect_left(keys, prefix + PREFIX_END, start)
+        result = items[start:end]
+        if contains:
+            result.extend(
+                items[index] for index, key in enumerate(keys)
+                if prefix in key and not start <= index < end
+            )
+        return result
+
+
+ingredient_index = IngredientIndex()
@@ -0,0 +1,124 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.renderers import JSONRenderer
+
+from foodgram.replicas import read_from_primary
+from recipes.models import Tag
+
+
+def version_key(model, pk=None):
+    if pk is None:
+        return f'catalog:{model._meta.label_lower}:version'
+    return f'catalog:{model._meta.label_lower}:{pk}:version'
+
+
+def get_version(model, pk=None):
+    key = version_key(model, pk)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def get_versions(*targets):
+    """Поколения нескольких моделей или объектов за одно чтение кэша."""
+    keys = {version_key(*target): target for target in targets}
+    found = cache.get_many(keys)
+    return tuple(
+        found[key] if key in found else get_version(*target)
+        for key, target in keys.items()
+    )
+
+
+def bump_version(model, pk=None):
+    try:
+        cache.incr(version_key(model, pk))
+    except ValueError:
+        cache.set(version_key(model, pk), time.time_ns(), timeout=None)
+
+
+def schedule_bump(model, pk=None):
+    """
+    Увеличивает поколение после фиксации транзакции, иначе параллельный
+    запрос успел бы закэшировать еще не измененные данные под новым ключом.
+    """
+    transaction.on_commit(lambda: bump_version(model, pk))
+
+
+def tag_bits():
+    """Биты тэгов в маске рецепта по slug, до следующего изменения тэгов."""
+    key = f'{version_key(Tag)}:{get_version(Tag)}:bits'
+    bits = cache.get(key)
+    if bits is None:
+        with read_from_primary():
+            bits = dict(
+                Tag.objects.exclude(bit=None).values_list('slug', 'bit')
+            )
+        cache.set(key, bits, timeout=settings.CATALOG_CACHE_TIMEOUT)
+    return bits
+
+
+def catalog_key(model, request):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'catalog:{model._meta.label_lower}:{get_version(model)}:{path}'
+
+
+def catalog_response(request, entry):
+    etag, last_modified, content = entry
+    response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=last_modified,
+        response=response
+    )
+
+
+class CachedCatalogMixin:
+    """
+    Отдает справочники из кэша готовым JSON с ETag и Last-Modified.
+
+    Ключ кэша включает поколение модели, которое увеличивают сигналы
+    post_save и post_delete, поэтому устаревшие записи не читаются.
+    Условные GET-запросы получают 304 без обращения к базе.
+    """
+
+    def perform_authentication(self, request):
+        pass
+
+    def cached_response(self, request, handler, *args, **kwargs):
+        if request.accepted_renderer.format != 'json':
+            return handler(request, *args, **kwargs)
+        key = catalog_key(self.queryset.model, request)
+        entry = cache.get(key)
+        if entry is None:
+            with read_from_primary():
+                response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            content = JSONRenderer().render(response.data)
+            entry = (
+                f'"{hashlib.sha1(content).hexdigest()}"',
+                int(time.time()),
+                content
+            )
+            cache.set(key, entry, timeout=settings.CATALOG_CACHE_TIMEOUT)
+        return catalog_response(request, entry)
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            request, super().retrieve, *args, **kwargs
+        )
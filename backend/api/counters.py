@@ -0,0 +1,15 @@
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+
+def change_counter(model, pks, field, delta):
+    """
+    Атомарно меняет счетчик одним UPDATE на стороне базы.
+
+    Счетчик не опускается ниже нуля, даже если успел разойтись с данными;
+    расхождения исправляет команда rebuild_counters.
+    """
+    if pks:
+        model.objects.filter(pk__in=pks).update(
+            **{field: Greatest(F(field) + delta, Value(0))}
+        )
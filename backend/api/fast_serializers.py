@@ -0,0 +1,192 @@
+"""
+Быстрая сборка ответов со списками рецептов.
+
+Строки рецептов берутся через values(), теги и ингредиенты страницы -
+одним готовым SQL-запросом на PostgreSQL или двумя запросами
+values_list() на других базах. Словари ответа собираются обычными
+функциями. Результат совпадает с RecipeShowSerializer байт в байт,
+это проверяют FastSerializersTest и команда check_fast_serializers в CI.
+"""
+import functools
+import json
+from collections import defaultdict
+
+from django.db import connections, router
+
+from .images import image_urls
+from recipes.models import (Favorite, Ingredient, IngredientInRecipe, Recipe,
+                            ShoppingCart, Tag)
+from users.models import Subscription, User
+
+RECIPE_FIELDS = (
+    'id',
+    'name',
+    'image',
+    'renditions_ready',
+    'text',
+    'cooking_time',
+    'author_id',
+    'author__email',
+    'author__first_name',
+    'author__last_name',
+    'author__username',
+)
+USER_FLAGS = ('is_favorited', 'is_in_shopping_cart', 'author_is_subscribed')
+
+
+def on_postgresql():
+    return connections[router.db_for_read(Recipe)].vendor == 'postgresql'
+
+
+def recipe_rows(queryset):
+    """
+    Строки рецептов для serialize_recipes. На PostgreSQL из queryset
+    берутся только id, остальное serialize_recipes выбирает одним
+    готовым запросом; на других базах флаги пользователя - аннотации
+    annotate_user_flags.
+    """
+    if on_postgresql():
+        return queryset.prefetch_related(None).values('id')
+    return queryset.prefetch_related(None).values(*RECIPE_FIELDS, *USER_FLAGS)
+
+
+def recipe_tags(recipe_ids):
+    """Теги рецептов по id рецепта в порядке id тега."""
+    tags = {}
+    by_recipe = defaultdict(list)
+    for recipe_id, tag_id, name, color, slug in (
+        Recipe.tags.through.objects.filter(
+            recipe_id__in=recipe_ids
+        ).order_by('tag_id').values_list(
+            'recipe_id', 'tag_id', 'tag__name', 'tag__color', 'tag__slug'
+        )
+    ):
+        tag = tags.get(tag_id)
+        if tag is None:
+            tag = tags[tag_id] = {
+                'id': tag_id, 'name': name, 'color': color, 'slug': slug
+            }
+        by_recipe[recipe_id].append(tag)
+    return by_recipe
+
+
+def recipe_ingredients(recipe_ids):
+    """Ингредиенты рецептов по id рецепта в порядке добавления."""
+    by_recipe = defaultdict(list)
+    for recipe_id, ingredient_id, name, measurment_unit, amount in (
+        IngredientInRecipe.objects.filter(
+            recipe_id__in=recipe_ids
+        ).order_by('id').values_list(
+            'recipe_id',
+            'ingredient_id',
+            'ingredient__name',
+            'ingredient__measurment_unit',
+            'amount'
+        )
+    ):
+        by_recipe[recipe_id].append({
+            'id': ingredient_id,
+            'name': name,
+            'measurment_unit': measurment_unit,
+            'amount': amount,
+        })
+    return by_recipe
+
+
+def recipe_payloads(rows, tags, ingredients):
+    """Ответы RecipeShowSerializer для строк recipe_rows."""
+    payloads = []
+    for row in rows:
+        images = image_urls(row['image'], row['renditions_ready'])
+        payloads.append({
+            'id': row['id'],
+            'tags': tags.get(row['id'], []),
+            'author': {
+                'id': row['author_id'],
+                'email': row['author__email'],
+                'first_name': row['author__first_name'],
+                'last_name': row['author__last_name'],
+                'username': row['author__username'],
+                'is_subscribed': row['author_is_subscribed'],
+            },
+            'ingredients': ingredients.get(row['id'], []),
+            'name': row['name'],
+            'image': images['original'],
+            'images': images,
+            'text': row['text'],
+            'cooking_time': row['cooking_time'],
+            'is_favorited': row['is_favorited'],
+            'is_in_shopping_cart': row['is_in_shopping_cart'],
+        })
+    return payloads
+
+
+@functools.lru_cache(maxsize=None)
+def page_sql():
+    """
+    Рецепты страницы с автором, тегами, ингредиентами и флагами
+    пользователя одним запросом, в порядке массива id. Текст строится
+    один раз: сборка запроса в ORM дороже его выполнения.
+    """
+    def table(model):
+        return model._meta.db_table
+
+    return (
+        'SELECT r.id, r.name, r.image, r.renditions_ready, r.text, '
+        'r.cooking_time, r.author_id, '
+        'u.email, u.first_name, u.last_name, u.username, EXISTS('
+        f'SELECT 1 FROM {table(Favorite)} '
+        'WHERE recipe_id = r.id AND user_id = %(user)s'
+        '), EXISTS('
+        f'SELECT 1 FROM {table(ShoppingCart)} '
+        'WHERE recipe_id = r.id AND user_id = %(user)s'
+        '), EXISTS('
+        f'SELECT 1 FROM {table(Subscription)} '
+        'WHERE author_id = r.author_id AND subscriber_id = %(user)s'
+        '), ('
+        'SELECT COALESCE(JSON_AGG(JSON_BUILD_OBJECT('
+        '\'id\', t.id, \'name\', t.name, \'color\', t.color, '
+        '\'slug\', t.slug'
+        ') ORDER BY t.id), \'[]\')::text '
+        f'FROM {table(Recipe.tags.through)} rt '
+        f'JOIN {table(Tag)} t ON t.id = rt.tag_id '
+        'WHERE rt.recipe_id = r.id'
+        '), ('
+        'SELECT COALESCE(JSON_AGG(JSON_BUILD_OBJECT('
+        '\'id\', i.id, \'name\', i.name, '
+        '\'measurment_unit\', i.measurment_unit, \'amount\', ri.amount'
+        ') ORDER BY ri.id), \'[]\')::text '
+        f'FROM {table(IngredientInRecipe)} ri '
+        f'JOIN {table(Ingredient)} i ON i.id = ri.ingredient_id '
+        'WHERE ri.recipe_id = r.id'
+        ') FROM UNNEST(%(ids)s::bigint[]) '
+        'WITH ORDINALITY AS page(id, position) '
+        f'JOIN {table(Recipe)} r ON r.id = page.id '
+        f'JOIN {table(User)} u ON u.id = r.author_id '
+        'ORDER BY page.position'
+    )
+
+
+def recipe_page(recipe_ids, user):
+    """Строки recipe_payloads, теги и ингредиенты по id рецепта."""
+    rows = []
+    tags = {}
+    ingredients = {}
+    if not recipe_ids:
+        return rows, tags, ingredients
+    with connections[router.db_for_read(Recipe)].cursor() as cursor:
+        cursor.execute(page_sql(), {'user': user.pk, 'ids': recipe_ids})
+        for *row, tag_rows, ingredient_rows in cursor:
+            row = dict(zip(RECIPE_FIELDS + USER_FLAGS, row))
+            tags[row['id']] = json.loads(tag_rows)
+            ingredients[row['id']] = json.loads(ingredient_rows)
+            rows.append(row)
+    return rows, tags, ingredients
+
+
+def serialize_recipes(rows, user):
+    """Ответы RecipeShowSerializer для строк recipe_rows."""
+    ids = [row['id'] for row in rows]
+    if on_postgresql():
+        return recipe_payloads(*recipe_page(ids, user))
+    return recipe_payloads(rows, recipe_tags(ids), recipe_ingredients(ids))
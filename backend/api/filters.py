@@ -1,6 +1,52 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import (Case, Count, Exists, F, IntegerField, OuterRef,
+                              When)
 from django_filters.rest_framework import FilterSet, filters
 
-from recipes.models import Ingredient, Recipe, Tag
+from .cache import tag_bits
+from recipes.models import (SEARCH_CONFIG, Ingredient, IngredientInRecipe,
+                            Recipe, tags_mask)
+
+TAGS_MODES = (('any', 'Любой из тэгов'), ('all', 'Все тэги'))
+# До 2^8 значений маски подходящие перечисляются для индекса по tags_mask,
+# при большем числе тэгов поиск идет по индексу tag_id таблицы связей.
+MAX_ENUMERATED_TAGS = 8
+
+
+def tag_choices():
+    return [(slug, slug) for slug in tag_bits()]
+
+
+def submasks(mask):
+    submask = mask
+    while True:
+        yield submask
+        if not submask:
+            return
+        submask = (submask - 1) & mask
+
+
+def filter_tags(queryset, mask, known_mask, match_all):
+    """
+    Рецепты, у которых в маске есть любой (или каждый) бит из mask.
+
+    Пока тэгов немного, подходящие значения маски перечисляются целиком,
+    и условие tags_mask IN (...) использует обычный индекс. Иначе рецепты
+    выбираются из таблицы связей с тэгами по ее индексу tag_id.
+    """
+    if bin(known_mask).count('1') <= MAX_ENUMERATED_TAGS:
+        return queryset.filter(tags_mask__in=[
+            value for value in submasks(known_mask)
+            if (value & mask == mask if match_all else value & mask)
+        ])
+    bits = [bit for bit in range(mask.bit_length()) if mask >> bit & 1]
+    links = Recipe.tags.through.objects.filter(tag__bit__in=bits)
+    if match_all:
+        links = links.values('recipe').annotate(
+            matched=Count('tag')
+        ).filter(matched=len(bits))
+    return queryset.filter(pk__in=links.values('recipe'))
 
 
 class IngredientFilter(FilterSet):
@@ -14,20 +60,53 @@ class IngredientFilter(FilterSet):
         fields = ('name',)
 
 
+class RecipeOrderingFilter(filters.OrderingFilter):
+    """Сортировка по счетчикам, при равенстве - сначала новые рецепты."""
+
+    def filter(self, queryset, value):
+        if not value:
+            return queryset
+        return queryset.order_by(
+            *(self.get_ordering_value(param) for param in value), '-id'
+        )
+
+
 class RecipeFilter(FilterSet):
-    tags = filters.ModelMultipleChoiceFilter(
-        queryset=Tag.objects.all(),
-        field_name='tags__slug',
-        to_field_name='slug',
+    tags = filters.MultipleChoiceFilter(
+        choices=tag_choices,
+        method='get_tags'
+    )
+    tags_mode = filters.ChoiceFilter(
+        choices=TAGS_MODES,
+        method='get_tags_mode'
     )
     is_favorited = filters.BooleanFilter(method='get_is_favorited')
     is_in_shopping_cart = filters.BooleanFilter(
         method='get_is_in_shopping_cart'
     )
+    search = filters.CharFilter(method='get_search')
+    ordering = RecipeOrderingFilter(
+        fields=('favorites_count', 'in_carts_count')
+    )
 
     class Meta:
         model = Recipe
-        fields = ('author', 'tags', 'is_favorited', 'is_in_shopping_cart')
+        fields = (
+            'author', 'tags', 'tags_mode', 'is_favorited',
+            'is_in_shopping_cart', 'search', 'ordering'
+        )
+
+    def get_tags(self, queryset, name, value):
+        bits = tag_bits()
+        return filter_tags(
+            queryset,
+            tags_mask(bits[slug] for slug in value),
+            tags_mask(bits.values()),
+            self.form.cleaned_data.get('tags_mode') == 'all'
+        )
+
+    def get_tags_mode(self, queryset, name, value):
+        return queryset
 
     def get_is_favorited(self, queryset, name, value):
         user = self.request.user
@@ -40,3 +119,22 @@ class RecipeFilter(FilterSet):
         if user.is_authenticated and value:
             return queryset.filter(shopping_cart__user=user)
         return queryset
+
+    def get_search(self, queryset, name, value):
+        if connection.vendor == 'postgresql':
+            query = SearchQuery(
+                value, config=SEARCH_CONFIG, search_type='websearch'
+            )
+            return queryset.filter(search_vector=query).annotate(
+                rank=SearchRank(F('search_vector'), query)
+            ).order_by('-rank', '-id')
+        in_ingredients = Exists(IngredientInRecipe.objects.filter(
+            recipe=OuterRef('pk'), ingredient__name__icontains=value
+        ))
+        return queryset.annotate(rank=Case(
+            When(name__icontains=value, then=3),
+            When(in_ingredients, then=2),
+            When(text__icontains=value, then=1),
+            default=0,
+            output_field=IntegerField()
+        )).filter(rank__gt=0).order_by('-rank', '-id')
@@ -0,0 +1,146 @@
+import base64
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from PIL import Image, features
+
+from .cache import bump_version
+from recipes.models import Recipe
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = 'recipes'
+DECODE_CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+RENDITIONS = {
+    'card': (600, 600),
+    'thumbnail': (200, 200),
+}
+RENDITION_FORMAT = 'webp' if features.check('webp') else 'jpeg'
+
+executor = ThreadPoolExecutor(
+    max_workers=settings.IMAGE_WORKERS,
+    thread_name_prefix='renditions'
+)
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def store_base64_image(encoded):
+    """
+    Декодирует base64 по частям во временный файл и считает sha256.
+
+    Имя файла строится из хеша содержимого, поэтому одинаковые загрузки
+    не дублируются: для уже сохраненного файла возвращается его имя,
+    для нового - File, который сохранит модель.
+    """
+    if len(encoded) * 3 // 4 > settings.MAX_IMAGE_SIZE:
+        raise ImageTooLarge
+    digest = hashlib.sha256()
+    file = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    for start in range(0, len(encoded), DECODE_CHUNK_SIZE):
+        chunk = base64.b64decode(
+            encoded[start:start + DECODE_CHUNK_SIZE], validate=True
+        )
+        digest.update(chunk)
+        file.write(chunk)
+    file.seek(0)
+    with Image.open(file) as image:
+        image.verify()
+        ext = image.format.lower()
+    file.seek(0)
+    hexdigest = digest.hexdigest()
+    name = f'{UPLOAD_DIR}/{hexdigest[:2]}/{hexdigest}.{ext}'
+    if default_storage.exists(name):
+        file.close()
+        return name
+    return File(file, name=name)
+
+
+def rendition_name(name, rendition):
+    return f'{os.path.splitext(name)[0]}.{rendition}.{RENDITION_FORMAT}'
+
+
+def make_renditions(name):
+    """Сохраняет недостающие превью, False - если не получилось."""
+    try:
+        with default_storage.open(name) as file, Image.open(file) as image:
+            image.load()
+            if RENDITION_FORMAT == 'jpeg':
+                image = image.convert('RGB')
+            for rendition, size in RENDITIONS.items():
+                target = rendition_name(name, rendition)
+                if default_storage.exists(target):
+                    continue
+                copy = image.copy()
+                copy.thumbnail(size)
+                buffer = BytesIO()
+                copy.save(buffer, RENDITION_FORMAT, quality=80)
+                default_storage.save(target, ContentFile(buffer.getvalue()))
+    except Exception:
+        logger.exception('Не удалось подготовить превью для %s', name)
+        return False
+    return True
+
+
+def mark_renditions_ready(name):
+    """
+    Отмечает превью готовыми у рецептов с этой картинкой и сбрасывает их
+    кэш, чтобы карточки стали ссылаться на превью.
+    """
+    ids = list(Recipe.objects.filter(
+        image=name, renditions_ready=False
+    ).values_list('pk', flat=True))
+    Recipe.objects.filter(pk__in=ids).update(renditions_ready=True)
+    for pk in ids:
+        bump_version(Recipe, pk)
+
+
+def process_renditions(name):
+    try:
+        if make_renditions(name):
+            mark_renditions_ready(name)
+    finally:
+        # Поток пула не обслуживает запросы, соединение закрывается здесь.
+        connection.close()
+
+
+def schedule_renditions(image):
+    """Готовит превью в фоновом пуле после фиксации транзакции."""
+    if image:
+        name = image.name
+        transaction.on_commit(
+            lambda: executor.submit(process_renditions, name)
+        )
+
+
+def rendition_urls(recipe):
+    if not recipe.image:
+        return {}
+    return image_urls(recipe.image.name, recipe.renditions_ready)
+
+
+def image_urls(name, renditions_ready):
+    """
+    Ссылки на оригинал и превью без обращений к хранилищу: пока превью
+    не готовы, вместо них отдается оригинал.
+    """
+    original = default_storage.url(name)
+    urls = {'original': original}
+    for rendition in RENDITIONS:
+        urls[rendition] = (
+            default_storage.url(rendition_name(name, rendition))
+            if renditions_ready else original
+        )
+    return urls
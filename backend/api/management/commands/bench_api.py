@@ -0,0 +1,272 @@
+import base64
+import json
+import os
+import statistics
+import time
+import tracemalloc
+from io import BytesIO
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from foodgram.settings import BASE_DIR
+from recipes.models import Favorite, Ingredient, Recipe, ShoppingCart, Tag
+from users.models import Subscription, User
+
+DEFAULT_BASELINE = os.path.join(BASE_DIR, 'bench_baseline.json')
+# Регрессией считается рост медианы: p95 на общих машинах слишком шумный.
+# Разница меньше NOISE_FLOOR_MS считается шумом.
+NOISE_FLOOR_MS = 2
+ALLOCATION_SAMPLES = 3
+# Точки сохранения, в которых выполняется каждый запрос, не считаются.
+TRANSACTION_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO')
+
+
+def image():
+    buffer = BytesIO()
+    Image.new('RGB', (600, 400), '#49B64E').save(buffer, 'PNG')
+    return (
+        'data:image/png;base64,'
+        + base64.b64encode(buffer.getvalue()).decode()
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        'Прогоняет эндпоинты API через тестовый клиент на текущей базе и '
+        'сравнивает p50/p95, число запросов и аллокации с базовой линией'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+        parser.add_argument(
+            '--save',
+            action='store_true',
+            help='Сохранить результаты как новую базовую линию'
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=0.5,
+            help='Допустимый рост p50 и аллокаций, доля от базовой линии'
+        )
+        parser.add_argument(
+            '--only',
+            nargs='*',
+            help='Запустить только сценарии с этими именами'
+        )
+
+    def fixtures(self):
+        user = User.objects.filter(
+            shopping_cart__isnull=False, subscriber__isnull=False
+        ).order_by('id').first()
+        recipe = Recipe.objects.order_by('-id').first()
+        if user is None or recipe is None:
+            raise CommandError(
+                'В базе нет данных, сначала запустите seed_foodgram'
+            )
+        author = Subscription.objects.filter(
+            subscriber=user
+        ).order_by('id').first().author
+        other = User.objects.exclude(
+            pk__in=Subscription.objects.filter(
+                subscriber=user
+            ).values('author')
+        ).exclude(pk=user.pk).order_by('id').first() or author
+        free_recipe = Recipe.objects.exclude(
+            pk__in=Favorite.objects.filter(user=user).values('recipe')
+        ).exclude(
+            pk__in=ShoppingCart.objects.filter(user=user).values('recipe')
+        ).order_by('-id').first() or recipe
+        ingredients = list(
+            recipe.recipe_ingredient.values_list('ingredient_id', flat=True)
+        )
+        return {
+            'user': user,
+            'recipe': recipe,
+            'author': author,
+            'other': other,
+            'free_recipe': free_recipe,
+            'ingredients': ingredients,
+            'batch': list(Recipe.objects.values_list('id', flat=True)[:20]),
+            'tags': list(Tag.objects.values_list('slug', flat=True)[:2]),
+            'name': Ingredient.objects.order_by('id').first().name[:2],
+        }
+
+    def scenarios(self, data):
+        recipe_id = data['recipe'].id
+        free_id = data['free_recipe'].id
+        tags = '&'.join(f'tags={slug}' for slug in data['tags'])
+        ids = ','.join(map(str, data['ingredients']))
+        create = {
+            'name': 'Бенчмарк',
+            'text': 'Рецепт для замера создания',
+            'cooking_time': 15,
+            'image': image(),
+            'tags': list(Tag.objects.values_list('id', flat=True)[:2]),
+            'ingredients': [
+                {'id': ingredient_id, 'amount': 100}
+                for ingredient_id in data['ingredients']
+            ],
+        }
+        return (
+            ('tags', 'get', '/api/tags/', None, False),
+            ('ingredients', 'get', f'/api/ingredients/?name={data["name"]}',
+             None, False),
+            ('recipes_anonymous', 'get', '/api/recipes/', None, False),
+            ('recipes', 'get', '/api/recipes/', None, True),
+            ('recipes_tags', 'get', f'/api/recipes/?{tags}', None, True),
+            ('recipes_favorited', 'get', '/api/recipes/?is_favorited=1',
+             None, True),
+            ('recipes_cart', 'get', '/api/recipes/?is_in_shopping_cart=1',
+             None, True),
+            ('recipes_search', 'get',
+             f'/api/recipes/?search={data["recipe"].name.split()[0]}',
+             None, True),
+            ('recipe', 'get', f'/api/recipes/{recipe_id}/', None, True),
+            ('by_ingredients', 'get',
+             f'/api/recipes/by_ingredients/?ids={ids}', None, True),
+            ('download_shopping_cart', 'get',
+             '/api/recipes/download_shopping_cart/', None, True),
+            ('recipe_create', 'post', '/api/recipes/', create, True),
+            ('favorite', 'post', f'/api/recipes/{free_id}/favorite/',
+             None, True),
+            ('shopping_cart', 'post', f'/api/recipes/{free_id}/shopping_cart/',
+             None, True),
+            ('shopping_cart_batch', 'post', '/api/recipes/shopping_cart/',
+             {'ids': data['batch']}, True),
+            ('users', 'get', '/api/users/', None, True),
+            ('user', 'get', f'/api/users/{data["author"].id}/', None, True),
+            ('me', 'get', '/api/users/me/', None, True),
+            ('subscriptions', 'get', '/api/users/subscriptions/', None, True),
+            ('subscribe', 'post', f'/api/users/{data["other"].id}/subscribe/',
+             None, True),
+        )
+
+    def request(self, client, method, path, payload):
+        """Запрос в точке сохранения: изменения данных откатываются."""
+        with transaction.atomic():
+            response = getattr(client, method)(path, payload, format='json')
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+            transaction.set_rollback(True)
+        if response.status_code >= 400:
+            raise CommandError(
+                f'{method.upper()} {path}: {response.status_code}'
+            )
+
+    def measure(self, client, method, path, payload):
+        for _ in range(self.options['warmup']):
+            self.request(client, method, path, payload)
+        peaks = []
+        for _ in range(ALLOCATION_SAMPLES):
+            tracemalloc.start()
+            with CaptureQueriesContext(connection) as queries:
+                self.request(client, method, path, payload)
+            query_count = sum(
+                not query['sql'].startswith(TRANSACTION_STATEMENTS)
+                for query in queries
+            )
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        timings = []
+        for _ in range(self.options['iterations']):
+            start = time.perf_counter()
+            self.request(client, method, path, payload)
+            timings.append((time.perf_counter() - start) * 1000)
+        percentiles = statistics.quantiles(
+            timings, n=100, method='inclusive'
+        )
+        return {
+            'p50': round(percentiles[49], 3),
+            'p95': round(percentiles[94], 3),
+            'queries': query_count,
+            'alloc_kb': round(min(peaks) / 1024, 1),
+        }
+
+    def regressions(self, name, result, baseline):
+        if baseline is None:
+            return []
+        tolerance = 1 + self.options['tolerance']
+        problems = []
+        if result['queries'] > baseline['queries']:
+            problems.append(
+                f'запросов {baseline["queries"]} -> {result["queries"]}'
+            )
+        if (result['p50'] > baseline['p50'] * tolerance
+                and result['p50'] - baseline['p50'] > NOISE_FLOOR_MS):
+            problems.append(
+                f'p50 {baseline["p50"]} -> {result["p50"]} мс'
+            )
+        if result['alloc_kb'] > baseline['alloc_kb'] * tolerance:
+            problems.append(
+                f'аллокации {baseline["alloc_kb"]} -> '
+                f'{result["alloc_kb"]} КБ'
+            )
+        return [f'{name}: {problem}' for problem in problems]
+
+    def run(self):
+        data = self.fixtures()
+        anonymous = APIClient()
+        client = APIClient()
+        token, _ = Token.objects.get_or_create(user=data['user'])
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        results = {}
+        self.stdout.write(
+            f'{"сценарий":<24}{"p50, мс":>10}{"p95, мс":>10}'
+            f'{"запросов":>10}{"КБ":>10}'
+        )
+        for name, method, path, payload, auth in self.scenarios(data):
+            if self.options['only'] and name not in self.options['only']:
+                continue
+            result = self.measure(
+                client if auth else anonymous, method, path, payload
+            )
+            results[name] = result
+            self.stdout.write(
+                f'{name:<24}{result["p50"]:>10.2f}{result["p95"]:>10.2f}'
+                f'{result["queries"]:>10}{result["alloc_kb"]:>10.1f}'
+            )
+        return results
+
+    def handle(self, *args, **options):
+        self.options = options
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            with transaction.atomic():
+                results = self.run()
+                transaction.set_rollback(True)
+        path = options['baseline']
+        if options['save']:
+            if options['only'] and os.path.exists(path):
+                with open(path) as file:
+                    results = {**json.load(file), **results}
+            with open(path, 'w') as file:
+                json.dump(results, file, indent=2, ensure_ascii=False)
+            self.stdout.write(self.style.SUCCESS(
+                f'Базовая линия сохранена в {path}'
+            ))
+            return
+        if not os.path.exists(path):
+            return
+        with open(path) as file:
+            baseline = json.load(file)
+        problems = [
+            problem
+            for name, result in results.items()
+            for problem in self.regressions(name, result, baseline.get(name))
+        ]
+        if problems:
+            raise CommandError(
+                'Регрессии относительно базовой линии:\n'
+                + '\n'.join(problems)
+            )
+        self.stdout.write(self.style.SUCCESS(
+            'Регрессий относительно базовой линии нет'
+        ))
@@ -0,0 +1,47 @@
+from timeit import timeit
+
+from django.core.management import BaseCommand
+
+from api.autocomplete import ingredient_index, normalize
+from recipes.models import Ingredient
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает поиск ингредиентов по индексу в памяти и через ORM'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--length',
+            type=int,
+            default=2,
+            help='Длина префикса, как при вводе в форме рецепта'
+        )
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        prefixes = sorted({
+            normalize(name)[:options['length']]
+            for name in Ingredient.objects.values_list('name', flat=True)
+        })
+        if not prefixes:
+            self.stdout.write('Справочник ингредиентов пуст')
+            return
+        ingredient_index.refresh()
+
+        def orm():
+            for prefix in prefixes:
+                list(Ingredient.objects.filter(
+                    name__istartswith=prefix
+                ).values('id', 'name', 'measurment_unit'))
+
+        def index():
+            for prefix in prefixes:
+                ingredient_index.search(prefix)
+
+        for label, func in (('ORM', orm), ('Индекс', index)):
+            seconds = timeit(func, number=options['repeat'])
+            per_query = seconds / options['repeat'] / len(prefixes) * 1000
+            self.stdout.write(
+                f'{label}: {len(prefixes)} префиксов, '
+                f'{per_query:.3f} мс на запрос'
+            )
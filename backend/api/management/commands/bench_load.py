@@ -0,0 +1,178 @@
+import asyncio
+import itertools
+import statistics
+import time
+from urllib.parse import quote, urlsplit
+
+from django.core.management import BaseCommand, CommandError
+from rest_framework.authtoken.models import Token
+
+from recipes.models import Ingredient, Recipe
+from users.models import Subscription
+
+
+class ResponseError(Exception):
+    pass
+
+
+async def read_response(reader):
+    """Статус, признак keep-alive и тело ответа HTTP/1.1."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ResponseError('соединение закрыто')
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                break
+    else:
+        await reader.read()
+        return status, False
+    return status, headers.get('connection') != 'close'
+
+
+class Client:
+    """Клиент с keep-alive, переподключается, если сервер закрыл сокет."""
+
+    def __init__(self, host, port, headers):
+        self.host = host
+        self.port = port
+        self.headers = headers
+        self.reader = self.writer = None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def get(self, path):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+        self.writer.write(
+            f'GET {path} HTTP/1.1\r\n{self.headers}\r\n'.encode()
+        )
+        await self.writer.drain()
+        try:
+            status, keep_alive = await read_response(self.reader)
+        except (ResponseError, asyncio.IncompleteReadError):
+            await self.close()
+            raise
+        if not keep_alive:
+            await self.close()
+        return status
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагружает запущенный сервер GET-запросами горячих эндпоинтов '
+        'с заданным числом одновременных клиентов и выводит пропускную '
+        'способность и задержки'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--concurrency', type=int, default=200)
+        parser.add_argument(
+            '--duration',
+            type=float,
+            default=30,
+            help='Длительность замера в секундах'
+        )
+        parser.add_argument(
+            '--warmup',
+            type=float,
+            default=5,
+            help='Прогрев перед замером в секундах, не учитывается'
+        )
+
+    def paths(self):
+        subscription = Subscription.objects.select_related(
+            'subscriber'
+        ).order_by('id').first()
+        recipe = Recipe.objects.order_by('-id').first()
+        if subscription is None or recipe is None:
+            raise CommandError(
+                'В базе нет данных, сначала запустите seed_foodgram'
+            )
+        token, _ = Token.objects.get_or_create(user=subscription.subscriber)
+        name = Ingredient.objects.order_by('id').first().name[:2]
+        return token.key, (
+            '/api/recipes/',
+            '/api/recipes/?page=2',
+            f'/api/recipes/{recipe.id}/',
+            f'/api/ingredients/?name={quote(name)}',
+            '/api/users/subscriptions/',
+        )
+
+    async def client(self, host, port, headers, paths, deadline, results):
+        client = Client(host, port, headers)
+        try:
+            while True:
+                path = next(paths)
+                start = time.perf_counter()
+                if start > deadline:
+                    return
+                try:
+                    status = await client.get(path)
+                except (OSError, ResponseError, asyncio.IncompleteReadError):
+                    status = None
+                results.append(
+                    (start, (time.perf_counter() - start) * 1000, status)
+                )
+        finally:
+            await client.close()
+
+    async def load(self, url, key, paths):
+        address = urlsplit(url)
+        headers = (
+            f'Host: {address.netloc}\r\n'
+            f'Authorization: Token {key}\r\n'
+            'Accept: application/json\r\n'
+        )
+        start = time.perf_counter()
+        measure_from = start + self.options['warmup']
+        deadline = measure_from + self.options['duration']
+        results = []
+        paths = itertools.cycle(paths)
+        await asyncio.gather(*(
+            self.client(
+                address.hostname, address.port or 80, headers, paths,
+                deadline, results
+            )
+            for _ in range(self.options['concurrency'])
+        ))
+        return [result for result in results if result[0] >= measure_from]
+
+    def handle(self, *args, **options):
+        self.options = options
+        key, paths = self.paths()
+        results = asyncio.run(self.load(options['url'], key, paths))
+        if not results:
+            raise CommandError('Ни один запрос не выполнен')
+        timings = [timing for _, timing, _ in results]
+        errors = sum(status != 200 for _, _, status in results)
+        percentiles = statistics.quantiles(
+            timings, n=100, method='inclusive'
+        )
+        self.stdout.write(
+            f'клиентов: {options["concurrency"]}, '
+            f'запросов: {len(results)}, ошибок: {errors}\n'
+            f'запросов в секунду: {len(results) / options["duration"]:.1f}\n'
+            f'p50: {percentiles[49]:.1f} мс, p95: {percentiles[94]:.1f} мс, '
+            f'p99: {percentiles[98]:.1f} мс'
+        )
+        if errors:
+            raise CommandError(f'Ответов с ошибкой: {errors}')
@@ -0,0 +1,98 @@
+import random
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from api.fast_serializers import recipe_rows, serialize_recipes
+from api.serializers import RecipeShowSerializer
+from api.views import RecipeViewSet, annotate_user_flags
+from recipes.models import Recipe, Tag
+from users.models import User
+
+PAGE_SIZE = 6
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает JSON списков рецептов из fast_serializers и '
+        'RecipeShowSerializer на случайных страницах, пользователях и '
+        'тегах и выводит процессорное время на страницу: всего, на '
+        'запросы и на сериализацию с рендером JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=200)
+        parser.add_argument('--seed', type=int)
+
+    def random_case(self, rng, users, tags, total):
+        user = rng.choice(users)
+        queryset = RecipeViewSet.queryset.all()
+        if tags and rng.random() < 0.5:
+            # Как filter_tags: без JOIN и DISTINCT по строкам рецептов.
+            queryset = queryset.filter(
+                pk__in=Recipe.tags.through.objects.filter(
+                    tag_id__in=rng.sample(tags, rng.randint(1, len(tags)))
+                ).values('recipe_id')
+            )
+        offset = rng.randrange(max(total - PAGE_SIZE, 0) + 1)
+        queryset = annotate_user_flags(queryset, user)
+        return user, queryset[offset:offset + PAGE_SIZE]
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        total = Recipe.objects.count()
+        if not total:
+            raise CommandError(
+                'В базе нет рецептов, сначала запустите seed_foodgram'
+            )
+        users = [AnonymousUser(), *User.objects.order_by('?')[:50]]
+        tags = list(Tag.objects.values_list('pk', flat=True))
+        renderer = JSONRenderer()
+        factory = APIRequestFactory()
+        # Время запросов и сериализации с рендером JSON, медленный и
+        # быстрый путь.
+        slow = [0, 0]
+        fast = [0, 0]
+        for sample in range(options['samples']):
+            user, page = self.random_case(rng, users, tags, total)
+            request = factory.get('/api/recipes/')
+            request.user = user
+
+            start = time.process_time()
+            recipes = list(page)
+            slow[0] += time.process_time() - start
+            start = time.process_time()
+            expected = renderer.render(RecipeShowSerializer(
+                recipes, many=True, context={'request': request}
+            ).data)
+            slow[1] += time.process_time() - start
+
+            start = time.process_time()
+            rows = list(recipe_rows(page))
+            fast[0] += time.process_time() - start
+            start = time.process_time()
+            # Вне PostgreSQL сюда входят и запросы тегов и ингредиентов.
+            actual = renderer.render(serialize_recipes(rows, user))
+            fast[1] += time.process_time() - start
+
+            if actual != expected:
+                raise CommandError(
+                    f'Ответы различаются, пример {sample}, '
+                    f'пользователь {user.pk}:\n{expected}\n{actual}'
+                )
+        samples = options['samples']
+        for label, slow_time, fast_time in (
+            ('всего', sum(slow), sum(fast)),
+            ('запросы', slow[0], fast[0]),
+            ('сериализация', slow[1], fast[1]),
+        ):
+            self.stdout.write(
+                f'{label}: RecipeShowSerializer '
+                f'{slow_time / samples * 1000:.2f} мс, fast_serializers '
+                f'{fast_time / samples * 1000:.2f} мс на страницу, '
+                f'ускорение {slow_time / fast_time if fast_time else 0:.1f}x'
+            )
+        self.stdout.write(self.style.SUCCESS('Ответы совпадают'))
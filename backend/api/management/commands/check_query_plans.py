@@ -0,0 +1,72 @@
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from api.cache import tag_bits
+from api.filters import filter_tags
+from recipes.models import Ingredient, Recipe, tags_mask
+from users.models import User
+
+HOT_TABLES = (
+    'recipes_recipe',
+    'recipes_favorite',
+    'recipes_shoppingcart',
+    'recipes_ingredient',
+    'users_subscription',
+)
+
+
+def hot_queries(user):
+    """Запросы, которые строят фильтры и вьюсеты API."""
+    bits = tag_bits()
+    mask = tags_mask(list(bits.values())[:1])
+    yield 'Рецепты по тегу и автору', filter_tags(
+        Recipe.objects.filter(author=user), mask,
+        tags_mask(bits.values()), False
+    ).order_by('-id')[:6]
+    yield 'Рецепты автора', Recipe.objects.filter(
+        author=user
+    ).order_by('-id')[:6]
+    yield 'Избранное', Recipe.objects.filter(favorites__user=user)[:6]
+    yield 'Корзина', Recipe.objects.filter(shopping_cart__user=user)[:6]
+    yield 'Подписки', User.objects.filter(
+        subscription__subscriber=user
+    )[:6]
+    yield 'Поиск ингредиента', Ingredient.objects.filter(
+        name__istartswith='Мол'
+    )
+
+
+def seq_scans(plan):
+    return [table for table in HOT_TABLES if f'Seq Scan on {table}' in plan]
+
+
+class Command(BaseCommand):
+    help = (
+        'Выполняет EXPLAIN для частых запросов API и сообщает о '
+        'последовательном сканировании больших таблиц'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int)
+
+    def handle(self, *args, **options):
+        if options['user_id']:
+            user = User.objects.get(pk=options['user_id'])
+        else:
+            user = User.objects.filter(recipes__isnull=False).first()
+        if user is None:
+            raise CommandError('Нет пользователей с рецептами')
+        degraded = []
+        for label, queryset in hot_queries(user):
+            plan = queryset.explain()
+            self.stdout.write(f'{label}:\n{plan}\n')
+            if connection.vendor != 'postgresql':
+                continue
+            scans = seq_scans(plan)
+            if scans:
+                degraded.append(f'{label}: {", ".join(scans)}')
+        if degraded:
+            raise CommandError(
+                'Последовательное сканирование: ' + '; '.join(degraded)
+            )
+        self.stdout.write(self.style.SUCCESS('Планы запросов в порядке'))
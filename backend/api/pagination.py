@@ -1,6 +1,48 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 
 
-class Paginator(PageNumberPagination):
+class CursorPaginator(CursorPagination):
     page_size = 6
     page_size_query_param = 'limit'
+    ordering = '-id'
+
+
+class PageNumberPaginator(PageNumberPagination):
+    page_size = 6
+    page_size_query_param = 'limit'
+
+
+class Paginator(PageNumberPaginator):
+    """
+    Постраничная пагинация с включаемым курсорным режимом.
+
+    По умолчанию ответ совпадает с PageNumberPagination. Если в запросе
+    есть параметр cursor (в том числе пустой для первой страницы),
+    страницы выбираются без OFFSET и без COUNT(*): по -id или по
+    единственному полю, которым упорядочен queryset. Курсор по
+    нескольким полям (поиск, сортировка по счетчикам) дал бы неверные
+    страницы, такой запрос отклоняется.
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_paginator = None
+        if CursorPaginator.cursor_query_param in request.query_params:
+            ordering = queryset.query.order_by
+            if len(ordering) > 1:
+                raise ValidationError({
+                    CursorPaginator.cursor_query_param:
+                        'Курсор нельзя совмещать с поиском и сортировкой'
+                })
+            self.cursor_paginator = CursorPaginator()
+            if ordering:
+                self.cursor_paginator.ordering = ordering[0]
+            return self.cursor_paginator.paginate_queryset(
+                queryset, request, view
+            )
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -0,0 +1,150 @@
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
+from itertools import chain
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from recipes.models import IngredientInRecipe
+
+BUILD_CHUNK_SIZE = 10000
+
+
+class RankedRecipes:
+    """
+    Ленивая последовательность рецептов, отсортированных по покрытию.
+
+    Пагинатор запрашивает только длину и срез, поэтому полностью
+    сортируются лишь рецепты до конца запрошенной страницы.
+    """
+
+    def __init__(self, counts, sizes):
+        self.counts = counts
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.counts)
+
+    def count(self):
+        return len(self.counts)
+
+    def __getitem__(self, index):
+        stop = index.stop if isinstance(index, slice) else index + 1
+        ranked = heapq.nsmallest(stop, (
+            (self.sizes[recipe_id] - matched, -matched, -recipe_id)
+            for recipe_id, matched in self.counts.items()
+        ))
+        ranked = [(-recipe_id, -matched) for _, matched, recipe_id in ranked]
+        return ranked[index]
+
+
+class IngredientRecipeIndex:
+    """
+    Инвертированный индекс: id ингредиента -> отсортированный массив id
+    рецептов, плюс число ингредиентов каждого рецепта.
+
+    Индекс строится при старте воркера gunicorn или при первом запросе,
+    изменения связей рецептов с ингредиентами применяются инкрементально
+    после фиксации транзакции.
+    Другие процессы подхватывают их при фоновой перестройке раз в
+    RECIPE_INDEX_TTL секунд.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.postings = None
+        self.sizes = array('H')
+        self.built_at = 0
+        self.rebuilding = False
+
+    def build(self):
+        postings = {}
+        sizes = array('H')
+        rows = IngredientInRecipe.objects.order_by(
+            'ingredient_id', 'recipe_id'
+        ).values_list('ingredient_id', 'recipe_id').iterator(
+            chunk_size=BUILD_CHUNK_SIZE
+        )
+        for ingredient_id, recipe_id in rows:
+            posting = postings.get(ingredient_id)
+            if posting is None:
+                posting = postings[ingredient_id] = array('q')
+            posting.append(recipe_id)
+            if recipe_id >= len(sizes):
+                sizes.extend([0] * (recipe_id + 1 - len(sizes)))
+            sizes[recipe_id] += 1
+        return postings, sizes
+
+    def rebuild(self, in_background=False):
+        try:
+            postings, sizes = self.build()
+            with self.lock:
+                self.postings, self.sizes = postings, sizes
+                self.built_at = time.monotonic()
+        finally:
+            self.rebuilding = False
+            if in_background:
+                # Поток не обслуживает запросы, соединение закрывается здесь.
+                connection.close()
+
+    def refresh(self):
+        if self.postings is None:
+            # Первый запрос строит индекс, остальные ждут его.
+            with self.build_lock:
+                if self.postings is None:
+                    self.rebuild()
+            return
+        if time.monotonic() - self.built_at <= settings.RECIPE_INDEX_TTL:
+            return
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+        threading.Thread(
+            target=self.rebuild, kwargs={'in_background': True}, daemon=True
+        ).start()
+
+    def add(self, pairs):
+        with self.lock:
+            if self.postings is None:
+                return
+            for ingredient_id, recipe_id in pairs:
+                posting = self.postings.setdefault(ingredient_id, array('q'))
+                position = bisect_left(posting, recipe_id)
+                if position < len(posting) and posting[position] == recipe_id:
+                    continue
+                insort(posting, recipe_id)
+                if recipe_id >= len(self.sizes):
+                    self.sizes.extend([0] * (recipe_id + 1 - len(self.sizes)))
+                self.sizes[recipe_id] += 1
+
+    def remove(self, pairs):
+        with self.lock:
+            if self.postings is None:
+                return
+            for ingredient_id, recipe_id in pairs:
+                posting = self.postings.get(ingredient_id, array('q'))
+                position = bisect_left(posting, recipe_id)
+                if position < len(posting) and posting[position] == recipe_id:
+                    del posting[position]
+                    self.sizes[recipe_id] -= 1
+
+    def schedule(self, method, pairs):
+        transaction.on_commit(lambda: method(pairs))
+
+    def search(self, ingredient_ids):
+        self.refresh()
+        postings = self.postings
+        counts = Counter(chain.from_iterable(
+            postings[ingredient_id] for ingredient_id in set(ingredient_ids)
+            if ingredient_id in postings
+        ))
+        return RankedRecipes(counts, self.sizes)
+
+
+recipe_index = IngredientRecipeIndex()
@@ -0,0 +1,208 @@
+import csv
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+PDF_PAGE_WIDTH = 595
+PDF_PAGE_HEIGHT = 842
+PDF_MARGIN = 50
+PDF_FONT_SIZE = 12
+PDF_LEADING = 16
+PDF_LINES_PER_PAGE = (PDF_PAGE_HEIGHT - 2 * PDF_MARGIN) // PDF_LEADING
+
+
+class Echo:
+    """Псевдо-файл для csv.writer: возвращает строку вместо записи."""
+
+    def write(self, value):
+        return value
+
+
+class ShoppingCartRenderer(BaseRenderer):
+    """
+    Базовый рендерер списка покупок.
+
+    Элементы списка - словари с ключами name, measurment_unit и amount.
+    stream() отдает байты построчно и используется для
+    StreamingHttpResponse, render() - для обычных ответов и ошибок.
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict):
+            return str(data.get('detail', data)).encode('utf-8')
+        return b''.join(self.stream(data))
+
+    def stream(self, items):
+        raise NotImplementedError
+
+    def line(self, item):
+        return f'{item["name"]} - {item["amount"]} {item["measurment_unit"]}'
+
+
+class TextShoppingCartRenderer(ShoppingCartRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+    def stream(self, items):
+        for item in items:
+            yield f'{self.line(item)}\n'.encode(self.charset)
+
+
+class CSVShoppingCartRenderer(ShoppingCartRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+    def stream(self, items):
+        writer = csv.writer(Echo())
+        yield writer.writerow(
+            ('Ингредиент', 'Количество', 'Единица измерения')
+        ).encode(self.charset)
+        for item in items:
+            yield writer.writerow(
+                (item['name'], item['amount'], item['measurment_unit'])
+            ).encode(self.charset)
+
+
+class JSONShoppingCartRenderer(ShoppingCartRenderer):
+    media_type = 'application/json'
+    format = 'json'
+
+    def stream(self, items):
+        separator = b'['
+        for item in items:
+            yield separator + json.dumps(
+                item, ensure_ascii=False).encode(self.charset)
+            separator = b','
+        yield b'[]' if separator == b'[' else b']'
+
+
+def cyrillic_glyph(char):
+    """Имя глифа Adobe (afii) для кириллической буквы."""
+    code = ord(char)
+    if char in 'Ёё':
+        return 'afii10023' if char == 'Ё' else 'afii10071'
+    if 'А' <= char <= 'Я':
+        return f'afii{10017 + code - ord("А") + (code >= ord("Ж"))}'
+    return f'afii{10065 + code - ord("а") + (code >= ord("ж"))}'
+
+
+class PDFWriter:
+    """
+    Минимальный потоковый PDF-писатель без сторонних зависимостей.
+
+    Объекты выдаются по мере готовности страниц, смещения для xref
+    считаются по уже отданным байтам, поэтому в памяти хранится только
+    текущая страница. Кириллица выводится стандартным шрифтом Helvetica
+    в кодировке cp1251 через таблицу Differences.
+    """
+    PAGES_ID = 1
+    CATALOG_ID = 2
+    FONT_ID = 3
+
+    def __init__(self):
+        self.position = 0
+        self.offsets = {}
+        self.kids = []
+        self.next_id = self.FONT_ID + 1
+
+    def chunk(self, data):
+        self.position += len(data)
+        return data
+
+    def object(self, number, body):
+        self.offsets[number] = self.position
+        return self.chunk(
+            f'{number} 0 obj\n'.encode('latin-1') + body + b'\nendobj\n'
+        )
+
+    def header(self):
+        return self.chunk(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def font(self):
+        differences = ' '.join(
+            f'{byte} /{cyrillic_glyph(bytes([byte]).decode("cp1251"))}'
+            for byte in (0xA8, 0xB8, *range(0xC0, 0x100))
+        )
+        return self.object(self.FONT_ID, (
+            '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica '
+            '/Encoding << /Type /Encoding /BaseEncoding /WinAnsiEncoding '
+            f'/Differences [{differences}] >> >>'
+        ).encode('latin-1'))
+
+    @staticmethod
+    def escape(text):
+        text = text.encode('cp1251', errors='replace')
+        return (text.replace(b'\\', b'\\\\')
+                .replace(b'(', b'\\(').replace(b')', b'\\)'))
+
+    def page(self, lines):
+        content = b''.join(
+            b'(' + self.escape(line) + b') Tj T*\n' for line in lines
+        )
+        content = (
+            f'BT /F1 {PDF_FONT_SIZE} Tf {PDF_LEADING} TL '
+            f'{PDF_MARGIN} {PDF_PAGE_HEIGHT - PDF_MARGIN} Td\n'
+        ).encode('latin-1') + content + b'ET'
+        content_id, page_id = self.next_id, self.next_id + 1
+        self.next_id += 2
+        self.kids.append(page_id)
+        return self.object(
+            content_id,
+            f'<< /Length {len(content)} >>\nstream\n'.encode('latin-1')
+            + content + b'\nendstream'
+        ) + self.object(page_id, (
+            f'<< /Type /Page /Parent {self.PAGES_ID} 0 R '
+            f'/MediaBox [0 0 {PDF_PAGE_WIDTH} {PDF_PAGE_HEIGHT}] '
+            f'/Resources << /Font << /F1 {self.FONT_ID} 0 R >> >> '
+            f'/Contents {content_id} 0 R >>'
+        ).encode('latin-1'))
+
+    def trailer(self):
+        kids = ' '.join(f'{kid} 0 R' for kid in self.kids)
+        data = self.object(self.PAGES_ID, (
+            f'<< /Type /Pages /Kids [{kids}] /Count {len(self.kids)} >>'
+        ).encode('latin-1')) + self.object(self.CATALOG_ID, (
+            f'<< /Type /Catalog /Pages {self.PAGES_ID} 0 R >>'
+        ).encode('latin-1'))
+        xref_position = self.position
+        size = self.next_id
+        xref = [f'xref\n0 {size}\n0000000000 65535 f \n']
+        xref.extend(
+            f'{self.offsets[number]:010d} 00000 n \n'
+            for number in range(1, size)
+        )
+        xref.append(
+            f'trailer\n<< /Size {size} /Root {self.CATALOG_ID} 0 R >>\n'
+            f'startxref\n{xref_position}\n%%EOF\n'
+        )
+        return data + self.chunk(''.join(xref).encode('latin-1'))
+
+
+class PDFShoppingCartRenderer(ShoppingCartRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
+    render_style = 'binary'
+
+    def stream(self, items):
+        writer = PDFWriter()
+        yield writer.header()
+        yield writer.font()
+        lines = []
+        for item in items:
+            lines.append(self.line(item))
+            if len(lines) == PDF_LINES_PER_PAGE:
+                yield writer.page(lines)
+                lines = []
+        if lines or not writer.kids:
+            yield writer.page(lines)
+        yield writer.trailer()
+
+
+SHOPPING_CART_RENDERERS = (
+    TextShoppingCartRenderer,
+    CSVShoppingCartRenderer,
+    JSONShoppingCartRenderer,
+    PDFShoppingCartRenderer,
+)
@@ -1,17 +1,35 @@
-import base64
+import binascii
 
-from django.core.files.base import ContentFile
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from djoser.serializers import UserCreateSerializer, UserSerializer
+from PIL import UnidentifiedImageError
 from rest_framework import serializers
 
+from .cache import schedule_bump
+from .counters import change_counter
+from .images import (ImageTooLarge, rendition_urls, schedule_renditions,
+                     store_base64_image)
+from .recipe_index import recipe_index
 from recipes.models import (Favorite, Ingredient, IngredientInRecipe, Recipe,
-                            ShoppingCart, Tag)
+                            ShoppingCart, ShoppingListItem, Tag)
 from users.models import User
 
 MAX_VALUE = 32767
 MIN_VALUE = 1
+MAX_BATCH_SIZE = 100
+
+
+def create_unique(model, message, **fields):
+    """
+    Вставляет строку без предварительного exists(): дубликат отсекает
+    уникальное ограничение, и ошибка превращается в ValidationError.
+    """
+    try:
+        with transaction.atomic():
+            return model.objects.create(**fields)
+    except IntegrityError:
+        raise serializers.ValidationError(message)
 
 
 class CustomUserSerializer(UserSerializer):
@@ -29,6 +47,8 @@ class CustomUserSerializer(UserSerializer):
         )
 
     def get_is_subscribed(self, data):
+        if hasattr(data, 'is_subscribed'):
+            return data.is_subscribed
         user = self.context.get('request').user
         return (user.is_authenticated and user.subscriber.filter(
             author=data).exists())
@@ -51,25 +71,49 @@ class SubscriptionSerializer(CustomUserSerializer):
             'recipes_count'
         )
 
-    def get_is_subscribed(self, data):
-        user = self.context.get('request').user
-        return (user.is_authenticated and user.subscriber.filter(
-            author=data).exists())
-
     def get_recipes_count(self, data):
-        return data.recipes.count()
+        return data.recipes_count
 
     def get_recipes(self, data):
-        request = self.context.get('request')
-        count_limit = request.GET.get('recipes_limit')
-        recipe_obj = data.recipes.all()
-        if count_limit:
-            recipe_obj = recipe_obj[:int(count_limit)]
+        if hasattr(data, 'limited_recipes'):
+            recipe_obj = data.limited_recipes
+        else:
+            count_limit = self.context.get('recipes_limit')
+            recipe_obj = data.recipes.all()
+            if count_limit is not None:
+                recipe_obj = recipe_obj[:count_limit]
         return ShortRecipeShowSerializer(
             recipe_obj, many=True
         ).data
 
 
+class RecipesLimitSerializer(serializers.Serializer):
+    recipes_limit = serializers.IntegerField(min_value=0, required=False)
+
+
+class IngredientIdsSerializer(serializers.Serializer):
+    ids = serializers.CharField()
+
+    def validate_ids(self, value):
+        try:
+            return [int(item) for item in value.split(',') if item.strip()]
+        except ValueError:
+            raise serializers.ValidationError(
+                'Укажите id ингредиентов через запятую'
+            )
+
+
+class RecipeIdsSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=MAX_BATCH_SIZE
+    )
+
+    def validate_ids(self, value):
+        return list(dict.fromkeys(value))
+
+
 class CustomUserCreateSerializer(UserCreateSerializer):
     class Meta:
         model = User
@@ -92,9 +136,14 @@ class Base64ImageField(serializers.ImageField):
     def to_internal_value(self, data):
         if isinstance(data, str) and data.startswith('data:image'):
             format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
-
-            data = ContentFile(base64.b64decode(imgstr), name='temp.' + ext)
+            try:
+                return store_base64_image(imgstr)
+            except ImageTooLarge:
+                raise serializers.ValidationError(
+                    'Изображение слишком большое'
+                )
+            except (binascii.Error, UnidentifiedImageError, SyntaxError):
+                self.fail('invalid_image')
 
         return super().to_internal_value(data)
 
@@ -113,10 +162,14 @@ class TagSerializer(serializers.ModelSerializer):
 
 class ShortRecipeShowSerializer(serializers.ModelSerializer):
     image = Base64ImageField()
+    images = serializers.SerializerMethodField()
 
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'images', 'cooking_time')
+
+    def get_images(self, obj):
+        return rendition_urls(obj)
 
 
 class AddIngredientSerializer(serializers.ModelSerializer):
@@ -203,61 +256,141 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
             instance,
             context={'request': self.context.get('request')}).data
 
+    @transaction.atomic
     def add_to_favorites(self, user, recipe):
-        if Favorite.objects.filter(recipe=recipe, user=user).exists():
-            raise serializers.ValidationError(
-                'Рецепт уже в избранном'
-            )
-        Favorite.objects.create(recipe=recipe, user=user)
+        create_unique(
+            Favorite, 'Рецепт уже в избранном', recipe=recipe, user=user
+        )
+        change_counter(Recipe, [recipe.pk], 'favorites_count', 1)
 
+    @transaction.atomic
     def add_to_shopping_cart(self, user, recipe):
-        if ShoppingCart.objects.filter(recipe=recipe, user=user).exists():
-            raise serializers.ValidationError(
-                'Рецепт уже в корзине'
-            )
-        ShoppingCart.objects.create(recipe=recipe, user=user)
+        create_unique(
+            ShoppingCart, 'Рецепт уже в корзине', recipe=recipe, user=user
+        )
+        change_counter(Recipe, [recipe.pk], 'in_carts_count', 1)
+        ShoppingListItem.objects.add_recipe(user, recipe)
+
+    def insert_ingredients(self, rows):
+        IngredientInRecipe.objects.bulk_create(rows)
+        recipe_index.schedule(recipe_index.add, [
+            (row.ingredient_id, row.recipe_id) for row in rows
+        ])
 
     def ingredients_create(self, recipe, ingredients):
-        ingredient_list = []
-        for ingredient in ingredients:
-            ingredient_list.append(
-                IngredientInRecipe(
-                    recipe=recipe,
-                    ingredient=ingredient.get('id'),
-                    amount=ingredient.get('amount')
-                )
+        self.insert_ingredients([
+            IngredientInRecipe(
+                recipe=recipe,
+                ingredient=ingredient.get('id'),
+                amount=ingredient.get('amount')
+            )
+            for ingredient in ingredients
+        ])
+        Recipe.objects.update_search_vector([recipe.pk])
+
+    def ingredients_update(self, recipe, ingredients):
+        """
+        Сравнивает присланные ингредиенты с текущими строками и меняет
+        только разницу: новые вставляются, исчезнувшие удаляются,
+        у остальных обновляется количество. id строк сохраняются.
+
+        Возвращает True, если состав рецепта изменился.
+        """
+        current = {
+            row.ingredient_id: row for row in recipe.recipe_ingredient.all()
+        }
+        submitted = {
+            ingredient['id'].id: ingredient['amount']
+            for ingredient in ingredients
+        }
+        removed = [
+            row for ingredient_id, row in current.items()
+            if ingredient_id not in submitted
+        ]
+        added = [
+            IngredientInRecipe(
+                recipe=recipe, ingredient_id=ingredient_id, amount=amount
+            )
+            for ingredient_id, amount in submitted.items()
+            if ingredient_id not in current
+        ]
+        amounts = {row.ingredient_id: -row.amount for row in removed}
+        amounts.update(
+            (row.ingredient_id, row.amount) for row in added
+        )
+        changed = []
+        for ingredient_id, row in current.items():
+            amount = submitted.get(ingredient_id, row.amount)
+            if amount != row.amount:
+                amounts[ingredient_id] = amount - row.amount
+                row.amount = amount
+                changed.append(row)
+        if amounts:
+            ShoppingListItem.objects.apply(
+                list(recipe.shopping_cart.values_list('user_id', flat=True)),
+                amounts
             )
-        IngredientInRecipe.objects.bulk_create(ingredient_list)
+        if removed:
+            IngredientInRecipe.objects.filter(
+                pk__in=[row.pk for row in removed]
+            ).delete()
+        if changed:
+            IngredientInRecipe.objects.bulk_update(changed, ('amount',))
+        if added:
+            self.insert_ingredients(added)
+        return bool(removed or added)
 
     def create(self, validated_data):
         name = validated_data.get('name')
         ingredients = validated_data.pop('ingredients')
         tags = validated_data.pop('tags')
         author = self.context.get('request').user
-        if Recipe.objects.filter(name=name, author=author).exists():
-            raise serializers.ValidationError(
-                f'Такой рецепт уже существует {name} {author}'
-            )
         with transaction.atomic():
-            recipes = Recipe.objects.create(**validated_data)
+            recipes = create_unique(
+                Recipe,
+                f'Такой рецепт уже существует {name} {author}',
+                **validated_data
+            )
+            change_counter(User, [recipes.author_id], 'recipes_count', 1)
             self.ingredients_create(recipes, ingredients)
             recipes.tags.set(tags)
+            schedule_renditions(recipes.image)
         return recipes
 
     @transaction.atomic
     def update(self, instance, validated_data):
-        ingredients = validated_data.pop('ingredients')
-        tags = validated_data.pop('tags')
-        instance.image = validated_data.get('image', instance.image)
-        instance.name = validated_data.get('name', instance.name)
-        instance.text = validated_data.get('text', instance.text)
-        instance.cooking_time = validated_data['cooking_time']
-        IngredientInRecipe.objects.filter(recipe=instance).delete()
-        instance.tags.clear()
-        instance.ingredients.clear()
-        instance.tags.set(tags)
-        self.ingredients_create(instance, ingredients)
-        super().update(instance, validated_data)
+        ingredients_changed = self.ingredients_update(
+            instance, validated_data.pop('ingredients')
+        )
+        instance.tags.set(validated_data.pop('tags'))
+        image = validated_data.get('image')
+        if isinstance(image, str) and image == instance.image.name:
+            # Та же картинка: файл уже сохранен, превью готовы.
+            del validated_data['image']
+        fields = [
+            field for field, value in validated_data.items()
+            if getattr(instance, field) != value
+        ]
+        for field in fields:
+            setattr(instance, field, validated_data[field])
+        if 'image' in fields:
+            instance.renditions_ready = False
+            fields.append('renditions_ready')
+        if fields:
+            try:
+                with transaction.atomic():
+                    instance.save(update_fields=fields)
+            except IntegrityError:
+                raise serializers.ValidationError(
+                    f'Такой рецепт уже существует {instance.name} '
+                    f'{instance.author}'
+                )
+        if ingredients_changed or {'name', 'text'} & set(fields):
+            Recipe.objects.update_search_vector([instance.pk])
+        if 'image' in fields:
+            schedule_renditions(instance.image)
+        # Состав меняется bulk-операциями без сигналов.
+        schedule_bump(Recipe, instance.pk)
         return instance
 
 
@@ -269,6 +402,7 @@ class RecipeShowSerializer(serializers.ModelSerializer):
     )
     image = serializers.ReadOnlyField(
         source='image.url')
+    images = serializers.SerializerMethodField()
     tags = TagSerializer(
         many=True,
         read_only=True
@@ -286,18 +420,31 @@ class RecipeShowSerializer(serializers.ModelSerializer):
             'ingredients',
             'name',
             'image',
+            'images',
             'text',
             'cooking_time',
             'is_favorited',
             'is_in_shopping_cart'
         )
 
+    def to_representation(self, instance):
+        if hasattr(instance, 'author_is_subscribed'):
+            instance.author.is_subscribed = instance.author_is_subscribed
+        return super().to_representation(instance)
+
+    def get_images(self, obj):
+        return rendition_urls(obj)
+
     def get_is_favorited(self, obj):
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         user = self.context['request'].user
         return (user.is_authenticated and Favorite.objects.filter(
             recipe=obj, user=user).exists())
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         user = self.context['request'].user
         return (user.is_authenticated and ShoppingCart.objects.filter(
             recipe=obj, user=user).exists())
@@ -0,0 +1,106 @@
+from django.db import transaction
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_save)
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import SNAPSHOT_FIELDS, invalidate_token
+from .cache import bump_version, schedule_bump
+from .recipe_index import recipe_index
+from recipes.models import Ingredient, IngredientInRecipe, Recipe, Tag
+from users.models import User
+
+# Поля пользователя, которые не попадают в карточку рецепта.
+PRIVATE_USER_FIELDS = frozenset(('last_login', 'password'))
+# Изменение этих полей сбрасывает кэш токенов пользователя.
+TOKEN_USER_FIELDS = SNAPSHOT_FIELDS | {'password'}
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+@receiver((post_save, post_delete), sender=Tag)
+def bump_catalog_version(sender, **kwargs):
+    bump_version(sender)
+
+
+@receiver((post_save, post_delete), sender=Recipe)
+def invalidate_recipe(sender, instance, **kwargs):
+    schedule_bump(Recipe, instance.pk)
+
+
+@receiver(pre_save, sender=IngredientInRecipe)
+def remember_ingredient_in_recipe(sender, instance, **kwargs):
+    instance.previous = None
+    if instance.pk is not None:
+        instance.previous = IngredientInRecipe.objects.filter(
+            pk=instance.pk
+        ).values_list('ingredient_id', 'recipe_id').first()
+
+
+@receiver(post_save, sender=IngredientInRecipe)
+def update_ingredient_in_recipe(sender, instance, **kwargs):
+    """
+    Строки, сохраненные по одной. bulk_create и bulk_update сигналов не
+    отправляют, там индекс и поколение обновляет вызывающий код.
+    """
+    pair = (instance.ingredient_id, instance.recipe_id)
+    if instance.previous not in (None, pair):
+        recipe_index.schedule(recipe_index.remove, [instance.previous])
+        schedule_bump(Recipe, instance.previous[1])
+    recipe_index.schedule(recipe_index.add, [pair])
+    schedule_bump(Recipe, instance.recipe_id)
+
+
+@receiver(post_delete, sender=IngredientInRecipe)
+def remove_ingredient_in_recipe(sender, instance, **kwargs):
+    recipe_index.schedule(
+        recipe_index.remove, [(instance.ingredient_id, instance.recipe_id)]
+    )
+    schedule_bump(Recipe, instance.recipe_id)
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def invalidate_recipe_tags(sender, instance, action, reverse, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        schedule_bump(Tag)
+    else:
+        schedule_bump(Recipe, instance.pk)
+
+
+@receiver(post_save, sender=User)
+def invalidate_author_recipes(sender, instance, created, update_fields,
+                              **kwargs):
+    """Карточки рецептов автора сверяют его поколение при чтении."""
+    if created or (
+        update_fields is not None and update_fields <= PRIVATE_USER_FIELDS
+    ):
+        return
+    schedule_bump(User, instance.pk)
+
+
+def forget_token(key):
+    """
+    Сбрасывает токен сразу и еще раз после фиксации транзакции, чтобы
+    параллельный запрос не закэшировал пользователя до изменения.
+    """
+    invalidate_token(key)
+    transaction.on_commit(lambda: invalidate_token(key))
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    forget_token(instance.key)
+
+
+@receiver(post_save, sender=User)
+def forget_user_tokens(sender, instance, created, update_fields, **kwargs):
+    if created or (
+        update_fields is not None
+        and TOKEN_USER_FIELDS.isdisjoint(update_fields)
+    ):
+        return
+    for key in Token.objects.filter(user=instance).values_list(
+        'key', flat=True
+    ):
+        forget_token(key)
@@ -0,0 +1,1498 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from array import array
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.postgres.search import SearchQuery
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, OperationalError, connection, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.test import (AsyncRequestFactory, SimpleTestCase, TestCase,
+                         TransactionTestCase)
+from django.test.utils import CaptureQueriesContext, override_settings
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory
+
+from api import async_views, filters
+from api.async_views import gather
+from api.authentication import CachedTokenAuthentication, local_cache
+from api.autocomplete import IngredientIndex
+from api.cache import bump_version
+from api.counters import change_counter
+from api.fast_serializers import recipe_rows, serialize_recipes
+from api.images import make_renditions, mark_renditions_ready, rendition_name
+from api.management.commands.check_query_plans import hot_queries, seq_scans
+from api.recipe_index import IngredientRecipeIndex, recipe_index
+from api.serializers import RecipeCreateUpdateSerializer, RecipeShowSerializer
+from api.views import RecipeViewSet, annotate_user_flags
+from foodgram import metrics, replicas
+from recipes.models import (SEARCH_CONFIG, Favorite, Ingredient,
+                            IngredientInRecipe, Recipe, ShoppingCart,
+                            ShoppingListItem, Tag)
+from users.models import Subscription, User
+
+
+def create_user(username):
+    return User.objects.create(
+        username=username,
+        email=f'{username}@example.com',
+        first_name=username,
+        last_name=username,
+        password='password'
+    )
+
+
+def create_recipe(author, name, tags=(), ingredients=()):
+    recipe = Recipe.objects.create(
+        author=author,
+        name=name,
+        text=f'Описание {name}',
+        cooking_time=10,
+        image=f'recipes/{name}.png'
+    )
+    recipe.tags.set(tags)
+    IngredientInRecipe.objects.bulk_create(
+        IngredientInRecipe(recipe=recipe, ingredient=ingredient, amount=2)
+        for ingredient in ingredients
+    )
+    Recipe.objects.update_search_vector([recipe.pk])
+    return recipe
+
+
+def client_for(user):
+    client = APIClient()
+    client.credentials(
+        HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=user).key}'
+    )
+    return client
+
+
+class APITestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('user')
+        cls.author = create_user('author')
+        cls.tags = [
+            Tag.objects.create(name=name, color=color, slug=name)
+            for name, color in (('breakfast', '#E26C2D'), ('lunch', '#49B64E'))
+        ]
+        cls.ingredients = [
+            Ingredient.objects.create(name=name, measurment_unit='г')
+            for name in ('мука', 'молоко', 'сахар')
+        ]
+
+    def setUp(self):
+        cache.clear()
+
+
+class SubscribeTest(APITestCase):
+
+    def test_invalid_recipes_limit_does_not_subscribe(self):
+        response = client_for(self.user).post(
+            f'/api/users/{self.author.pk}/subscribe/?recipes_limit=x'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Subscription.objects.exists())
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.followers_count, 0)
+
+
+class CatalogCacheTest(APITestCase):
+    """Справочники отдаются из кэша с ETag, изменения видны сразу."""
+
+    def test_cached_list(self):
+        response = self.client.get('/api/tags/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [tag['slug'] for tag in json.loads(response.content)],
+            ['breakfast', 'lunch']
+        )
+        with self.assertNumQueries(0):
+            cached = self.client.get('/api/tags/')
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['ETag'], response['ETag'])
+        self.assertIn('Last-Modified', cached)
+
+    def test_not_modified(self):
+        etag = self.client.get('/api/ingredients/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                '/api/ingredients/', HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_invalidation(self):
+        etag = self.client.get('/api/tags/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.filter(slug='lunch').first().delete()
+        response = self.client.get('/api/tags/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(
+            [tag['slug'] for tag in json.loads(response.content)],
+            ['breakfast']
+        )
+
+    def test_detail(self):
+        url = f'/api/ingredients/{self.ingredients[0].pk}/'
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content)['name'], 'мука')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).content, response.content)
+        for _ in range(2):
+            # Ответ 404 не кэшируется.
+            with self.assertNumQueries(1):
+                response = self.client.get('/api/ingredients/0/')
+            self.assertEqual(response.status_code, 404)
+
+
+class IngredientIndexTest(APITestCase):
+    """Префиксный поиск ингредиентов в памяти процесса."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for name in ('Мёд', 'медовик', 'кокосовое молоко'):
+            Ingredient.objects.create(name=name, measurment_unit='г')
+
+    def setUp(self):
+        super().setUp()
+        self.index = IngredientIndex()
+
+    def names(self, query, contains=False):
+        return [item['name'] for item in self.index.search(query, contains)]
+
+    def test_prefix(self):
+        self.assertEqual(self.names('МОЛ'), ['молоко'])
+        self.assertEqual(self.names('мед'), ['Мёд', 'медовик'])
+        self.assertEqual(self.names(' мё '), ['Мёд', 'медовик'])
+        self.assertEqual(
+            self.names('м'), ['Мёд', 'медовик', 'молоко', 'мука']
+        )
+        self.assertEqual(self.names('х'), [])
+
+    def test_contains(self):
+        self.assertEqual(
+            self.names('молоко', contains=True),
+            ['молоко', 'кокосовое молоко']
+        )
+
+    def test_built_once(self):
+        with self.assertNumQueries(1):
+            self.index.search('м')
+        with self.assertNumQueries(0):
+            self.index.search('с')
+
+    def test_rebuilt_after_change(self):
+        self.index.search('м')
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingredient.objects.create(name='манка', measurment_unit='г')
+        self.assertEqual(self.names('ман'), ['манка'])
+
+    def test_api(self):
+        response = self.client.get('/api/ingredients/', {'name': 'Мол'})
+        self.assertEqual(json.loads(response.content), [{
+            'id': self.ingredients[1].pk,
+            'name': 'молоко',
+            'measurment_unit': 'г',
+        }])
+        response = self.client.get(
+            '/api/ingredients/', {'name': 'молоко', 'contains': 'true'}
+        )
+        self.assertEqual(
+            [item['name'] for item in json.loads(response.content)],
+            ['молоко', 'кокосовое молоко']
+        )
+
+
+class LoadIngredientsTest(APITestCase):
+    """Импорт справочника повторяем и не создает дубликатов."""
+
+    ROWS = [
+        ('мука', 'г'),
+        ('соль', 'г'),
+        ('соль', 'г'),
+        ('соль', 'по вкусу'),
+        ('яйца', 'шт.'),
+    ]
+
+    def write(self, suffix, content):
+        with tempfile.NamedTemporaryFile(
+            'w', suffix=suffix, encoding='utf-8', delete=False
+        ) as file:
+            file.write(content)
+        self.addCleanup(os.remove, file.name)
+        return file.name
+
+    def load(self, path, *args):
+        out = StringIO()
+        call_command('load_ingredients', '--path', path, *args, stdout=out)
+        return out.getvalue().strip().splitlines()[-1]
+
+    def names(self):
+        return sorted(Ingredient.objects.values_list(
+            'name', 'measurment_unit'
+        ))
+
+    def test_csv(self):
+        path = self.write('.csv', ''.join(
+            f'{name},{unit}\n' for name, unit in self.ROWS
+        ))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                self.load(path, '--batch-size', '2'),
+                'Добавлено: 3, пропущено: 2'
+            )
+        # Одна вставка на файл и одна загрузка на пачку, а не на строку.
+        self.assertEqual(
+            sum('INSERT' in query['sql'] for query in queries), 1
+        )
+        self.assertEqual(
+            sum('COPY' in query['sql'] for query in queries), 3
+        )
+        self.assertEqual(self.names(), [
+            ('молоко', 'г'), ('мука', 'г'), ('сахар', 'г'),
+            ('соль', 'г'), ('соль', 'по вкусу'), ('яйца', 'шт.'),
+        ])
+        self.assertEqual(self.load(path), 'Добавлено: 0, пропущено: 5')
+        self.assertEqual(len(self.names()), 6)
+
+    def test_json(self):
+        path = self.write('.json', json.dumps([
+            {'name': name, 'measurement_unit': unit}
+            for name, unit in self.ROWS
+        ], ensure_ascii=False))
+        # Объекты пересекают границы прочитанных кусков файла.
+        with mock.patch(
+            'recipes.management.commands.load_ingredients.READ_SIZE', 7
+        ):
+            self.assertEqual(self.load(path), 'Добавлено: 3, пропущено: 2')
+        self.assertIn(('соль', 'по вкусу'), self.names())
+
+    def test_dry_run(self):
+        path = self.write('.csv', 'соль,г\nмука,г\n')
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.load(path, '--dry-run'),
+                'Будет добавлено: 1, пропущено: 1'
+            )
+        self.assertEqual(Ingredient.objects.count(), 3)
+
+    def test_invalid_json(self):
+        path = self.write('.json', '[{"name": "соль", ')
+        with self.assertRaises(CommandError):
+            self.load(path)
+        self.assertEqual(Ingredient.objects.count(), 3)
+
+    def test_invalidates_catalog(self):
+        etag = self.client.get('/api/ingredients/')['ETag']
+        self.load(self.write('.csv', 'соль,г\n'))
+        response = self.client.get('/api/ingredients/?name=со')
+        self.assertEqual(
+            [item['name'] for item in json.loads(response.content)],
+            ['соль']
+        )
+        self.assertNotEqual(
+            self.client.get('/api/ingredients/')['ETag'], etag
+        )
+
+
+class RecipeListQueriesTest(APITestCase):
+    """Число запросов списка рецептов не зависит от размера страницы."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for number in range(6):
+            create_recipe(
+                cls.author, f'recipe{number}', cls.tags, cls.ingredients
+            )
+
+    def assert_list_queries(self, client, expected):
+        with self.assertNumQueries(expected):
+            response = client.get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 6)
+
+    def test_anonymous(self):
+        client = APIClient()
+        # Биты тегов для фильтра, COUNT, id страницы, рецепты с тегами и
+        # ингредиентами.
+        self.assert_list_queries(client, 4)
+        # Биты тегов берутся из кэша.
+        self.assert_list_queries(client, 3)
+
+    def test_authenticated(self):
+        client = client_for(self.user)
+        # Еще токен с пользователем; флаги пользователя - подзапросы.
+        self.assert_list_queries(client, 5)
+        # Токен и биты тегов берутся из кэша.
+        self.assert_list_queries(client, 3)
+
+    def add_flags(self):
+        recipes = list(Recipe.objects.order_by('id'))
+        Favorite.objects.create(user=self.user, recipe=recipes[0])
+        ShoppingCart.objects.create(user=self.user, recipe=recipes[1])
+        Subscription.objects.create(subscriber=self.user, author=self.author)
+        return recipes
+
+    def test_authenticated_flags(self):
+        """Флаги - подзапросы EXISTS в запросе страницы."""
+        recipes = self.add_flags()
+        client = client_for(self.user)
+        client.get('/api/recipes/')
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/recipes/')
+        self.assertEqual(len(queries), 3)
+        page_sql = next(
+            query['sql'] for query in queries
+            if 'recipes_favorite' in query['sql']
+        )
+        self.assertEqual(page_sql.count('EXISTS'), 3)
+        flags = {
+            item['id']: (
+                item['is_favorited'],
+                item['is_in_shopping_cart'],
+                item['author']['is_subscribed']
+            )
+            for item in response.data['results']
+        }
+        self.assertEqual(flags[recipes[0].pk], (True, False, True))
+        self.assertEqual(flags[recipes[1].pk], (False, True, True))
+        self.assertEqual(flags[recipes[2].pk], (False, False, True))
+
+    def test_authenticated_detail(self):
+        recipe = self.add_flags()[0]
+        client = client_for(self.user)
+        url = f'/api/recipes/{recipe.pk}/'
+        client.get(url)
+        # Карточка и токен из кэша, флаги - один запрос.
+        with self.assertNumQueries(1):
+            response = client.get(url)
+        self.assertTrue(response.data['is_favorited'])
+        self.assertFalse(response.data['is_in_shopping_cart'])
+        self.assertTrue(response.data['author']['is_subscribed'])
+
+    def test_serializer_fallback(self):
+        """Без fast_read список собирает RecipeShowSerializer."""
+        self.add_flags()
+        client = client_for(self.user)
+        fast = client.get('/api/recipes/')
+        fast_read = mock.patch.object(RecipeViewSet, 'fast_read', False)
+        serialize = mock.patch(
+            'api.views.serialize_recipes', side_effect=AssertionError
+        )
+        with fast_read, serialize:
+            # COUNT, рецепты с автором и флагами, prefetch тегов и
+            # ингредиентов.
+            self.assert_list_queries(client, 4)
+            response = client.get('/api/recipes/')
+        self.assertEqual(
+            JSONRenderer().render(response.data),
+            JSONRenderer().render(fast.data)
+        )
+
+
+class CursorPaginationTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for number in range(3):
+            create_recipe(cls.author, f'recipe{number}')
+
+    def test_rejected_with_search_and_ordering(self):
+        for query in ('search=recipe', 'ordering=-favorites_count'):
+            with self.subTest(query=query):
+                response = self.client.get(f'/api/recipes/?cursor=&{query}')
+                self.assertEqual(response.status_code, 400)
+
+    def test_recipes_by_id(self):
+        response = self.client.get('/api/recipes/?cursor=&limit=2')
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            list(Recipe.objects.order_by('-id').values_list(
+                'pk', flat=True
+            )[:2])
+        )
+
+    def test_subscriptions_keep_username_order(self):
+        authors = [create_user(name) for name in ('carol', 'alice', 'bob')]
+        Subscription.objects.bulk_create(
+            Subscription(subscriber=self.user, author=author)
+            for author in authors
+        )
+        client = client_for(self.user)
+        url = '/api/users/subscriptions/?cursor=&limit=2'
+        usernames = []
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            usernames += [user['username'] for user in response.data[
+                'results'
+            ]]
+            url = response.data['next']
+        self.assertEqual(usernames, ['alice', 'bob', 'carol'])
+
+
+class SearchVectorTest(APITestCase):
+    """Поисковый вектор пересчитывается один раз на рецепт, а не на строку."""
+
+    def vector_updates(self, queries):
+        return [
+            query for query in queries
+            if query['sql'].startswith('UPDATE "recipes_recipe" SET '
+                                       '"search_vector"')
+        ]
+
+    def search(self, text):
+        return [
+            recipe['id'] for recipe in
+            self.client.get(f'/api/recipes/?search={text}').data['results']
+        ]
+
+    def test_update_ingredients(self):
+        flour, milk, sugar = self.ingredients
+        recipe = create_recipe(
+            self.author, 'блины', self.tags, [flour, milk]
+        )
+        serializer = RecipeCreateUpdateSerializer(
+            context={'request': None}
+        )
+        with CaptureQueriesContext(connection) as queries:
+            serializer.update(recipe, {
+                'ingredients': [{'id': flour, 'amount': 1},
+                                {'id': sugar, 'amount': 1}],
+                'tags': self.tags,
+            })
+        self.assertEqual(len(self.vector_updates(queries)), 1)
+        self.assertEqual(self.search('сахар'), [recipe.pk])
+        self.assertEqual(self.search('молоко'), [])
+
+    def test_rename_ingredient(self):
+        flour, milk, sugar = self.ingredients
+        recipe = create_recipe(self.author, 'блины', self.tags, [milk])
+        create_recipe(self.author, 'оладьи', self.tags, [flour])
+        milk.name = 'кефир'
+        with CaptureQueriesContext(connection) as queries:
+            milk.save()
+        self.assertEqual(len(self.vector_updates(queries)), 1)
+        self.assertEqual(self.search('кефир'), [recipe.pk])
+        self.assertEqual(self.search('молоко'), [])
+
+    def test_delete_recipe(self):
+        recipe = create_recipe(
+            self.author, 'блины', self.tags, self.ingredients
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = client_for(self.author).delete(
+                f'/api/recipes/{recipe.pk}/'
+            )
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.vector_updates(queries), [])
+
+
+class RecipeDetailCacheTest(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.recipe = create_recipe(
+            self.author, 'recipe', self.tags, self.ingredients
+        )
+        self.url = f'/api/recipes/{self.recipe.pk}/'
+
+    def test_cached_before_renditions_are_ready(self):
+        self.assertFalse(self.recipe.renditions_ready)
+        self.client.get(self.url)
+        # Из базы читаются только флаги пользователя.
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['name'], 'recipe')
+
+    def test_ingredient_row_saved_directly(self):
+        self.client.get(self.url)
+        row = self.recipe.recipe_ingredient.first()
+        row.amount = 77
+        with self.captureOnCommitCallbacks(execute=True):
+            row.save()
+        amounts = {
+            ingredient['id']: ingredient['amount']
+            for ingredient in self.client.get(self.url).data['ingredients']
+        }
+        self.assertEqual(amounts[row.ingredient_id], 77)
+
+    def test_ingredient_row_deleted_directly(self):
+        index = IngredientRecipeIndex()
+        index.rebuild()
+        self.client.get(self.url)
+        row = self.recipe.recipe_ingredient.first()
+        with mock.patch('api.signals.recipe_index', index), \
+                self.captureOnCommitCallbacks(execute=True):
+            row.delete()
+        ingredients = self.client.get(self.url).data['ingredients']
+        self.assertNotIn(
+            row.ingredient_id, [ingredient['id'] for ingredient in ingredients]
+        )
+        self.assertNotIn(self.recipe.pk, index.postings[row.ingredient_id])
+
+    def test_author_profile_change(self):
+        for number in range(5):
+            create_recipe(self.author, f'other{number}')
+        self.client.get(self.url)
+        with mock.patch(
+            'api.cache.bump_version', wraps=bump_version
+        ) as bump, self.captureOnCommitCallbacks(execute=True):
+            self.author.first_name = 'Новое'
+            self.author.save()
+        bump.assert_called_once_with(User, self.author.pk)
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['author']['first_name'], 'Новое')
+
+
+class CachedTokenAuthenticationTest(APITestCase):
+    """Токен разрешается без запроса к authtoken_token, пока он в кэше."""
+
+    def setUp(self):
+        super().setUp()
+        local_cache.entries.clear()
+        self.addCleanup(local_cache.entries.clear)
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    def get_me(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/users/me/')
+        self.token_queries = [
+            query for query in queries
+            if 'authtoken_token' in query['sql']
+        ]
+        return response
+
+    def test_cached_token(self):
+        self.assertEqual(self.get_me().status_code, 200)
+        self.assertEqual(len(self.token_queries), 1)
+        response = self.get_me()
+        self.assertEqual(response.data['username'], 'user')
+        self.assertEqual(self.token_queries, [])
+
+    def test_shared_cache(self):
+        """Другой процесс с пустым LRU берет снимок из общего кэша."""
+        self.get_me()
+        local_cache.entries.clear()
+        self.assertEqual(self.get_me().status_code, 200)
+        self.assertEqual(self.token_queries, [])
+
+    def test_invalid_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token invalid')
+        for _ in range(2):
+            self.assertEqual(self.get_me().status_code, 401)
+            self.assertEqual(len(self.token_queries), 1)
+
+    def test_logout(self):
+        self.get_me()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/auth/token/logout/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.get_me().status_code, 401)
+
+    def test_user_changes(self):
+        self.get_me()
+        self.user.username = 'renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(self.get_me().data['username'], 'renamed')
+        self.user.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save(update_fields=['is_active'])
+        self.assertEqual(self.get_me().status_code, 401)
+
+    def test_counters_keep_cache(self):
+        """Счетчики не входят в снимок и не сбрасывают токен."""
+        self.get_me()
+        change_counter(User, [self.user.pk], 'followers_count', 1)
+        self.user.refresh_from_db()
+        self.user.save(update_fields=['followers_count'])
+        self.get_me()
+        self.assertEqual(self.token_queries, [])
+
+    def test_restored_user_save(self):
+        """Сохранение пользователя из снимка не затирает другие поля."""
+        User.objects.filter(pk=self.user.pk).update(followers_count=3)
+        self.get_me()
+        user, _ = CachedTokenAuthentication().authenticate_credentials(
+            self.token.key
+        )
+        user.first_name = 'new'
+        user.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, 'new')
+        self.assertEqual(self.user.followers_count, 3)
+        self.assertEqual(self.user.password, 'password')
+
+
+class FastSerializersTest(APITestCase):
+    """fast_serializers отдают тот же JSON, что RecipeShowSerializer."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        rng = random.Random(0)
+        cls.ingredients += [
+            Ingredient.objects.create(name=name, measurment_unit=unit)
+            for name, unit in (
+                ('яйца', 'шт.'), ('соль', 'по вкусу'), ('масло', 'мл')
+            )
+        ]
+        authors = [cls.author] + [
+            create_user(f'author{number}') for number in range(3)
+        ]
+        cls.users = [cls.user] + authors
+        recipes = []
+        for number in range(24):
+            recipe = create_recipe(
+                rng.choice(authors),
+                f'recipe{number}',
+                rng.sample(cls.tags, rng.randint(0, len(cls.tags))),
+                rng.sample(
+                    cls.ingredients, rng.randint(0, len(cls.ingredients))
+                )
+            )
+            recipe.renditions_ready = rng.random() < 0.5
+            recipe.save(update_fields=['renditions_ready'])
+            recipes.append(recipe)
+        for user in cls.users:
+            for model in (Favorite, ShoppingCart):
+                model.objects.bulk_create(
+                    model(user=user, recipe=recipe)
+                    for recipe in rng.sample(recipes, 8)
+                )
+            Subscription.objects.bulk_create(
+                Subscription(subscriber=user, author=author)
+                for author in rng.sample(authors, 2) if author != user
+            )
+
+    def test_matches_recipe_show_serializer(self):
+        renderer = JSONRenderer()
+        users = [AnonymousUser(), *self.users]
+        tags = [tag.pk for tag in self.tags]
+        for seed in range(30):
+            rng = random.Random(seed)
+            user = rng.choice(users)
+            queryset = RecipeViewSet.queryset.all()
+            if rng.random() < 0.5:
+                queryset = queryset.filter(
+                    pk__in=Recipe.tags.through.objects.filter(
+                        tag_id__in=rng.sample(
+                            tags, rng.randint(1, len(tags))
+                        )
+                    ).values('recipe_id')
+                )
+            offset = rng.randrange(24)
+            page = annotate_user_flags(queryset, user)[offset:offset + 6]
+            request = APIRequestFactory().get('/api/recipes/')
+            request.user = user
+            with self.subTest(seed=seed):
+                self.assertEqual(
+                    renderer.render(serialize_recipes(
+                        list(recipe_rows(page)), user
+                    )),
+                    renderer.render(RecipeShowSerializer(
+                        list(page), many=True, context={'request': request}
+                    ).data)
+                )
+
+
+class TagsFilterTest(APITestCase):
+    """Фильтр по тэгам в режимах any и all при любом числе тэгов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.tags += [
+            Tag.objects.create(
+                name=f'tag{number}', color=f'#0000{number:02}',
+                slug=f'tag{number}'
+            )
+            for number in range(filters.MAX_ENUMERATED_TAGS)
+        ]
+        first, second, last = cls.tags[0], cls.tags[1], cls.tags[-1]
+        cls.recipes = {
+            name: create_recipe(cls.author, name, tags)
+            for name, tags in (
+                ('first', [first]),
+                ('first_second', [first, second]),
+                ('second_last', [second, last]),
+                ('untagged', []),
+            )
+        }
+
+    def get_names(self, tags, mode='any'):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/recipes/', {
+                'tags': [tag.slug for tag in tags], 'tags_mode': mode
+            })
+        self.assertEqual(response.status_code, 200)
+        self.sql = ' '.join(query['sql'] for query in queries)
+        return {recipe['name'] for recipe in response.data['results']}
+
+    def check_modes(self):
+        first, second, last = self.tags[0], self.tags[1], self.tags[-1]
+        for tags, mode, names in (
+            ([first], 'any', {'first', 'first_second'}),
+            ([first, last], 'any', {'first', 'first_second', 'second_last'}),
+            ([first, second], 'all', {'first_second'}),
+            ([second, last], 'all', {'second_last'}),
+            ([first, last], 'all', set()),
+        ):
+            with self.subTest(tags=[tag.slug for tag in tags], mode=mode):
+                self.assertEqual(self.get_names(tags, mode), names)
+
+    def test_enumerated_masks(self):
+        with mock.patch.object(
+            filters, 'MAX_ENUMERATED_TAGS', len(self.tags)
+        ):
+            self.check_modes()
+        self.assertNotIn('recipes_recipe_tags', self.sql)
+
+    def test_more_tags_than_enumerated(self):
+        """Больше MAX_ENUMERATED_TAGS тэгов - поиск по таблице связей."""
+        self.assertGreater(len(self.tags), filters.MAX_ENUMERATED_TAGS)
+        self.check_modes()
+        self.assertIn('recipes_recipe_tags', self.sql)
+        self.assertNotIn('&', self.sql)
+
+
+class PantrySearchTest(APITestCase):
+    """Поиск рецептов по имеющимся ингредиентам."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        flour, milk, sugar = cls.ingredients
+        cls.recipes = {
+            name: create_recipe(cls.author, name, cls.tags[:1], ingredients)
+            for name, ingredients in (
+                ('блины', [flour, milk]),
+                ('торт', [flour, milk, sugar]),
+                ('коктейль', [milk]),
+                ('карамель', [sugar]),
+            )
+        }
+
+    def setUp(self):
+        super().setUp()
+        # Индекс процесса строится заново по данным этого теста.
+        recipe_index.postings = None
+        self.addCleanup(setattr, recipe_index, 'postings', None)
+        flour, milk, _ = self.ingredients
+        self.url = f'/api/recipes/by_ingredients/?ids={flour.pk},{milk.pk}'
+
+    def test_ranking(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(
+            [
+                (item['name'], item['matched_count'],
+                 [missing['name'] for missing in item['missing_ingredients']])
+                for item in response.data['results']
+            ],
+            [
+                ('блины', 2, []),
+                ('коктейль', 1, []),
+                ('торт', 2, ['сахар']),
+            ]
+        )
+
+    def test_response_shape(self):
+        response = self.client.get(f'{self.url}&limit=1&page=2')
+        self.assertEqual(
+            set(response.data), {'count', 'next', 'previous', 'results'}
+        )
+        item, = response.data['results']
+        recipe = self.recipes['коктейль']
+        self.assertEqual(item['id'], recipe.pk)
+        expected = RecipeShowSerializer(
+            annotate_user_flags(
+                RecipeViewSet.queryset.filter(pk=recipe.pk), AnonymousUser()
+            ).get()
+        ).data
+        self.assertEqual(
+            {key: value for key, value in item.items() if key not in (
+                'matched_count', 'missing_ingredients'
+            )},
+            {**expected, 'image': item['image']}
+        )
+
+    def test_queries(self):
+        self.client.get(self.url)
+        # id страницы и рецепты с тегами и ингредиентами; индекс уже
+        # построен.
+        with self.assertNumQueries(2):
+            self.client.get(self.url)
+
+    def test_incremental_update(self):
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            IngredientInRecipe.objects.create(
+                recipe=self.recipes['карамель'],
+                ingredient=self.ingredients[1],
+                amount=1
+            )
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertIn(
+            ('карамель', 1),
+            [(item['name'], item['matched_count'])
+             for item in response.data['results']]
+        )
+        # Индекс обновлен на месте, а не перестроен.
+        self.assertEqual(len(queries), 2)
+
+    def test_invalid_ids(self):
+        response = self.client.get('/api/recipes/by_ingredients/?ids=a,1')
+        self.assertEqual(response.status_code, 400)
+
+
+class ShoppingCartDownloadTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        ShoppingListItem.objects.bulk_create(
+            ShoppingListItem(
+                user=cls.user, ingredient=ingredient, total_amount=number
+            )
+            for number, ingredient in enumerate(cls.ingredients, 1)
+        )
+        cls.token = Token.objects.create(user=cls.user)
+
+    async def test_asgi_streams_async_iterator(self):
+        response = await self.async_client.get(
+            '/api/recipes/download_shopping_cart/?format=txt',
+            headers={'Authorization': f'Token {self.token.key}'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        content = b''.join([
+            chunk async for chunk in response.streaming_content
+        ])
+        self.assertEqual(
+            content.decode(),
+            'молоко - 2 г\nмука - 1 г\nсахар - 3 г\n'
+        )
+
+
+class ShoppingListTotalsTest(APITestCase):
+    """Итоги списка покупок после удаления рецептов из корзины."""
+
+    def setUp(self):
+        super().setUp()
+        self.client = client_for(self.user)
+        self.first = create_recipe(
+            self.author, 'first', ingredients=self.ingredients[:2]
+        )
+        self.second = create_recipe(
+            self.author, 'second', ingredients=self.ingredients[1:]
+        )
+        response = self.client.post(
+            '/api/recipes/shopping_cart/',
+            {'ids': [self.first.pk, self.second.pk]},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def totals(self):
+        return dict(ShoppingListItem.objects.filter(
+            user=self.user
+        ).values_list('ingredient__name', 'total_amount'))
+
+    def test_added(self):
+        self.assertEqual(
+            self.totals(), {'мука': 2, 'молоко': 4, 'сахар': 2}
+        )
+
+    def test_remove(self):
+        response = self.client.delete(
+            f'/api/recipes/{self.first.pk}/shopping_cart/'
+        )
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.totals(), {'молоко': 2, 'сахар': 2})
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.in_carts_count, 0)
+
+    def test_remove_batch(self):
+        response = self.client.delete(
+            '/api/recipes/shopping_cart/',
+            {'ids': [self.second.pk, self.second.pk + 100]},
+            format='json'
+        )
+        self.assertEqual(response.data, [
+            {'id': self.second.pk, 'status': 'removed'},
+            {'id': self.second.pk + 100, 'status': 'not_found'},
+        ])
+        self.assertEqual(self.totals(), {'мука': 2, 'молоко': 2})
+
+    def test_clear(self):
+        response = self.client.delete('/api/recipes/shopping_cart/clear/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.totals(), {})
+        self.assertFalse(ShoppingCart.objects.exists())
+        self.second.refresh_from_db()
+        self.assertEqual(self.second.in_carts_count, 0)
+
+
+class AsyncWorkersTest(SimpleTestCase):
+
+    async def test_threads_are_bounded(self):
+        threads = set()
+
+        def query():
+            threads.add(threading.get_ident())
+            time.sleep(0.01)
+        await gather(*[query] * (settings.ASGI_DB_THREADS * 4))
+        self.assertLessEqual(len(threads), settings.ASGI_DB_THREADS)
+
+
+class AsyncViewsTest(TransactionTestCase):
+    """Асинхронные view отвечают так же, как синхронные."""
+
+    def setUp(self):
+        cache.clear()
+        # Соединения потоков пула закрываются после каждого запроса, иначе
+        # они мешают удалить тестовую базу.
+        patcher = mock.patch.dict(
+            connection.settings_dict, {'CONN_MAX_AGE': 0}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = create_user('user')
+        self.author = create_user('author')
+        self.tag = Tag.objects.create(
+            name='breakfast', color='#E26C2D', slug='breakfast'
+        )
+        ingredients = [
+            Ingredient.objects.create(name=name, measurment_unit='г')
+            for name in ('мука', 'молоко')
+        ]
+        self.recipes = [
+            create_recipe(self.author, f'recipe{number}', tags, ingredients)
+            for number, tags in enumerate(([self.tag], [], [self.tag]))
+        ]
+        Favorite.objects.create(user=self.user, recipe=self.recipes[0])
+        ShoppingCart.objects.create(user=self.user, recipe=self.recipes[2])
+        Subscription.objects.create(subscriber=self.user, author=self.author)
+        self.headers = {
+            'Authorization': f'Token {Token.objects.create(user=self.user)}'
+        }
+
+    def assert_same(self, handler, url, headers=None, **kwargs):
+        expected = self.client.get(url, headers=headers)
+        self.assertEqual(expected.status_code, 200)
+        response = async_to_sync(handler)(
+            AsyncRequestFactory().get(url, headers=headers), **kwargs
+        )
+        self.assertEqual(json.loads(response.content), expected.json())
+
+    def test_recipe_list(self):
+        for fast_read in (True, False):
+            for url, headers in (
+                ('/api/recipes/', None),
+                ('/api/recipes/', self.headers),
+                ('/api/recipes/?limit=2&page=2', self.headers),
+                ('/api/recipes/?tags=breakfast', self.headers),
+            ):
+                patcher = mock.patch.object(
+                    RecipeViewSet, 'fast_read', fast_read
+                )
+                with self.subTest(fast_read=fast_read, url=url), patcher:
+                    self.assert_same(async_views.recipe_list, url, headers)
+
+    def test_recipe_detail(self):
+        pk = str(self.recipes[0].pk)
+        self.assert_same(
+            async_views.recipe_detail, f'/api/recipes/{pk}/',
+            self.headers, pk=pk
+        )
+
+    def test_subscription_list(self):
+        self.assert_same(
+            async_views.subscription_list,
+            '/api/users/subscriptions/?recipes_limit=1',
+            self.headers
+        )
+
+    def test_fallback(self):
+        for handler, url, headers in (
+            (async_views.recipe_list, '/api/recipes/?tags=x', None),
+            (async_views.recipe_list, '/api/recipes/?page=9', None),
+            (async_views.subscription_list, '/api/users/subscriptions/',
+             None),
+            (async_views.subscription_list,
+             '/api/users/subscriptions/?recipes_limit=x', self.headers),
+        ):
+            with self.subTest(url=url, headers=headers):
+                with self.assertRaises(async_views.Fallback):
+                    async_to_sync(handler)(
+                        AsyncRequestFactory().get(url, headers=headers)
+                    )
+
+
+class IngredientInRecipeAdminTest(APITestCase):
+    """Правки строк рецепта в админке обновляют производные данные."""
+
+    def setUp(self):
+        super().setUp()
+        admin = create_user('admin')
+        admin.is_staff = admin.is_superuser = True
+        admin.save()
+        self.client.force_login(admin)
+        flour, milk, sugar = self.ingredients
+        self.recipe = create_recipe(
+            self.author, 'блины', self.tags, [flour, milk]
+        )
+        ShoppingCart.objects.create(user=self.user, recipe=self.recipe)
+        ShoppingListItem.objects.add_recipe(self.user, self.recipe)
+        self.row = self.recipe.recipe_ingredient.get(ingredient=milk)
+        self.url = f'/admin/recipes/ingredientinrecipe/{self.row.pk}/'
+        self.client.get(f'/api/recipes/{self.recipe.pk}/')
+
+    def totals(self):
+        return dict(ShoppingListItem.objects.filter(
+            user=self.user
+        ).values_list('ingredient__name', 'total_amount'))
+
+    def change(self, ingredient, amount):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'{self.url}change/', {
+                'recipe': self.recipe.pk,
+                'ingredient': ingredient.pk,
+                'amount': amount,
+            })
+        self.assertEqual(response.status_code, 302)
+
+    def test_change_amount(self):
+        self.change(self.row.ingredient, 5)
+        self.assertEqual(self.totals(), {'мука': 2, 'молоко': 5})
+        ingredients = self.client.get(
+            f'/api/recipes/{self.recipe.pk}/'
+        ).data['ingredients']
+        self.assertIn(5, [ingredient['amount'] for ingredient in ingredients])
+
+    def test_change_ingredient(self):
+        self.change(self.ingredients[2], 3)
+        self.assertEqual(self.totals(), {'мука': 2, 'сахар': 3})
+        found = self.client.get('/api/recipes/?search=сахар').data
+        self.assertEqual(
+            [recipe['id'] for recipe in found['results']], [self.recipe.pk]
+        )
+
+    def test_delete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                f'{self.url}delete/', {'post': 'yes'}
+            )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.totals(), {'мука': 2})
+        self.assertEqual(
+            len(self.client.get(
+                f'/api/recipes/{self.recipe.pk}/'
+            ).data['ingredients']),
+            1
+        )
+
+
+class RenditionsTest(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = override_settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+    def images(self):
+        return self.client.get('/api/recipes/').data['results'][0]['images']
+
+    def test_urls_do_not_probe_storage(self):
+        create_recipe(self.author, 'recipe')
+        with mock.patch.object(
+            default_storage, 'exists', side_effect=AssertionError
+        ):
+            images = self.images()
+        self.assertEqual(images['thumbnail'], images['original'])
+
+    def test_ready_renditions(self):
+        buffer = BytesIO()
+        Image.new('RGB', (800, 600), '#49B64E').save(buffer, 'PNG')
+        name = default_storage.save(
+            'recipes/recipe.png', ContentFile(buffer.getvalue())
+        )
+        recipe = create_recipe(self.author, 'recipe')
+        Recipe.objects.filter(pk=recipe.pk).update(image=name)
+        self.assertTrue(make_renditions(name))
+        mark_renditions_ready(name)
+        images = self.images()
+        self.assertEqual(
+            images['thumbnail'],
+            default_storage.url(rendition_name(name, 'thumbnail'))
+        )
+        self.assertTrue(default_storage.exists(
+            rendition_name(name, 'thumbnail')
+        ))
+
+
+class BackfillMigrationsTest(TransactionTestCase):
+    """Данные, созданные до миграций бэклога, получают производные поля."""
+
+    before = [
+        ('recipes', '0001_initial'), ('users', '0005_alter_user_password')
+    ]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_backfill(self):
+        apps = self.migrate(self.before)
+        old = {
+            name: apps.get_model(app, name) for app, name in (
+                ('users', 'User'), ('users', 'Subscription'),
+                ('recipes', 'Tag'), ('recipes', 'Ingredient'),
+                ('recipes', 'Recipe'), ('recipes', 'IngredientInRecipe'),
+                ('recipes', 'ShoppingCart'), ('recipes', 'Favorite'),
+            )
+        }
+        user, author = (
+            old['User'].objects.create(
+                username=name, email=f'{name}@example.com', password='x'
+            )
+            for name in ('user', 'author')
+        )
+        old['Subscription'].objects.create(subscriber=user, author=author)
+        breakfast, lunch = (
+            old['Tag'].objects.create(name=name, color=color, slug=name)
+            for name, color in (('breakfast', '#E26C2D'), ('lunch', '#49B64E'))
+        )
+        milk = old['Ingredient'].objects.create(
+            name='молоко', measurment_unit='мл'
+        )
+        recipes = []
+        for name, amount in (('блины', 200), ('каша', 300)):
+            recipe = old['Recipe'].objects.create(
+                author=author, name=name, text=name, cooking_time=10,
+                image='recipes/recipe.png'
+            )
+            recipe.tags.set([breakfast, lunch])
+            old['IngredientInRecipe'].objects.create(
+                recipe=recipe, ingredient=milk, amount=amount
+            )
+            old['ShoppingCart'].objects.create(user=user, recipe=recipe)
+            recipes.append(recipe)
+        old['Favorite'].objects.create(user=user, recipe=recipes[0])
+
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+        self.assertEqual(
+            set(Tag.objects.values_list('bit', flat=True)), {0, 1}
+        )
+        self.assertEqual(
+            set(Recipe.objects.values_list('tags_mask', flat=True)), {3}
+        )
+        self.assertEqual(
+            Recipe.objects.filter(search_vector=SearchQuery(
+                'молоко', config=SEARCH_CONFIG
+            )).count(),
+            2
+        )
+        self.assertEqual(
+            Recipe.objects.get(pk=recipes[0].pk).favorites_count, 1
+        )
+        self.assertEqual(
+            set(Recipe.objects.values_list('in_carts_count', flat=True)), {1}
+        )
+        self.assertEqual(
+            ShoppingListItem.objects.get(user_id=user.pk).total_amount, 500
+        )
+        author = User.objects.get(pk=author.pk)
+        self.assertEqual(
+            (author.recipes_count, author.followers_count), (2, 1)
+        )
+
+
+class ConcurrentWritesTest(TransactionTestCase):
+    """
+    Одновременные одинаковые POST: дубликат отсекает уникальное
+    ограничение, ответ 201 получает ровно один запрос.
+    """
+
+    THREADS = 4
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_user('user')
+        self.author = create_user('author')
+        self.ingredient = Ingredient.objects.create(
+            name='мука', measurment_unit='г'
+        )
+        self.recipe = create_recipe(
+            self.author, 'recipe', ingredients=[self.ingredient]
+        )
+        Token.objects.create(user=self.user)
+
+    def run_concurrently(self, requests):
+        """Выполняет запросы (метод, url) одновременно, каждый в потоке."""
+        barrier = threading.Barrier(len(requests))
+        statuses = []
+
+        def send(method, url):
+            client = APIClient()
+            client.credentials(
+                HTTP_AUTHORIZATION=f'Token {self.user.auth_token.key}'
+            )
+            try:
+                barrier.wait()
+                statuses.append(getattr(client, method)(url).status_code)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=send, args=request)
+            for request in requests
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return statuses
+
+    def race(self, url):
+        statuses = self.run_concurrently([('post', url)] * self.THREADS)
+        self.assertEqual(
+            sorted(statuses), [201] + [400] * (self.THREADS - 1)
+        )
+
+    def test_favorite(self):
+        self.race(f'/api/recipes/{self.recipe.pk}/favorite/')
+        self.assertEqual(Favorite.objects.count(), 1)
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.favorites_count, 1)
+
+    def test_shopping_cart(self):
+        self.race(f'/api/recipes/{self.recipe.pk}/shopping_cart/')
+        self.assertEqual(ShoppingCart.objects.count(), 1)
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.in_carts_count, 1)
+        self.assertEqual(
+            ShoppingListItem.objects.get(user=self.user).total_amount, 2
+        )
+
+    def test_subscription(self):
+        self.race(f'/api/users/{self.author.pk}/subscribe/')
+        self.assertEqual(Subscription.objects.count(), 1)
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.followers_count, 1)
+
+    def test_shopping_list_totals(self):
+        other = create_recipe(
+            self.author, 'other', ingredients=[self.ingredient]
+        )
+        ShoppingCart.objects.create(user=self.user, recipe=other)
+        ShoppingListItem.objects.create(
+            user=self.user, ingredient=self.ingredient, total_amount=2
+        )
+        for _ in range(10):
+            self.run_concurrently([
+                ('post', f'/api/recipes/{self.recipe.pk}/shopping_cart/'),
+                ('delete', f'/api/recipes/{other.pk}/shopping_cart/'),
+            ])
+            self.assertEqual(
+                ShoppingListItem.objects.get(user=self.user).total_amount, 2
+            )
+            self.run_concurrently([
+                ('post', f'/api/recipes/{other.pk}/shopping_cart/'),
+                ('delete', f'/api/recipes/{self.recipe.pk}/shopping_cart/'),
+            ])
+            self.assertEqual(
+                ShoppingListItem.objects.get(user=self.user).total_amount, 2
+            )
+
+    def test_add_and_clear(self):
+        """Итоги всегда равны сумме по рецептам, оставшимся в корзине."""
+        for _ in range(10):
+            self.run_concurrently([
+                ('post', f'/api/recipes/{self.recipe.pk}/shopping_cart/'),
+                ('delete', '/api/recipes/shopping_cart/clear/'),
+            ])
+            in_cart = ShoppingCart.objects.filter(user=self.user).exists()
+            self.assertEqual(
+                list(ShoppingListItem.objects.filter(
+                    user=self.user
+                ).values_list('total_amount', flat=True)),
+                [2] if in_cart else []
+            )
+            self.recipe.refresh_from_db()
+            self.assertEqual(self.recipe.in_carts_count, int(in_cart))
+            ShoppingCart.objects.all().delete()
+            ShoppingListItem.objects.all().delete()
+            Recipe.objects.update(in_carts_count=0)
+
+
+@skipUnless(
+    'replica' in settings.DATABASES, 'нужны настройки foodgram.settings_test'
+)
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTest(TransactionTestCase):
+    """Реплика - тестовое зеркало основной базы."""
+
+    # Без foodgram.settings_test псевдонима нет, а тест пропускается.
+    databases = {'default', 'replica'}.intersection(settings.DATABASES)
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(replicas.unavailable.clear)
+        self.user = create_user('user')
+        create_recipe(create_user('author'), 'recipe')
+
+    def get_recipes(self, client, connect=None):
+        connection = connections['replica']
+        connect = connect or connection.ensure_connection
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connection) as replica, \
+                mock.patch.object(connection, 'ensure_connection', connect):
+            response = client.get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+        return tables(primary), tables(replica)
+
+    def test_reads_go_to_replica(self):
+        primary, replica = self.get_recipes(APIClient())
+        self.assertIn('recipes_recipe', replica)
+        self.assertNotIn('recipes_recipe', primary)
+
+    def test_token_is_read_from_primary(self):
+        primary, replica = self.get_recipes(client_for(self.user))
+        self.assertIn('authtoken_token', primary)
+        self.assertNotIn('authtoken_token', replica)
+        self.assertIn('recipes_recipe', replica)
+
+    def test_unavailable_replica(self):
+        connect = mock.Mock(side_effect=OperationalError)
+        with self.assertLogs('foodgram.replicas', 'WARNING'):
+            primary, replica = self.get_recipes(APIClient(), connect)
+        self.assertIn('recipes_recipe', primary)
+        self.assertEqual(replica, set())
+        # Недоступную реплику не пробуют до DATABASE_REPLICA_RETRY.
+        self.get_recipes(APIClient(), connect)
+        connect.assert_called_once()
+
+
+def tables(queries):
+    return {
+        table for query in queries
+        for table in ('authtoken_token', 'recipes_recipe')
+        if f'"{table}"' in query['sql']
+    }
+
+
+class QueryPlansTest(APITestCase):
+    """
+    У каждого частого запроса есть подходящий индекс: с запретом
+    последовательного сканирования план не читает горячие таблицы целиком.
+    """
+
+    def test_hot_queries_use_indexes(self):
+        create_recipe(self.author, 'recipe', self.tags, self.ingredients)
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        for label, queryset in hot_queries(self.author):
+            with self.subTest(label):
+                self.assertEqual(seq_scans(queryset.explain()), [])
+
+
+class RecipeIndexRefreshTest(SimpleTestCase):
+
+    def test_concurrent_first_requests_build_once(self):
+        index = IngredientRecipeIndex()
+        calls = []
+
+        def build():
+            calls.append(1)
+            time.sleep(0.05)
+            return {}, array('H')
+
+        threads = [
+            threading.Thread(target=index.refresh) for _ in range(8)
+        ]
+        with mock.patch.object(index, 'build', build):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(index.postings, {})
+
+    def test_failed_rebuild_is_retried(self):
+        index = IngredientRecipeIndex()
+        index.postings, index.rebuilding = {}, True
+        with mock.patch.object(index, 'build', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                index.rebuild(in_background=True)
+        self.assertFalse(index.rebuilding)
+
+
+class MetricsFilesTest(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        metrics_dir = override_settings(METRICS_DIR=directory.name)
+        metrics_dir.enable()
+        self.addCleanup(metrics_dir.disable)
+        self.directory = directory.name
+
+    def observe(self, registry, queries):
+        registry.observe('recipes-list', {'foodgram_db_queries': queries})
+
+    def totals(self):
+        return metrics.Registry().collect()['foodgram_db_queries|recipes-list']
+
+    def test_dead_worker_is_archived(self):
+        dead = metrics.Registry()
+        self.observe(dead, 3)
+        dead_path = metrics.worker_path(os.getpid())
+        os.rename(dead_path, metrics.worker_path(1))
+        metrics.archive_worker(1)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ['metrics-archive.json', 'metrics.lock']
+        )
+        self.assertEqual(self.totals()[-2:], [1, 3])
+
+    def test_stale_file_with_same_pid_is_archived(self):
+        self.observe(metrics.Registry(), 3)
+        self.observe(metrics.Registry(), 5)
+        self.assertEqual(self.totals()[-2:], [2, 8])
@@ -1,6 +1,9 @@
-from django.urls import include, path
+from django.conf import settings
+from django.urls import include, path, re_path
 from rest_framework.routers import DefaultRouter
 
+from api.async_views import (ingredient_list_view, recipe_detail_view,
+                             recipe_list_view, subscription_list_view)
 from api.views import (CustomUserViewSet, IngredientViewSet, RecipeViewSet,
                        TagViewSet)
 
@@ -12,9 +15,26 @@ router.register('tags', TagViewSet)
 router.register('recipes', RecipeViewSet)
 router.register('users', CustomUserViewSet)
 
-urlpatterns = [
+urlpatterns = []
+
+if settings.ASGI_ENABLED:
+    urlpatterns += [
+        path('recipes/', recipe_list_view, name='recipes-list'),
+        re_path(
+            r'^recipes/(?P<pk>\d+)/$',
+            recipe_detail_view,
+            name='recipes-detail'
+        ),
+        path('ingredients/', ingredient_list_view, name='ingredients-list'),
+        path(
+            'users/subscriptions/',
+            subscription_list_view,
+            name='users-subscriptions'
+        ),
+    ]
+
+urlpatterns += [
     path('', include(router.urls)),
     path('', include('djoser.urls')),
     path('auth/', include('djoser.urls.authtoken')),
-
 ]
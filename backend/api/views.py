@@ -1,5 +1,12 @@
-from django.db.models import Sum
-from django.http import HttpResponse
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Prefetch, Value
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet
@@ -8,33 +15,143 @@ from rest_framework.decorators import action
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 
+from .autocomplete import ingredient_index
+from .cache import CachedCatalogMixin, get_version, get_versions
+from .counters import change_counter
+from .fast_serializers import recipe_rows, serialize_recipes
 from .filters import IngredientFilter, RecipeFilter
-from .pagination import Paginator
+from .pagination import PageNumberPaginator, Paginator
 from .permissions import AllowAnyOrIsAuthenticated, AuthorOrReadOnly
-from .serializers import (CustomUserSerializer, IngredientSerializer,
-                          RecipeCreateUpdateSerializer, RecipeShowSerializer,
-                          ShortRecipeShowSerializer, SubscriptionSerializer,
-                          TagSerializer)
-from recipes.models import Favorite, Ingredient, Recipe, ShoppingCart, Tag
+from .recipe_index import recipe_index
+from .renderers import SHOPPING_CART_RENDERERS
+from .serializers import (CustomUserSerializer, IngredientIdsSerializer,
+                          IngredientSerializer, RecipeCreateUpdateSerializer,
+                          RecipeIdsSerializer, RecipeShowSerializer,
+                          RecipesLimitSerializer, ShortRecipeShowSerializer,
+                          SubscriptionSerializer, TagSerializer, create_unique)
+from foodgram.replicas import read_from_primary
+from recipes.models import (Favorite, Ingredient, IngredientInRecipe, Recipe,
+                            ShoppingCart, ShoppingListItem, Tag)
 from users.models import Subscription, User
 
+SHOPPING_CART_CHUNK_SIZE = 500
+
+
+def stream_content(request, chunks):
+    """
+    Содержимое StreamingHttpResponse. Синхронный итератор под ASGI Django
+    4.2 собирает в список целиком, поэтому там части читаются пачками в
+    потоке запроса, где открыт курсор базы.
+    """
+    if not isinstance(request._request, ASGIRequest):
+        return chunks
+    next_batch = sync_to_async(
+        lambda: list(islice(chunks, SHOPPING_CART_CHUNK_SIZE))
+    )
+
+    async def content():
+        while batch := await next_batch():
+            yield b''.join(batch)
+    return content()
+
+
+def annotate_user_flags(queryset, user):
+    if not user.is_authenticated:
+        return queryset.annotate(
+            is_favorited=Value(False),
+            is_in_shopping_cart=Value(False),
+            author_is_subscribed=Value(False)
+        )
+    return queryset.annotate(
+        is_favorited=Exists(Favorite.objects.filter(
+            user=user, recipe=OuterRef('pk'))),
+        is_in_shopping_cart=Exists(ShoppingCart.objects.filter(
+            user=user, recipe=OuterRef('pk'))),
+        author_is_subscribed=Exists(Subscription.objects.filter(
+            subscriber=user, author=OuterRef('author')))
+    )
+
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+def recipe_detail_key(pk):
+    return 'recipe:{}:{}:{}:{}'.format(
+        pk, *get_versions((Recipe, pk), (Tag,), (Ingredient,))
+    )
+
+
+def cached_recipe_detail(pk):
+    """
+    Ключ карточки и ее общая часть из кэша. Поколение автора хранится
+    в записи: его id до чтения карточки неизвестен.
+    """
+    key = recipe_detail_key(pk)
+    entry = cache.get(key)
+    if entry is None:
+        return key, None
+    author_id, author_version, data = entry
+    if get_version(User, author_id) != author_version:
+        return key, None
+    return key, data
+
+
+def recipe_user_flags(pk, user):
+    """Флаги пользователя к карточке из кэша, None - рецепта нет."""
+    return annotate_user_flags(Recipe.objects.filter(pk=pk), user).values(
+        'is_favorited', 'is_in_shopping_cart', 'author_is_subscribed'
+    ).first()
+
+
+def merge_user_flags(data, flags):
+    return {
+        **data,
+        'author': {
+            **data['author'],
+            'is_subscribed': flags.pop('author_is_subscribed')
+        },
+        **flags,
+    }
+
+
+class IngredientViewSet(CachedCatalogMixin, viewsets.ReadOnlyModelViewSet):
+    read_replica = True
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     filter_backends = (DjangoFilterBackend,)
     filterset_class = IngredientFilter
     permission_classes = (AllowAny,)
 
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('name'):
+            return self.cached_response(request, self.autocomplete)
+        return super().list(request, *args, **kwargs)
+
+    def autocomplete(self, request):
+        return Response(ingredient_index.search(
+            request.query_params['name'],
+            contains=request.query_params.get('contains') in ('1', 'true')
+        ))
 
-class TagViewSet(viewsets.ModelViewSet):
+
+class TagViewSet(CachedCatalogMixin, viewsets.ModelViewSet):
+    read_replica = True
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (AllowAny,)
 
 
 class RecipeViewSet(viewsets.ModelViewSet):
-    queryset = Recipe.objects.all()
+    read_replica = True
+    # Списки собираются из values() в fast_serializers, а не
+    # RecipeShowSerializer.
+    fast_read = True
+    queryset = Recipe.objects.select_related('author').prefetch_related(
+        Prefetch('tags', queryset=Tag.objects.order_by('id')),
+        Prefetch(
+            'recipe_ingredient',
+            queryset=IngredientInRecipe.objects.select_related(
+                'ingredient'
+            ).order_by('id')
+        )
+    )
     permission_classes = (AuthorOrReadOnly,)
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
@@ -52,11 +169,134 @@ class RecipeViewSet(viewsets.ModelViewSet):
         except serializers.ValidationError as error:
             return Response(str(error), status=status.HTTP_400_BAD_REQUEST)
 
+    @transaction.atomic
+    def batch(self, request, model, counter, on_added=None, on_removed=None):
+        """
+        Добавляет или удаляет список рецептов одним запросом.
+
+        Все id проверяются одним SELECT, вставка и удаление выполняются
+        одним INSERT и одним DELETE. В ответе - статус для каждого id.
+        """
+        serializer = RecipeIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data['ids']
+        user = request.user
+        if on_added is not None:
+            # Итоги списка покупок зависят от того, какие строки реально
+            # вставлены или удалены, поэтому изменения корзины одного
+            # пользователя выполняются по очереди.
+            User.objects.select_for_update().filter(pk=user.pk).exists()
+        present = dict(Recipe.objects.filter(pk__in=ids).annotate(
+            present=Exists(model.objects.filter(
+                user=user, recipe=OuterRef('pk')
+            ))
+        ).values_list('pk', 'present').order_by())
+        if request.method == 'POST':
+            changed = [pk for pk in ids if present.get(pk) is False]
+            model.objects.bulk_create(
+                (model(user=user, recipe_id=pk) for pk in changed),
+                ignore_conflicts=True
+            )
+            change_counter(Recipe, changed, counter, 1)
+            callback, statuses = on_added, ('added', 'already_added')
+        else:
+            changed = [pk for pk in ids if present.get(pk)]
+            model.objects.filter(user=user, recipe_id__in=changed).delete()
+            change_counter(Recipe, changed, counter, -1)
+            callback, statuses = on_removed, ('removed', 'not_added')
+        if callback is not None and changed:
+            callback(user, changed)
+        changed = set(changed)
+        return Response([
+            {
+                'id': pk,
+                'status': (
+                    'not_found' if pk not in present
+                    else statuses[0] if pk in changed
+                    else statuses[1]
+                )
+            }
+            for pk in ids
+        ])
+
+    def get_queryset(self):
+        return annotate_user_flags(super().get_queryset(), self.request.user)
+
+    def page_rows(self, queryset):
+        """Рецепты для serialize_page: строки values() или модели."""
+        return recipe_rows(queryset) if self.fast_read else queryset
+
+    def serialize_page(self, page):
+        """Карточки рецептов страницы, общие для всех списков рецептов."""
+        if self.fast_read:
+            return serialize_recipes(page, self.request.user)
+        return self.get_serializer(page, many=True).data
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(
+            self.page_rows(self.filter_queryset(self.get_queryset()))
+        )
+        return self.get_paginated_response(self.serialize_page(page))
+
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Общая для всех пользователей часть карточки берется из кэша,
+        флаги текущего пользователя подставляются одним запросом.
+
+        Ключ включает поколения рецепта, тегов и ингредиентов, запись -
+        поколение автора; их увеличивают сигналы, поэтому изменения видны
+        сразу после записи.
+        """
+        pk = kwargs['pk']
+        if request.query_params or not pk.isdigit():
+            return super().retrieve(request, *args, **kwargs)
+        key, data = cached_recipe_detail(pk)
+        if data is None:
+            with read_from_primary():
+                author_id = Recipe.objects.filter(pk=pk).values_list(
+                    'author_id', flat=True
+                ).first()
+                if author_id is None:
+                    raise Http404
+                # Поколение читается до карточки, как и поколения в ключе.
+                author_version = get_version(User, author_id)
+                response = super().retrieve(request, *args, **kwargs)
+            self.cache_detail(key, author_version, response.data)
+            return response
+        flags = recipe_user_flags(pk, request.user)
+        if flags is None:
+            raise Http404
+        return Response(merge_user_flags(data, flags))
+
+    def cache_detail(self, key, author_version, data):
+        shared = {
+            field: value for field, value in data.items()
+            if field not in ('is_favorited', 'is_in_shopping_cart')
+        }
+        shared['author'] = {
+            field: value for field, value in data['author'].items()
+            if field != 'is_subscribed'
+        }
+        cache.set(
+            key,
+            (data['author']['id'], author_version, shared),
+            timeout=settings.RECIPE_CACHE_TIMEOUT
+        )
+
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        ShoppingListItem.objects.remove_recipe(
+            list(instance.shopping_cart.values_list('user_id', flat=True)),
+            instance
+        )
+        change_counter(User, [instance.author_id], 'recipes_count', -1)
+        instance.delete()
+
     def get_serializer_class(self):
-        if self.action == 'GET':
+        if self.action in ('list', 'retrieve'):
             return RecipeShowSerializer
         return RecipeCreateUpdateSerializer
 
@@ -66,26 +306,26 @@ class RecipeViewSet(viewsets.ModelViewSet):
         permission_classes=(IsAuthenticated,)
     )
     def favorite(self, request, pk):
-        user = request.user
-        recipe = get_object_or_404(Recipe, pk=pk)
-        serializer = RecipeCreateUpdateSerializer()
-
         if request.method == 'POST':
             return self.method_post(
-                user,
-                recipe,
-                serializer.add_to_favorites
+                request.user,
+                get_object_or_404(Recipe, pk=pk),
+                RecipeCreateUpdateSerializer().add_to_favorites
             )
 
-        instance = Favorite.objects.filter(
-            user=user,
-            recipe=recipe).first()
-        if instance:
-            instance.delete()
+        with transaction.atomic():
+            deleted, _ = Favorite.objects.filter(
+                user=request.user,
+                recipe_id=pk
+            ).delete()
+            if deleted:
+                change_counter(Recipe, [pk], 'favorites_count', -1)
+        if deleted:
             return Response(
                 'Рецепт удален из избранного',
                 status=status.HTTP_204_NO_CONTENT
             )
+        get_object_or_404(Recipe, pk=pk)
         return Response(
             'Рецепт не находится в избранном',
             status=status.HTTP_400_BAD_REQUEST
@@ -98,64 +338,150 @@ class RecipeViewSet(viewsets.ModelViewSet):
     )
     def shopping_cart(self, request, pk):
         user = request.user
-        recipe = get_object_or_404(Recipe, pk=pk)
-        serializer = RecipeCreateUpdateSerializer()
-
         if request.method == 'POST':
             return self.method_post(
                 user,
-                recipe,
-                serializer.add_to_shopping_cart
+                get_object_or_404(Recipe, pk=pk),
+                RecipeCreateUpdateSerializer().add_to_shopping_cart
             )
 
-        instance = ShoppingCart.objects.filter(
-            user=user,
-            recipe=recipe).first()
-        if instance:
-            instance.delete()
+        with transaction.atomic():
+            deleted, _ = ShoppingCart.objects.filter(
+                user=user,
+                recipe_id=pk
+            ).delete()
+            if deleted:
+                change_counter(Recipe, [pk], 'in_carts_count', -1)
+                ShoppingListItem.objects.remove_recipes(user, [pk])
+        if deleted:
             return Response(
                 'Рецепт удален из корзины',
                 status=status.HTTP_204_NO_CONTENT
             )
+        get_object_or_404(Recipe, pk=pk)
         return Response(
             'Рецепт не находится в корзине',
             status=status.HTTP_400_BAD_REQUEST
         )
 
     @action(
+        methods=['POST', 'DELETE'],
         detail=False,
+        url_path='favorite',
+        url_name='favorite-batch',
         permission_classes=(IsAuthenticated,)
     )
+    def favorite_batch(self, request):
+        return self.batch(request, Favorite, 'favorites_count')
+
+    @action(
+        methods=['POST', 'DELETE'],
+        detail=False,
+        url_path='shopping_cart',
+        url_name='shopping-cart-batch',
+        permission_classes=(IsAuthenticated,)
+    )
+    def shopping_cart_batch(self, request):
+        return self.batch(
+            request,
+            ShoppingCart,
+            'in_carts_count',
+            ShoppingListItem.objects.add_recipes,
+            ShoppingListItem.objects.remove_recipes
+        )
+
+    @action(
+        methods=['DELETE'],
+        detail=False,
+        url_path='shopping_cart/clear',
+        permission_classes=(IsAuthenticated,)
+    )
+    def clear_shopping_cart(self, request):
+        with transaction.atomic():
+            # Та же блокировка строки пользователя, что и при добавлении:
+            # иначе параллельный apply() допишет итоги к очищенной корзине.
+            User.objects.select_for_update().filter(
+                pk=request.user.pk
+            ).exists()
+            cart = ShoppingCart.objects.filter(user=request.user)
+            recipe_ids = list(cart.values_list('recipe_id', flat=True))
+            cart.delete()
+            change_counter(Recipe, recipe_ids, 'in_carts_count', -1)
+            ShoppingListItem.objects.filter(user=request.user).delete()
+        return Response(
+            'Корзина очищена',
+            status=status.HTTP_204_NO_CONTENT
+        )
+
+    @action(detail=False)
+    def by_ingredients(self, request):
+        params = IngredientIdsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        ingredient_ids = set(params.validated_data['ids'])
+        paginator = PageNumberPaginator()
+        page = paginator.paginate_queryset(
+            recipe_index.search(ingredient_ids), request, view=self
+        )
+        recipes = self.get_queryset().filter(
+            pk__in=[recipe_id for recipe_id, _ in page]
+        )
+        recipes = {
+            item['id']: item
+            for item in self.serialize_page(list(self.page_rows(recipes)))
+        }
+        data = []
+        for recipe_id, matched in page:
+            if recipe_id not in recipes:
+                continue
+            item = recipes[recipe_id]
+            item['matched_count'] = matched
+            item['missing_ingredients'] = [
+                ingredient for ingredient in item['ingredients']
+                if ingredient['id'] not in ingredient_ids
+            ]
+            data.append(item)
+        return paginator.get_paginated_response(data)
+
+    @action(
+        detail=False,
+        permission_classes=(IsAuthenticated,),
+        renderer_classes=SHOPPING_CART_RENDERERS
+    )
     def download_shopping_cart(self, request):
         user = request.user
-        ingredient_name = 'recipe__recipe_ingredient__ingredient__name'
-        unit = 'recipe__recipe_ingredient__ingredient__measurment_unit'
-        amount = 'recipe__recipe_ingredient__amount'
-        items = ShoppingCart.objects.filter(user=user).values(
-            ingredient_name,
-            unit
-        ).annotate(amount=Sum(amount))
-        shopping_cart = []
-
-        for item in items:
-            name = item[ingredient_name]
-            amount = item['amount']
-            measurment_unit = item[unit]
-
-            shopping_cart.append(f'{name} - {amount} {measurment_unit}')
-
-        file_name = 'shopping_cart.txt'
-        response = HttpResponse(shopping_cart, content_type='text/plain')
+        items = ShoppingListItem.objects.filter(user=user).values(
+            name=F('ingredient__name'),
+            measurment_unit=F('ingredient__measurment_unit'),
+            amount=F('total_amount')
+        ).order_by('name', 'measurment_unit')
+        renderer = request.accepted_renderer
+        content_type = renderer.media_type
+        if renderer.charset:
+            content_type = f'{content_type}; charset={renderer.charset}'
+
+        file_name = f'shopping_cart.{renderer.format}'
+        response = StreamingHttpResponse(
+            stream_content(request, renderer.stream(items.iterator(
+                chunk_size=SHOPPING_CART_CHUNK_SIZE
+            ))),
+            content_type=content_type
+        )
         response['Content-Disposition'] = f'attachment; filename={file_name}'
         return response
 
 
 class CustomUserViewSet(UserViewSet):
+    read_replica = True
     queryset = User.objects.all()
     serializer_class = CustomUserSerializer
     permission_classes = (AllowAnyOrIsAuthenticated,)
     pagination_class = Paginator
 
+    def get_recipes_limit(self, request):
+        params = RecipesLimitSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        return params.validated_data.get('recipes_limit')
+
     @action(
         detail=False,
         methods=['GET']
@@ -163,16 +489,34 @@ class CustomUserViewSet(UserViewSet):
     def subscriptions(self, request):
         if not request.user.is_authenticated:
             return Response(status=status.HTTP_401_UNAUTHORIZED)
-        user = request.user
-        queryset = self.paginate_queryset(
-            User.objects.filter(subscription__subscriber=user)
+        recipes_limit = self.get_recipes_limit(request)
+        page = self.paginate_queryset(self.subscription_authors(recipes_limit))
+        return self.get_paginated_response(
+            self.serialize_subscriptions(page, recipes_limit)
         )
-        serializer = SubscriptionSerializer(
-            queryset,
-            context={'request': request},
-            many=True
+
+    def subscription_authors(self, recipes_limit):
+        recipes = Recipe.objects.order_by('-id')
+        if recipes_limit is not None:
+            recipes = recipes[:recipes_limit]
+        return User.objects.filter(
+            subscription__subscriber=self.request.user
+        ).annotate(
+            is_subscribed=Value(True)
+        ).order_by('username').prefetch_related(
+            Prefetch(
+                'recipes',
+                queryset=recipes,
+                to_attr='limited_recipes'
+            )
         )
-        return self.get_paginated_response(serializer.data)
+
+    def serialize_subscriptions(self, authors, recipes_limit):
+        return SubscriptionSerializer(
+            authors,
+            context={'request': self.request, 'recipes_limit': recipes_limit},
+            many=True
+        ).data
 
     @action(
         methods=['POST', 'DELETE'],
@@ -182,35 +526,49 @@ class CustomUserViewSet(UserViewSet):
     def subscribe(self, request, *args, **kwargs):
         subscriber = request.user
         author_id = self.kwargs.get('id')
-        author = get_object_or_404(User, id=author_id)
 
-        if subscriber == author:
+        if str(subscriber.id) == author_id:
             return Response(
                 'Нельзя подписаться на себя',
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        instance = Subscription.objects.filter(
-            subscriber=subscriber,
-            author=author
-        )
-
         if request.method == 'POST':
-            if instance.exists():
+            recipes_limit = self.get_recipes_limit(request)
+            author = get_object_or_404(User, id=author_id)
+            try:
+                with transaction.atomic():
+                    create_unique(
+                        Subscription,
+                        'Пользователь уже подписан на автора',
+                        subscriber=subscriber,
+                        author=author
+                    )
+                    change_counter(User, [author.pk], 'followers_count', 1)
+            except serializers.ValidationError as error:
                 return Response(
-                    'Пользователь уже подписан на автора',
+                    error.detail[0],
                     status=status.HTTP_400_BAD_REQUEST
                 )
-            Subscription.objects.create(subscriber=subscriber, author=author)
             serializer = SubscriptionSerializer(
                 author,
-                context={'request': request},
+                context={
+                    'request': request,
+                    'recipes_limit': recipes_limit
+                },
             )
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-        if instance.exists():
-            instance.delete()
+        with transaction.atomic():
+            deleted, _ = Subscription.objects.filter(
+                subscriber=subscriber,
+                author_id=author_id
+            ).delete()
+            if deleted:
+                change_counter(User, [author_id], 'followers_count', -1)
+        if deleted:
             return Response(status=status.HTTP_204_NO_CONTENT)
+        get_object_or_404(User, id=author_id)
         return Response(
             'Пользователь не подписан на автора',
             status=status.HTTP_400_BAD_REQUEST
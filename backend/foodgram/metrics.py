@@ -0,0 +1,304 @@
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import Http404, HttpResponse
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+HISTOGRAMS = {
+    'foodgram_request_duration_seconds': DURATION_BUCKETS,
+    'foodgram_db_duration_seconds': DURATION_BUCKETS,
+    'foodgram_render_duration_seconds': DURATION_BUCKETS,
+    'foodgram_db_queries': (1, 2, 5, 10, 20, 50, 100, 200),
+    'foodgram_response_size_bytes': (
+        1024, 4096, 16384, 65536, 262144, 1048576, 4194304
+    ),
+}
+
+
+ARCHIVE_FILE = 'metrics-archive.json'
+
+
+@contextmanager
+def directory_lock(exclusive):
+    """Блокировка METRICS_DIR между процессами: архивация против чтения."""
+    with open(os.path.join(settings.METRICS_DIR, 'metrics.lock'), 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def merge(total, data):
+    for key, counts in data.items():
+        merged = total.setdefault(key, [0] * len(counts))
+        for index, value in enumerate(counts):
+            merged[index] += value
+    return total
+
+
+def read(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def write(path, data):
+    temp = f'{path}.tmp'
+    with open(temp, 'w') as file:
+        json.dump(data, file)
+    os.replace(temp, path)
+
+
+def worker_path(pid):
+    return os.path.join(settings.METRICS_DIR, f'metrics-{pid}.json')
+
+
+def archive_worker(pid):
+    """
+    Переносит счетчики завершившегося воркера в общий архив и удаляет
+    его файл: суммы в /metrics не убывают, а файлы не копятся. Вызывается
+    из хука child_exit gunicorn и при старте процесса с тем же pid.
+    """
+    if not settings.METRICS_DIR:
+        return
+    path = worker_path(pid)
+    with directory_lock(exclusive=True):
+        data = read(path)
+        if not data:
+            return
+        archive = os.path.join(settings.METRICS_DIR, ARCHIVE_FILE)
+        write(archive, merge(read(archive), data))
+        os.remove(path)
+
+
+class Registry:
+    """
+    Гистограммы по view внутри процесса.
+
+    Если задан METRICS_DIR, состояние процесса периодически пишется в
+    отдельный файл, а /metrics суммирует файлы всех воркеров gunicorn и
+    архив завершившихся.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+        self.flushed_at = 0
+        self.pid = None
+
+    def observe(self, view, values):
+        with self.lock:
+            for name, value in values.items():
+                buckets = HISTOGRAMS[name]
+                counts = self.data.setdefault(
+                    f'{name}|{view}', [0] * (len(buckets) + 1) + [0.0]
+                )
+                for index, bound in enumerate(buckets):
+                    if value <= bound:
+                        counts[index] += 1
+                counts[-2] += 1
+                counts[-1] += value
+            self.flush()
+
+    def flush(self, force=False):
+        if not settings.METRICS_DIR:
+            return
+        now = time.monotonic()
+        interval = settings.METRICS_FLUSH_INTERVAL
+        if not force and now - self.flushed_at < interval:
+            return
+        pid = os.getpid()
+        if self.pid != pid:
+            # Файл мог остаться от убитого воркера с тем же pid.
+            archive_worker(pid)
+            self.pid = pid
+        self.flushed_at = now
+        write(worker_path(pid), self.data)
+
+    def collect(self):
+        with self.lock:
+            if not settings.METRICS_DIR:
+                return dict(self.data)
+            self.flush(force=True)
+        merged = {}
+        with directory_lock(exclusive=False):
+            for path in glob.glob(
+                os.path.join(settings.METRICS_DIR, 'metrics-*.json')
+            ):
+                merge(merged, read(path))
+        return merged
+
+    def exposition(self):
+        lines = []
+        collected = self.collect()
+        for name, buckets in HISTOGRAMS.items():
+            lines.append(f'# TYPE {name} histogram')
+            for key in sorted(collected):
+                metric, view = key.split('|', 1)
+                if metric != name:
+                    continue
+                counts = collected[key]
+                for bound, count in zip(buckets, counts):
+                    lines.append(
+                        f'{name}_bucket{{view="{view}",le="{bound}"}} {count}'
+                    )
+                lines.append(
+                    f'{name}_bucket{{view="{view}",le="+Inf"}} {counts[-2]}'
+                )
+                lines.append(f'{name}_count{{view="{view}"}} {counts[-2]}')
+                lines.append(f'{name}_sum{{view="{view}"}} {counts[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class QueryTimer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self.lock:
+                self.count += 1
+                self.duration += time.perf_counter() - start
+
+
+# Таймер текущего запроса: запросы из потоков sync_to_async тоже видны.
+current_timer = ContextVar('current_timer', default=None)
+
+
+def timed_execute(execute, sql, params, many, context):
+    timer = current_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    return timer(execute, sql, params, many, context)
+
+
+def install_timer(connection, **kwargs):
+    if timed_execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(timed_execute)
+
+
+def view_name(view_func, method):
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return f'{view_func.__module__}.{view_func.__qualname__}'
+    actions = getattr(view_func, 'actions', None) or {}
+    return f'{view_class.__name__}.{actions.get(method, method)}'
+
+
+class MetricsMiddleware:
+    """
+    Считает SQL-запросы, время в базе, рендеринг и размер ответа по view.
+
+    Отдает их в заголовке Server-Timing и в /metrics. Выключенный через
+    METRICS_ENABLED middleware исключается из цепочки и ничего не стоит.
+    Работает и под WSGI, и под ASGI.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        connection_created.connect(install_timer)
+        for connection in connections.all(initialized_only=True):
+            install_timer(connection)
+
+    def process_template_response(self, request, response):
+        start = time.perf_counter()
+
+        def rendered(response):
+            request.metrics_render = time.perf_counter() - start
+
+        response.add_post_render_callback(rendered)
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = QueryTimer()
+        token = current_timer.set(timer)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timer.reset(token)
+        return self.finish(request, response, timer, start)
+
+    async def __acall__(self, request):
+        timer = QueryTimer()
+        token = current_timer.set(timer)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timer.reset(token)
+        return self.finish(request, response, timer, start)
+
+    def finish(self, request, response, timer, start):
+        duration = time.perf_counter() - start
+        match = request.resolver_match
+        if match is None:
+            return response
+        view = view_name(match.func, request.method.lower())
+        render = getattr(request, 'metrics_render', 0)
+        values = {
+            'foodgram_request_duration_seconds': duration,
+            'foodgram_db_duration_seconds': timer.duration,
+            'foodgram_render_duration_seconds': render,
+            'foodgram_db_queries': timer.count,
+        }
+        if not response.streaming:
+            values['foodgram_response_size_bytes'] = len(response.content)
+        registry.observe(view, values)
+        response['Server-Timing'] = (
+            f'db;dur={timer.duration * 1000:.1f};'
+            f'desc="{timer.count} queries", '
+            f'render;dur={render * 1000:.1f}, '
+            f'total;dur={duration * 1000:.1f}'
+        )
+        if timer.count > settings.METRICS_QUERY_BUDGET:
+            logger.warning(
+                '%s: %s SQL-запросов при бюджете %s',
+                view, timer.count, settings.METRICS_QUERY_BUDGET
+            )
+        return response
+
+
+def metrics_view(request):
+    if not settings.METRICS_ENABLED:
+        raise Http404
+    return HttpResponse(
+        registry.exposition(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
@@ -0,0 +1,193 @@
+import hashlib
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import SimpleNamespace
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+# Состояние текущего запроса. Объект общий для копий контекста, поэтому
+# запись, сделанная в потоке sync_to_async, видна middleware.
+request_state = ContextVar('request_state', default=None)
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+# Время monotonic, до которого реплика процесса считается недоступной.
+unavailable = {}
+
+
+def pin_key(request):
+    """Клиента узнаем по заголовку авторизации или сессии, без запроса."""
+    credentials = request.META.get('HTTP_AUTHORIZATION') or (
+        request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    )
+    if not credentials:
+        return None
+    return f'db:pinned:{hashlib.sha256(credentials.encode()).hexdigest()}'
+
+
+def choose_database(request):
+    """
+    Реплика для чтения view с read_replica = True, если клиент недавно
+    ничего не записывал. None - view для запроса еще не выбран.
+    """
+    match = request.resolver_match
+    if match is None:
+        return None
+    if (
+        request.method not in READ_METHODS
+        or not getattr(getattr(match.func, 'cls', None),
+                       'read_replica', False)
+    ):
+        return DEFAULT_DB_ALIAS
+    key = pin_key(request)
+    if key is not None and cache.get(key):
+        return DEFAULT_DB_ALIAS
+    replicas = settings.DATABASE_REPLICAS
+    for alias in random.sample(replicas, len(replicas)):
+        if available(alias):
+            return alias
+    return DEFAULT_DB_ALIAS
+
+
+def available(alias):
+    """
+    Подключается к реплике. Недоступная реплика пропускается
+    DATABASE_REPLICA_RETRY секунд, чтение идет на другую или основную базу.
+    """
+    if unavailable.get(alias, 0) > time.monotonic():
+        return False
+    try:
+        connections[alias].ensure_connection()
+    except DatabaseError:
+        logger.warning('Реплика %s недоступна', alias, exc_info=True)
+        unavailable[alias] = (
+            time.monotonic() + settings.DATABASE_REPLICA_RETRY
+        )
+        return False
+    unavailable.pop(alias, None)
+    return True
+
+
+@contextmanager
+def read_from_primary():
+    """
+    Чтение с основной базы внутри запроса к реплике. Нужно там, где
+    результат кэшируется под новым поколением: данные отстающей реплики
+    остались бы в кэше после того, как она догонит основную базу.
+    """
+    state = request_state.get()
+    if state is None:
+        yield
+        return
+    primary, state.primary = state.primary, True
+    try:
+        yield
+    finally:
+        state.primary = primary
+
+
+def detect_write(execute, sql, params, many, context):
+    """Отмечает в состоянии запроса первую изменяющую команду SQL."""
+    state = request_state.get()
+    if state is not None and sql.lstrip()[:6].upper() in WRITE_STATEMENTS:
+        state.wrote = True
+    return execute(sql, params, many, context)
+
+
+def install_write_detector(connection, **kwargs):
+    if (connection.alias == DEFAULT_DB_ALIAS
+            and detect_write not in connection.execute_wrappers):
+        connection.execute_wrappers.append(detect_write)
+
+
+class PrimaryReplicaRouter:
+    """
+    Чтение view с read_replica = True идет на одну из реплик, все
+    остальное - на основную базу. После первой записи в запросе он до
+    конца читает с основной базы.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = request_state.get()
+        if state is None or state.wrote or state.primary:
+            return DEFAULT_DB_ALIAS
+        if state.database is None:
+            state.database = choose_database(state.request)
+        return state.database or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaMiddleware:
+    """
+    Отправляет чтение на реплику и закрепляет клиента за основной базой
+    на DATABASE_REPLICA_PIN секунд после записи, чтобы он сразу видел
+    свои изменения несмотря на отставание реплики. Без реплик исключается
+    из цепочки.
+
+    Записи замечает постоянная обертка соединений с основной базой: она
+    видит запросы из любого потока, в том числе из sync_to_async.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        connection_created.connect(install_write_detector)
+        for connection in connections.all(initialized_only=True):
+            install_write_detector(connection)
+
+    def start(self, request):
+        state = SimpleNamespace(
+            request=request, database=None, primary=False, wrote=False
+        )
+        return state, request_state.set(state)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            request_state.reset(token)
+        key = pin_key(request) if state.wrote else None
+        if key is not None:
+            cache.set(key, True, timeout=settings.DATABASE_REPLICA_PIN)
+        return response
+
+    async def __acall__(self, request):
+        state, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_state.reset(token)
+        key = pin_key(request) if state.wrote else None
+        if key is not None:
+            await cache.aset(
+                key, True, timeout=settings.DATABASE_REPLICA_PIN
+            )
+        return response
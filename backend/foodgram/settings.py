@@ -30,6 +30,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework.authtoken',
     'colorfield',
@@ -41,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'foodgram.metrics.MetricsMiddleware',
+    'foodgram.replicas.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -70,6 +73,11 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'foodgram.wsgi.application'
 
+# Асинхронные версии горячих GET-запросов; нужен запуск через ASGI.
+ASGI_ENABLED = os.getenv('ASGI_ENABLED') == 'True'
+# Потоков с соединениями к базе у асинхронных view в каждом воркере.
+ASGI_DB_THREADS = int(os.getenv('ASGI_DB_THREADS', 8))
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
@@ -81,9 +89,67 @@ DATABASES = {
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD', 'foodgrampassword'),
         'HOST': os.environ.get('DB_HOST', 'db'),
         'PORT': os.environ.get('DB_PORT', '5432'),
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+    }
+}
+
+# Реплики для чтения: host[:port][/name] через запятую.
+DATABASE_REPLICAS = []
+for number, address in enumerate(
+    filter(None, os.environ.get('DB_REPLICAS', '').split(','))
+):
+    address, _, name = address.strip().partition('/')
+    host, _, port = address.partition(':')
+    alias = f'replica_{number}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'NAME': name or DATABASES['default']['NAME'],
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        'OPTIONS': {
+            'connect_timeout': int(
+                os.environ.get('DB_REPLICA_CONNECT_TIMEOUT', 2)
+            ),
+        },
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['foodgram.replicas.PrimaryReplicaRouter']
+# Сколько секунд после записи клиент читает с основной базы.
+DATABASE_REPLICA_PIN = int(os.environ.get('DB_REPLICA_PIN', 10))
+# Сколько секунд не пробовать реплику, к которой не удалось подключиться.
+DATABASE_REPLICA_RETRY = int(os.environ.get('DB_REPLICA_RETRY', 5))
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
     }
 }
 
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', 60 * 60 * 24))
+
+RECIPE_INDEX_TTL = int(os.getenv('RECIPE_INDEX_TTL', 5 * 60))
+
+RECIPE_CACHE_TIMEOUT = int(os.getenv('RECIPE_CACHE_TIMEOUT', 60 * 60))
+
+AUTH_TOKEN_CACHE_TIMEOUT = int(os.getenv('AUTH_TOKEN_CACHE_TIMEOUT', 5 * 60))
+AUTH_TOKEN_LOCAL_CACHE_TIMEOUT = int(
+    os.getenv('AUTH_TOKEN_LOCAL_CACHE_TIMEOUT', 5)
+)
+AUTH_TOKEN_LOCAL_CACHE_SIZE = int(
+    os.getenv('AUTH_TOKEN_LOCAL_CACHE_SIZE', 1024)
+)
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED') == 'True'
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = int(os.getenv('METRICS_FLUSH_INTERVAL', 10))
+METRICS_QUERY_BUDGET = int(os.getenv('METRICS_QUERY_BUDGET', 20))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -125,6 +191,9 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = '/backend_media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+MAX_IMAGE_SIZE = int(os.getenv('MAX_IMAGE_SIZE', 5 * 1024 * 1024))
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 2))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -134,7 +203,7 @@ AUTH_USER_MODEL = 'users.User'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
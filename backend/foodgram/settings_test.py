@@ -0,0 +1,12 @@
+"""
+Настройки для тестов: python manage.py test --settings=foodgram.settings_test
+или pytest (см. pytest.ini).
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES
+
+# Зеркало основной базы для тестов маршрутизации, в DATABASE_REPLICAS
+# его добавляют сами тесты.
+DATABASES['replica'] = {
+    **DATABASES['default'], 'TEST': {'MIRROR': 'default'}
+}
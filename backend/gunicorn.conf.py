@@ -0,0 +1,35 @@
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(
+    os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1)
+)
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+
+if os.getenv('ASGI_ENABLED') == 'True':
+    # Воркер uvicorn обслуживает много соединений в одном процессе,
+    # запросы к базе выполняются в пуле потоков каждого воркера.
+    wsgi_app = 'foodgram.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'foodgram.wsgi:application'
+    worker_class = 'sync'
+
+
+def post_worker_init(worker):
+    """Строит индекс рецептов по ингредиентам до первого запроса."""
+    from django.db import connections
+
+    from api.recipe_index import recipe_index
+
+    recipe_index.refresh()
+    connections.close_all()
+
+
+def child_exit(server, worker):
+    """Счетчики метрик завершившегося воркера уходят в архив."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram.settings')
+    from foodgram.metrics import archive_worker
+
+    archive_worker(worker.pid)
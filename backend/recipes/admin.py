@@ -1,12 +1,169 @@
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django import forms
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import PAGE_VAR
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.utils.functional import cached_property
 
 from .models import (Favorite, Ingredient, IngredientInRecipe, Recipe,
-                     ShoppingCart, Tag)
+                     ShoppingCart, ShoppingListItem, Tag)
+
+# Меньшие таблицы дешевле посчитать точно.
+ESTIMATED_COUNT_THRESHOLD = 10000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Для списка без фильтров и поиска число строк берется из статистики
+    PostgreSQL (pg_class.reltuples) вместо COUNT(*) по всей таблице.
+
+    Оценка обновляется autovacuum/ANALYZE, поэтому последняя страница
+    может оказаться неполной или пустой.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql' or queryset.query.where:
+            return super().count
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                [queryset.model._meta.db_table]
+            )
+            row = cursor.fetchone()
+        if row is None or row[0] < ESTIMATED_COUNT_THRESHOLD:
+            return super().count
+        return int(row[0])
+
+
+def recipe_amounts(recipe_ids):
+    amounts = defaultdict(dict)
+    for recipe_id, ingredient_id, amount in IngredientInRecipe.objects.filter(
+        recipe_id__in=recipe_ids
+    ).values_list('recipe_id', 'ingredient_id', 'amount'):
+        amounts[recipe_id][ingredient_id] = amount
+    return amounts
+
+
+@contextmanager
+def tracking_ingredients(recipe_ids):
+    """
+    Правка состава рецептов в админке. После блока итоги списков покупок
+    пользователей с рецептом в корзине сдвигаются на разницу количеств и
+    пересчитываются поисковые векторы. Индекс рецептов и кэш карточек
+    обновляют сигналы строк.
+    """
+    with transaction.atomic():
+        recipe_ids = set(recipe_ids)
+        before = recipe_amounts(recipe_ids)
+        carts = defaultdict(list)
+        for recipe_id, user_id in ShoppingCart.objects.filter(
+            recipe_id__in=recipe_ids
+        ).values_list('recipe_id', 'user_id'):
+            carts[recipe_id].append(user_id)
+        yield
+        after = recipe_amounts(recipe_ids)
+        for recipe_id, user_ids in carts.items():
+            old, new = before[recipe_id], after[recipe_id]
+            ShoppingListItem.objects.apply(user_ids, {
+                ingredient_id: new.get(ingredient_id, 0)
+                - old.get(ingredient_id, 0)
+                for ingredient_id in old.keys() | new.keys()
+            })
+        Recipe.objects.update_search_vector(recipe_ids)
+
+
+class AutocompleteFilter(admin.SimpleListFilter):
+    """
+    Фильтр по внешнему ключу с поиском через autocomplete админки:
+    в боковую панель загружается только выбранный объект, а не все.
+    """
+
+    template = 'admin/autocomplete_filter.html'
+    field_name = None
+
+    def __init__(self, request, params, model, model_admin):
+        field = model._meta.get_field(self.field_name)
+        self.title = field.verbose_name
+        self.parameter_name = f'{self.field_name}__id__exact'
+        super().__init__(request, params, model, model_admin)
+        self.params = [
+            (name, value) for name, value in request.GET.items()
+            if name not in (self.parameter_name, PAGE_VAR)
+        ]
+        self.form_field = forms.ModelChoiceField(
+            queryset=field.remote_field.model._default_manager.all(),
+            widget=AutocompleteSelect(
+                field,
+                model_admin.admin_site,
+                attrs={'onchange': 'this.form.submit()'}
+            ),
+            required=False
+        )
+
+    def has_output(self):
+        return True
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        try:
+            return queryset.filter(**{self.parameter_name: self.value()})
+        except (ValueError, ValidationError) as error:
+            raise IncorrectLookupParameters(error)
+
+    def choices(self, changelist):
+        yield {
+            'selected': not self.value(),
+            'query_string': changelist.get_query_string(
+                remove=[self.parameter_name]
+            ),
+            'display': 'Все',
+            'params': self.params,
+            'widget': self.form_field.widget.render(
+                self.parameter_name, self.value()
+            ),
+        }
+
+
+class AuthorFilter(AutocompleteFilter):
+    field_name = 'author'
+
+
+class UserFilter(AutocompleteFilter):
+    field_name = 'user'
+
+
+class RecipeFilter(AutocompleteFilter):
+    field_name = 'recipe'
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Список для больших таблиц: без точных COUNT(*) и полных фильтров."""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    @property
+    def media(self):
+        return super().media + AutocompleteSelect(None, self.admin_site).media
 
 
 class IngredientInLine(admin.TabularInline):
     model = IngredientInRecipe
     min_num = 1
+    autocomplete_fields = ('ingredient',)
 
 
 @admin.register(Ingredient)
@@ -34,65 +191,95 @@ class TagAdmin(admin.ModelAdmin):
 
 
 @admin.register(Recipe)
-class RecipeAdmin(admin.ModelAdmin):
+class RecipeAdmin(LargeTableAdmin):
     list_display = (
         'name',
         'author',
+        'favorites_count',
     )
+    list_select_related = ('author',)
     search_fields = (
-        'author',
         'name',
+        'author__username',
     )
     list_filter = (
-        'name',
-        'author',
+        AuthorFilter,
         'tags'
     )
+    autocomplete_fields = ('author', 'tags')
+    readonly_fields = ('favorites_count', 'in_carts_count')
     inlines = (IngredientInLine,)
 
     empty_value_display = '-пусто-'
 
+    def save_related(self, request, form, formsets, change):
+        with tracking_ingredients([form.instance.pk]):
+            super().save_related(request, form, formsets, change)
+
 
 @admin.register(IngredientInRecipe)
-class IngredientInRecipeAdmin(admin.ModelAdmin):
+class IngredientInRecipeAdmin(LargeTableAdmin):
     list_display = (
         'recipe',
         'ingredient',
         'amount'
     )
+    list_select_related = ('recipe', 'ingredient')
+    autocomplete_fields = ('recipe', 'ingredient')
     search_fields = (
         'recipe__name',
         'ingredient__name'
     )
 
+    def save_model(self, request, obj, form, change):
+        recipe_ids = {obj.recipe_id}
+        if change:
+            recipe_ids.add(form.initial['recipe'])
+        with tracking_ingredients(recipe_ids):
+            super().save_model(request, obj, form, change)
+
+    def delete_model(self, request, obj):
+        with tracking_ingredients([obj.recipe_id]):
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with tracking_ingredients(
+            queryset.values_list('recipe_id', flat=True)
+        ):
+            super().delete_queryset(request, queryset)
+
 
 @admin.register(Favorite)
-class FavoriteAdmin(admin.ModelAdmin):
+class FavoriteAdmin(LargeTableAdmin):
     list_display = (
         'user',
         'recipe'
     )
+    list_select_related = ('user', 'recipe')
     search_fields = (
         'user__username',
         'recipe__name'
     )
     list_filter = (
-        'user',
-        'recipe'
+        UserFilter,
+        RecipeFilter
     )
+    autocomplete_fields = ('user', 'recipe')
 
 
 @admin.register(ShoppingCart)
-class ShoppingCartAdmin(admin.ModelAdmin):
+class ShoppingCartAdmin(LargeTableAdmin):
     list_display = (
         'user',
         'recipe'
     )
+    list_select_related = ('user', 'recipe')
     search_fields = (
         'user__username',
         'recipe__name'
     )
     list_filter = (
-        'user',
-        'recipe'
+        UserFilter,
+        RecipeFilter
     )
+    autocomplete_fields = ('user', 'recipe')
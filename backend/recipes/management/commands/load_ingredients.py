@@ -1,25 +1,164 @@
+import csv
+import io
+import json
 import os
-from csv import reader
+from itertools import islice
 
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
 
+from api.cache import bump_version
 from foodgram.settings import BASE_DIR
 from recipes.models import Ingredient
 
+DEFAULT_PATH = os.path.join(BASE_DIR, 'recipes/data', 'ingredients.csv')
+READ_SIZE = 64 * 1024
+
+
+def read_csv(file):
+    for row in csv.reader(file, delimiter=','):
+        if row:
+            yield row[0], row[1]
+
+
+def read_json(file):
+    """Построчно разбирает JSON-массив объектов, не загружая файл целиком."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    while True:
+        chunk = file.read(READ_SIZE)
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in '[,] \t\r\n':
+                position += 1
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break
+            position = end
+            yield item['name'], item.get(
+                'measurement_unit', item.get('measurment_unit')
+            )
+        if not chunk:
+            if buffer[position:].strip():
+                raise CommandError('Некорректный JSON в файле ингредиентов')
+            return
+
+
+READERS = {
+    'csv': read_csv,
+    'json': read_json,
+}
+
 
 class Command(BaseCommand):
-    def handle(self, *args, **options):
-        with open(
-            os.path.join(
-                os.path.join(BASE_DIR, 'recipes/data'), 'ingredients.csv'
-            ),
-                'r',
-                encoding='utf-8'
-        ) as file:
-            csv_reader = reader(file, delimiter=',')
-            for row in csv_reader:
-                Ingredient.objects.get_or_create(
-                    name=row[0],
-                    measurment_unit=row[1]
+    help = 'Загружает справочник ингредиентов из CSV или JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=DEFAULT_PATH)
+        parser.add_argument(
+            '--format',
+            choices=tuple(READERS),
+            help='Формат файла, по умолчанию определяется по расширению'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Прочитать файл и посчитать новые строки без записи'
+        )
+
+    def batches(self, rows, size):
+        while True:
+            batch = list(islice(rows, size))
+            if not batch:
+                return
+            yield batch
+
+    def progress(self, read):
+        self.stdout.write(f'Прочитано строк: {read}', ending='\r')
+        self.stdout.flush()
+
+    def dry_run(self, batches):
+        existing = set(
+            Ingredient.objects.values_list('name', 'measurment_unit')
+        )
+        read = inserted = 0
+        for batch in batches:
+            read += len(batch)
+            for row in batch:
+                if row not in existing:
+                    existing.add(row)
+                    inserted += 1
+            self.progress(read)
+        return read, inserted
+
+    def bulk_load(self, batches):
+        before = Ingredient.objects.count()
+        read = 0
+        for batch in batches:
+            read += len(batch)
+            Ingredient.objects.bulk_create(
+                (Ingredient(name=name, measurment_unit=measurment_unit)
+                 for name, measurment_unit in batch),
+                ignore_conflicts=True
+            )
+            self.progress(read)
+        return read, Ingredient.objects.count() - before
+
+    def copy_load(self, batches):
+        table = Ingredient._meta.db_table
+        read = 0
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMP TABLE ingredient_import '
+                '(name varchar(200), measurment_unit varchar(200)) '
+                'ON COMMIT DROP'
+            )
+            for batch in batches:
+                read += len(batch)
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(batch)
+                buffer.seek(0)
+                cursor.copy_expert(
+                    'COPY ingredient_import (name, measurment_unit) '
+                    'FROM STDIN WITH CSV',
+                    buffer
                 )
-        print('Done loading ing')
+                self.progress(read)
+            cursor.execute(
+                f'INSERT INTO {table} (name, measurment_unit) '
+                'SELECT DISTINCT name, measurment_unit FROM ingredient_import '
+                'ON CONFLICT (name, measurment_unit) DO NOTHING'
+            )
+            inserted = cursor.rowcount
+            # ON COMMIT DROP не срабатывает, если команда вызвана внутри
+            # внешней транзакции, и повторный вызов не создал бы таблицу.
+            cursor.execute('DROP TABLE ingredient_import')
+            return read, inserted
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or os.path.splitext(path)[1][1:]
+        if file_format not in READERS:
+            raise CommandError(f'Неизвестный формат файла: {path}')
+        with open(path, 'r', encoding='utf-8') as file:
+            batches = self.batches(
+                READERS[file_format](file), options['batch_size']
+            )
+            if options['dry_run']:
+                read, inserted = self.dry_run(batches)
+            else:
+                with transaction.atomic():
+                    if connection.vendor == 'postgresql':
+                        read, inserted = self.copy_load(batches)
+                    else:
+                        read, inserted = self.bulk_load(batches)
+                bump_version(Ingredient)
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(
+            f'{"Будет добавлено" if options["dry_run"] else "Добавлено"}: '
+            f'{inserted}, пропущено: {read - inserted}'
+        ))
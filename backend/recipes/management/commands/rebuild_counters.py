@@ -0,0 +1,72 @@
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from recipes.models import Favorite, Recipe, ShoppingCart
+from users.models import Subscription, User
+
+
+def count(model, field):
+    """Подзапрос с числом строк model, ссылающихся на текущий объект."""
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef('pk')}).order_by().values(
+            field
+        ).annotate(total=Count('pk')).values('total'),
+        output_field=IntegerField()
+    ), Value(0))
+
+
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'in_carts_count', ShoppingCart, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'followers_count', Subscription, 'author'),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчитывает счетчики избранного, корзин, рецептов и подписчиков'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только сверить счетчики, не изменяя данные'
+        )
+
+    def verify(self):
+        mismatches = 0
+        for model, field, related, related_field in COUNTERS:
+            wrong = model.objects.annotate(
+                expected=count(related, related_field)
+            ).exclude(expected=F(field)).count()
+            if wrong:
+                self.stdout.write(
+                    f'{model._meta.model_name}.{field}: {wrong}'
+                )
+            mismatches += wrong
+        if mismatches:
+            raise CommandError(f'Расхождений в счетчиках: {mismatches}')
+        self.stdout.write(self.style.SUCCESS(
+            'Счетчики согласованы с данными'
+        ))
+
+    @transaction.atomic
+    def rebuild(self):
+        for model, field, related, related_field in COUNTERS:
+            updated = model.objects.update(
+                **{field: count(related, related_field)}
+            )
+            self.stdout.write(
+                f'{model._meta.model_name}.{field}: {updated}'
+            )
+        self.stdout.write(self.style.SUCCESS('Счетчики пересчитаны'))
+
+    def handle(self, *args, **options):
+        if options['check']:
+            self.verify()
+        else:
+            self.rebuild()
@@ -0,0 +1,28 @@
+from django.core.management import BaseCommand
+
+from api.images import make_renditions, mark_renditions_ready
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = (
+        'Готовит недостающие превью картинок рецептов и отмечает их '
+        'готовыми; картинки, загруженные до появления превью, и неудачные '
+        'фоновые задачи'
+    )
+
+    def handle(self, *args, **options):
+        names = Recipe.objects.filter(renditions_ready=False).exclude(
+            image=''
+        ).values_list('image', flat=True).distinct().order_by()
+        failed = 0
+        for name in names.iterator():
+            if make_renditions(name):
+                mark_renditions_ready(name)
+            else:
+                failed += 1
+        if failed:
+            self.stdout.write(self.style.WARNING(
+                f'Не удалось подготовить превью для {failed} картинок'
+            ))
+        self.stdout.write(self.style.SUCCESS('Превью обновлены'))
@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает поисковые векторы всех рецептов'
+
+    def handle(self, *args, **options):
+        Recipe.objects.update_search_vector(Recipe.objects.values('pk'))
+        self.stdout.write(self.style.SUCCESS('Поисковые векторы обновлены'))
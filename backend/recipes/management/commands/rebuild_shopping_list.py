@@ -0,0 +1,77 @@
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+
+from recipes.models import ShoppingCart, ShoppingListItem
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает итоги списков покупок из корзин пользователей'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только сверить таблицу с корзинами, не изменяя данные'
+        )
+
+    def expected_totals(self):
+        return (
+            ((row['user'], row['recipe__recipe_ingredient__ingredient']),
+             row['total'])
+            for row in ShoppingCart.objects.filter(
+                recipe__recipe_ingredient__isnull=False
+            ).values(
+                'user', 'recipe__recipe_ingredient__ingredient'
+            ).annotate(
+                total=Sum('recipe__recipe_ingredient__amount')
+            ).order_by().iterator(chunk_size=BATCH_SIZE)
+        )
+
+    def verify(self):
+        actual = {
+            (user_id, ingredient_id): total
+            for user_id, ingredient_id, total in
+            ShoppingListItem.objects.values_list(
+                'user_id', 'ingredient_id', 'total_amount'
+            ).iterator(chunk_size=BATCH_SIZE)
+        }
+        mismatches = 0
+        for key, total in self.expected_totals():
+            if actual.pop(key, None) != total:
+                mismatches += 1
+        mismatches += len(actual)
+        if mismatches:
+            raise CommandError(
+                f'Расхождений в списках покупок: {mismatches}'
+            )
+        self.stdout.write(self.style.SUCCESS(
+            'Списки покупок согласованы с корзинами'
+        ))
+
+    @transaction.atomic
+    def rebuild(self):
+        ShoppingListItem.objects.all().delete()
+        batch = []
+        created = 0
+        for (user_id, ingredient_id), total in self.expected_totals():
+            batch.append(ShoppingListItem(
+                user_id=user_id,
+                ingredient_id=ingredient_id,
+                total_amount=total
+            ))
+            if len(batch) == BATCH_SIZE:
+                created += len(ShoppingListItem.objects.bulk_create(batch))
+                batch = []
+        created += len(ShoppingListItem.objects.bulk_create(batch))
+        self.stdout.write(self.style.SUCCESS(
+            f'Списки покупок пересобраны, позиций: {created}'
+        ))
+
+    def handle(self, *args, **options):
+        if options['check']:
+            self.verify()
+        else:
+            self.rebuild()
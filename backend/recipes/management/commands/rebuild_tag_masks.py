@@ -0,0 +1,15 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from recipes.models import Recipe, Tag
+
+
+class Command(BaseCommand):
+    help = 'Назначает тэгам биты и пересчитывает маски тэгов всех рецептов'
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        for tag in Tag.objects.filter(bit=None).order_by('id'):
+            tag.save(update_fields=('bit',))
+        Recipe.objects.update_tags_mask(Recipe.objects.values('pk'))
+        self.stdout.write(self.style.SUCCESS('Маски тэгов обновлены'))
@@ -0,0 +1,284 @@
+import random
+from io import BytesIO
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import BaseCommand, CommandError, call_command
+from django.db import transaction
+from PIL import Image
+
+from api.cache import bump_version
+from api.images import make_renditions
+from recipes.models import (Favorite, Ingredient, IngredientInRecipe, Recipe,
+                            ShoppingCart, Tag)
+from users.models import Subscription, User
+
+TAGS = (
+    ('Завтрак', '#E26C2D', 'breakfast'),
+    ('Обед', '#49B64E', 'lunch'),
+    ('Ужин', '#8775D2', 'dinner'),
+    ('Десерт', '#E2C12D', 'dessert'),
+    ('Перекус', '#2D9CE2', 'snack'),
+)
+TAG_WEIGHTS = (3, 5, 5, 2, 1)
+IMAGE_COLORS = (
+    '#E26C2D', '#49B64E', '#8775D2', '#E2C12D',
+    '#2D9CE2', '#C22D5B', '#6B4226', '#3E3E3E',
+)
+COOKING_TIMES = (5, 10, 15, 20, 30, 40, 45, 60, 90, 120)
+RECIPE_WORDS = (
+    'по-домашнему', 'с травами', 'запеченный', 'на скорую руку',
+    'праздничный', 'острый', 'по-деревенски', 'в горшочке',
+)
+
+
+def weights(size, exponent):
+    """Закон Ципфа: k-й по популярности элемент встречается в 1/k^s раз."""
+    return list(accumulate(
+        1 / rank ** exponent for rank in range(1, size + 1)
+    ))
+
+
+def weighted_sample(rng, population, cum_weights, size):
+    """Выборка без повторов с учетом популярности элементов."""
+    size = min(size, len(population))
+    chosen = {}
+    while len(chosen) < size:
+        for item in rng.choices(
+            population, cum_weights=cum_weights, k=size - len(chosen)
+        ):
+            chosen[item] = None
+    return list(chosen)
+
+
+class Command(BaseCommand):
+    help = (
+        'Заполняет базу синтетическими пользователями, рецептами, '
+        'подписками, избранным и корзинами'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--recipes', type=int, default=1000)
+        parser.add_argument(
+            '--subscriptions',
+            type=int,
+            default=10,
+            help='Подписок на пользователя, в среднем'
+        )
+        parser.add_argument(
+            '--favorites',
+            type=int,
+            default=20,
+            help='Рецептов в избранном на пользователя, в среднем'
+        )
+        parser.add_argument(
+            '--cart',
+            type=int,
+            default=5,
+            help='Рецептов в корзине на пользователя, в среднем'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Одинаковый seed дает одинаковые данные'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--password', default='foodgram-seed')
+        parser.add_argument(
+            '--clear',
+            action='store_true',
+            help='Удалить данные, созданные ранее с этим seed'
+        )
+
+    def prefix(self, seed):
+        return f'seed{seed}_'
+
+    def ingredients(self):
+        if not Ingredient.objects.exists():
+            call_command('load_ingredients', stdout=self.stdout)
+        return list(Ingredient.objects.order_by('id').values_list(
+            'id', 'name', 'measurment_unit'
+        ))
+
+    def tags(self):
+        for name, color, slug in TAGS:
+            Tag.objects.get_or_create(
+                slug=slug, defaults={'name': name, 'color': color}
+            )
+        bump_version(Tag)
+        tags = dict(Tag.objects.values_list('slug', 'id'))
+        return [tags[slug] for _, _, slug in TAGS]
+
+    def images(self):
+        names = []
+        for number, color in enumerate(IMAGE_COLORS):
+            name = f'recipes/seed/{number}.png'
+            if not default_storage.exists(name):
+                buffer = BytesIO()
+                Image.new('RGB', (800, 600), color).save(buffer, 'PNG')
+                default_storage.save(name, ContentFile(buffer.getvalue()))
+                make_renditions(name)
+            names.append(name)
+        return names
+
+    def users(self, rng, prefix, count, batch_size):
+        password = make_password(self.options['password'])
+        users = User.objects.bulk_create(
+            (User(
+                username=f'{prefix}{number:06d}',
+                email=f'{prefix}{number:06d}@example.com',
+                first_name=rng.choice(('Анна', 'Иван', 'Мария', 'Олег')),
+                last_name=rng.choice(('Иванова', 'Петров', 'Смирнова')),
+                password=password
+            ) for number in range(count)),
+            batch_size=batch_size
+        )
+        return [user.id for user in users]
+
+    def recipes(self, rng, authors, count, batch_size):
+        ingredients = self.ingredients()
+        ingredient_ids = [ingredient_id for ingredient_id, _, _ in ingredients]
+        names = {ingredient_id: name for ingredient_id, name, _ in ingredients}
+        units = {ingredient_id: unit for ingredient_id, _, unit in ingredients}
+        rng.shuffle(ingredient_ids)
+        ingredient_weights = weights(len(ingredient_ids), 1.1)
+        author_weights = weights(len(authors), 1.0)
+        tag_ids = self.tags()
+        tag_weights = list(accumulate(TAG_WEIGHTS))
+        images = self.images()
+        recipe_ids = []
+        for start in range(0, count, batch_size):
+            recipes, compositions, tags = [], [], []
+            for number in range(start, min(start + batch_size, count)):
+                composition = weighted_sample(
+                    rng, ingredient_ids, ingredient_weights,
+                    rng.randint(3, 12)
+                )
+                recipes.append(Recipe(
+                    author_id=rng.choices(
+                        authors, cum_weights=author_weights
+                    )[0],
+                    name=(
+                        f'{names[composition[0]].capitalize()} '
+                        f'{rng.choice(RECIPE_WORDS)} №{number}'
+                    ),
+                    text=' '.join(rng.choices(RECIPE_WORDS, k=20)),
+                    cooking_time=rng.choice(COOKING_TIMES),
+                    image=rng.choice(images),
+                    renditions_ready=True
+                ))
+                compositions.append(composition)
+                tags.append(weighted_sample(
+                    rng, tag_ids, tag_weights, rng.choice((1, 1, 2, 3))
+                ))
+            recipes = Recipe.objects.bulk_create(recipes)
+            IngredientInRecipe.objects.bulk_create(
+                IngredientInRecipe(
+                    recipe_id=recipe.id,
+                    ingredient_id=ingredient_id,
+                    amount=(
+                        rng.randrange(50, 550, 50)
+                        if units[ingredient_id] in ('г', 'мл')
+                        else rng.randint(1, 5)
+                    )
+                )
+                for recipe, composition in zip(recipes, compositions)
+                for ingredient_id in composition
+            )
+            Recipe.tags.through.objects.bulk_create(
+                Recipe.tags.through(recipe_id=recipe.id, tag_id=tag_id)
+                for recipe, recipe_tags in zip(recipes, tags)
+                for tag_id in recipe_tags
+            )
+            batch_ids = [recipe.id for recipe in recipes]
+            Recipe.objects.update_tags_mask(batch_ids)
+            Recipe.objects.update_search_vector(batch_ids)
+            recipe_ids.extend(batch_ids)
+            self.stdout.write(
+                f'Рецептов: {len(recipe_ids)}/{count}', ending='\r'
+            )
+        self.stdout.write('')
+        return recipe_ids
+
+    def relations(self, rng, model, user_ids, targets, mean, make):
+        """
+        Каждому пользователю - случайное число связей со средним mean,
+        популярные цели выбираются чаще.
+        """
+        cum_weights = weights(len(targets), 0.8)
+        created = 0
+        batch = []
+        for user_id in user_ids:
+            size = min(int(rng.expovariate(1 / mean)) if mean else 0,
+                       len(targets) - 1)
+            for target in weighted_sample(rng, targets, cum_weights, size):
+                if target != user_id or model is not Subscription:
+                    batch.append(make(user_id, target))
+            if len(batch) >= self.options['batch_size']:
+                created += len(model.objects.bulk_create(batch))
+                batch = []
+        created += len(model.objects.bulk_create(batch))
+        return created
+
+    def clear(self, prefix):
+        deleted, _ = User.objects.filter(username__startswith=prefix).delete()
+        call_command('rebuild_shopping_list', stdout=self.stdout)
+        call_command('rebuild_counters', stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f'Удалено объектов: {deleted}'))
+
+    def handle(self, *args, **options):
+        self.options = options
+        prefix = self.prefix(options['seed'])
+        if options['clear']:
+            with transaction.atomic():
+                self.clear(prefix)
+            return
+        if options['users'] < 1:
+            raise CommandError('Нужен хотя бы один пользователь')
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(
+                f'Данные с seed {options["seed"]} уже созданы, '
+                'удалите их через --clear или выберите другой --seed'
+            )
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        with transaction.atomic():
+            user_ids = self.users(rng, prefix, options['users'], batch_size)
+            authors = user_ids[:]
+            rng.shuffle(authors)
+            recipe_ids = self.recipes(
+                rng, authors, options['recipes'], batch_size
+            )
+            popular_recipes = recipe_ids[:]
+            rng.shuffle(popular_recipes)
+            subscriptions = self.relations(
+                rng, Subscription, user_ids, authors,
+                options['subscriptions'],
+                lambda user_id, author_id: Subscription(
+                    subscriber_id=user_id, author_id=author_id
+                )
+            )
+            favorites = self.relations(
+                rng, Favorite, user_ids, popular_recipes,
+                options['favorites'],
+                lambda user_id, recipe_id: Favorite(
+                    user_id=user_id, recipe_id=recipe_id
+                )
+            )
+            carts = self.relations(
+                rng, ShoppingCart, user_ids, popular_recipes, options['cart'],
+                lambda user_id, recipe_id: ShoppingCart(
+                    user_id=user_id, recipe_id=recipe_id
+                )
+            )
+            call_command('rebuild_shopping_list', stdout=self.stdout)
+            call_command('rebuild_counters', stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(
+            f'Создано пользователей: {len(user_ids)}, '
+            f'рецептов: {len(recipe_ids)}, подписок: {subscriptions}, '
+            f'в избранном: {favorites}, в корзинах: {carts}'
+        ))
@@ -0,0 +1,122 @@
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations, models
+from django.db.models import (BigIntegerField, Count, F, IntegerField,
+                              OuterRef, Subquery, Sum, Value)
+from django.db.models.functions import Cast, Coalesce
+
+# Значения на момент миграции: код моделей может измениться позже.
+MAX_TAGS = 63
+SEARCH_CONFIG = 'russian'
+BATCH_SIZE = 1000
+
+
+def count(model, field):
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef('pk')}).order_by().values(
+            field
+        ).annotate(total=Count('pk')).values('total'),
+        output_field=IntegerField()
+    ), Value(0))
+
+
+def fill_tag_bits(apps, schema_editor):
+    Tag = apps.get_model('recipes', 'Tag')
+    used = set(Tag.objects.exclude(bit=None).values_list('bit', flat=True))
+    free = (bit for bit in range(MAX_TAGS) if bit not in used)
+    for tag in Tag.objects.filter(bit=None).order_by('id'):
+        tag.bit = next(free, None)
+        if tag.bit is None:
+            raise RuntimeError(f'Тэгов больше {MAX_TAGS}')
+        tag.save(update_fields=('bit',))
+
+
+def fill_tags_masks(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    masks = Recipe.tags.through.objects.filter(
+        recipe=OuterRef('pk')
+    ).values('recipe').annotate(mask=Sum(
+        Cast(Value(1), BigIntegerField()).bitleftshift(F('tag__bit')),
+        output_field=BigIntegerField()
+    )).values('mask')
+    Recipe.objects.update(tags_mask=Coalesce(
+        Subquery(masks, output_field=BigIntegerField()), Value(0)
+    ))
+
+
+def fill_search_vectors(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Recipe = apps.get_model('recipes', 'Recipe')
+    IngredientInRecipe = apps.get_model('recipes', 'IngredientInRecipe')
+    ingredient_names = IngredientInRecipe.objects.filter(
+        recipe=OuterRef('pk')
+    ).values('recipe').annotate(
+        names=StringAgg('ingredient__name', ' ')
+    ).values('names')
+    Recipe.objects.update(search_vector=(
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector(
+            Coalesce(
+                Subquery(ingredient_names),
+                Value(''),
+                output_field=models.TextField()
+            ),
+            weight='B',
+            config=SEARCH_CONFIG
+        )
+        + SearchVector('text', weight='C', config=SEARCH_CONFIG)
+    ))
+
+
+def fill_recipe_counters(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Recipe.objects.update(
+        favorites_count=count(apps.get_model('recipes', 'Favorite'), 'recipe'),
+        in_carts_count=count(
+            apps.get_model('recipes', 'ShoppingCart'), 'recipe'
+        )
+    )
+
+
+def fill_shopping_lists(apps, schema_editor):
+    ShoppingCart = apps.get_model('recipes', 'ShoppingCart')
+    ShoppingListItem = apps.get_model('recipes', 'ShoppingListItem')
+    ShoppingListItem.objects.all().delete()
+    batch = []
+    for row in ShoppingCart.objects.filter(
+        recipe__recipe_ingredient__isnull=False
+    ).values(
+        'user', 'recipe__recipe_ingredient__ingredient'
+    ).annotate(
+        total=Sum('recipe__recipe_ingredient__amount')
+    ).order_by().iterator(chunk_size=BATCH_SIZE):
+        batch.append(ShoppingListItem(
+            user_id=row['user'],
+            ingredient_id=row['recipe__recipe_ingredient__ingredient'],
+            total_amount=row['total']
+        ))
+        if len(batch) == BATCH_SIZE:
+            ShoppingListItem.objects.bulk_create(batch)
+            batch = []
+    ShoppingListItem.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+    """
+    Заполняет производные данные для записей, созданных до 0002: биты
+    тэгов, маски, поисковые векторы, счетчики и итоги списков покупок.
+    Дальше их поддерживают сигналы и сериализаторы.
+    """
+
+    dependencies = [
+        ('recipes', '0002_indexes_counters_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_tag_bits, migrations.RunPython.noop),
+        migrations.RunPython(fill_tags_masks, migrations.RunPython.noop),
+        migrations.RunPython(fill_search_vectors, migrations.RunPython.noop),
+        migrations.RunPython(fill_recipe_counters, migrations.RunPython.noop),
+        migrations.RunPython(fill_shopping_lists, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,15 @@
 from colorfield.fields import ColorField
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.core.exceptions import ValidationError
 from django.core.validators import (MaxValueValidator, MinValueValidator,
                                     RegexValidator)
-from django.db import models
+from django.db import connection, models
+from django.db.models import (BigIntegerField, Case, F, IntegerField, OuterRef,
+                              Subquery, Sum, Value, When)
+from django.db.models.functions import Cast, Coalesce, Greatest, Upper
 
 User = get_user_model()
 
@@ -10,6 +17,30 @@ User = get_user_model()
 STR_MAX_LENGTH = 25
 MAX_VALUE = 32767
 MIN_VALUE = 1
+SEARCH_CONFIG = 'russian'
+# Маска тегов рецепта хранится в знаковом bigint.
+MAX_TAGS = 63
+
+
+class PatternIndex(models.Index):
+    """
+    Индекс для LIKE 'префикс%': с классом операторов в PostgreSQL и
+    без него в SQLite для тестов.
+    """
+
+    def create_sql(self, model, schema_editor, using='', **kwargs):
+        if schema_editor.connection.vendor == 'postgresql':
+            return super().create_sql(
+                model, schema_editor, using=using, **kwargs
+            )
+        return models.Index(
+            *(
+                expression.get_source_expressions()[0]
+                if isinstance(expression, OpClass) else expression
+                for expression in self.expressions
+            ),
+            name=self.name
+        ).create_sql(model, schema_editor, using=using, **kwargs)
 
 
 class Ingredient(models.Model):
@@ -26,7 +57,19 @@ class Ingredient(models.Model):
         ordering = ('name',)
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
-        unique_together = ('name', 'measurment_unit')
+        constraints = (
+            models.UniqueConstraint(
+                fields=('name', 'measurment_unit'),
+                name='unique_ingredient'
+            ),
+        )
+        indexes = (
+            # name__istartswith строит UPPER(name::text) LIKE UPPER(...).
+            PatternIndex(
+                OpClass(Upper('name'), name='text_pattern_ops'),
+                name='ingredient_name_upper_idx'
+            ),
+        )
 
     def __str__(self):
         return (f'{self.name} - {self.measurment_unit}'[:STR_MAX_LENGTH])
@@ -54,6 +97,12 @@ class Tag(models.Model):
         max_length=200,
         unique=True
     )
+    bit = models.PositiveSmallIntegerField(
+        'Бит в маске рецепта',
+        unique=True,
+        null=True,
+        editable=False
+    )
 
     class Meta:
         verbose_name = 'Тэг'
@@ -62,6 +111,82 @@ class Tag(models.Model):
     def __str__(self):
         return self.name
 
+    @staticmethod
+    def free_bit():
+        used = set(
+            Tag.objects.exclude(bit=None).values_list('bit', flat=True)
+        )
+        for bit in range(MAX_TAGS):
+            if bit not in used:
+                return bit
+        raise ValidationError(f'Тэгов не может быть больше {MAX_TAGS}')
+
+    def clean(self):
+        if self.bit is None:
+            self.bit = self.free_bit()
+
+    def save(self, *args, **kwargs):
+        if self.bit is None:
+            self.bit = self.free_bit()
+        super().save(*args, **kwargs)
+
+
+def tags_mask(bits):
+    return sum(1 << bit for bit in set(bits))
+
+
+class SearchVectorIndex(GinIndex):
+    """GIN-индекс в PostgreSQL и обычный индекс в SQLite для тестов."""
+
+    def create_sql(self, model, schema_editor, using='', **kwargs):
+        if schema_editor.connection.vendor == 'postgresql':
+            return super().create_sql(
+                model, schema_editor, using=using, **kwargs
+            )
+        return models.Index.create_sql(
+            self, model, schema_editor, using=using, **kwargs
+        )
+
+
+class RecipeManager(models.Manager):
+    def update_tags_mask(self, recipe_ids):
+        """Пересчитывает маску тегов по связям рецептов с тегами."""
+        masks = Tag.objects.filter(recipes=OuterRef('pk')).values(
+            'recipes'
+        ).annotate(mask=Sum(
+            Cast(Value(1), BigIntegerField()).bitleftshift(F('bit')),
+            output_field=BigIntegerField()
+        )).values('mask')
+        self.filter(pk__in=recipe_ids).update(tags_mask=Coalesce(
+            Subquery(masks, output_field=BigIntegerField()), Value(0)
+        ))
+
+    def update_search_vector(self, recipe_ids):
+        """
+        Пересчитывает поисковый вектор: название важнее ингредиентов,
+        ингредиенты важнее описания. Вне PostgreSQL поле не заполняется.
+        """
+        if connection.vendor != 'postgresql':
+            return
+        ingredient_names = IngredientInRecipe.objects.filter(
+            recipe=OuterRef('pk')
+        ).values('recipe').annotate(
+            names=StringAgg('ingredient__name', ' ')
+        ).values('names')
+        self.filter(pk__in=recipe_ids).update(search_vector=(
+            SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector(
+                Coalesce(
+                    Subquery(ingredient_names),
+                    Value(''),
+                    output_field=models.TextField()
+                ),
+                weight='B',
+                config=SEARCH_CONFIG
+            )
+            + SearchVector('text', weight='C', config=SEARCH_CONFIG)
+        ))
+
 
 class Recipe(models.Model):
     author = models.ForeignKey(
@@ -91,12 +216,52 @@ class Recipe(models.Model):
         )
     )
     image = models.ImageField('Изображение рецепта')
+    renditions_ready = models.BooleanField(
+        'Превью готовы',
+        default=False,
+        editable=False
+    )
+    search_vector = SearchVectorField(null=True, editable=False)
+    favorites_count = models.PositiveIntegerField(
+        'В избранном',
+        default=0,
+        editable=False
+    )
+    in_carts_count = models.PositiveIntegerField(
+        'В корзинах',
+        default=0,
+        editable=False
+    )
+    tags_mask = models.BigIntegerField(
+        'Маска тэгов',
+        default=0,
+        editable=False
+    )
+
+    objects = RecipeManager()
 
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         ordering = ('-id',)
-        unique_together = ('name', 'author')
+        constraints = (
+            models.UniqueConstraint(
+                fields=('author', 'name'),
+                name='unique_recipe'
+            ),
+        )
+        indexes = (
+            models.Index(fields=('author', '-id'), name='recipe_author_idx'),
+            models.Index(
+                fields=('-favorites_count', '-id'),
+                name='recipe_favorites_count_idx'
+            ),
+            models.Index(fields=('tags_mask',), name='recipe_tags_mask_idx'),
+            SearchVectorIndex(
+                fields=('search_vector',),
+                name='recipe_search_vector_idx'
+            ),
+        )
 
     def __str__(self):
         return self.name[:STR_MAX_LENGTH]
@@ -127,7 +292,12 @@ class IngredientInRecipe(models.Model):
     class Meta:
         verbose_name = 'Ингридиеты в рецепте'
         verbose_name_plural = 'Ингридиенты в рецепте'
-        unique_together = ('ingredient', 'recipe')
+        constraints = (
+            models.UniqueConstraint(
+                fields=('recipe', 'ingredient'),
+                name='unique_ingredient_in_recipe'
+            ),
+        )
 
     def __str__(self):
         return (
@@ -152,7 +322,12 @@ class Favorite(models.Model):
     class Meta:
         verbose_name = 'Избранный'
         verbose_name_plural = 'Избранные'
-        unique_together = ('user', 'recipe')
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'recipe'),
+                name='unique_favorite'
+            ),
+        )
 
     def __str__(self):
         return f'{self.user}, {self.recipe}'[:STR_MAX_LENGTH]
@@ -175,7 +350,120 @@ class ShoppingCart(models.Model):
     class Meta:
         verbose_name = 'Корзина'
         verbose_name_plural = 'Корзина'
-        unique_together = ('user', 'recipe')
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'recipe'),
+                name='unique_shopping_cart'
+            ),
+        )
 
     def __str__(self):
         return f'{self.user} Добавил {self.recipe} в корзину'[:STR_MAX_LENGTH]
+
+
+class ShoppingListManager(models.Manager):
+    def apply(self, user_ids, amounts):
+        """
+        Прибавляет к итогам пользователей изменения количеств.
+
+        amounts - словарь {id ингредиента: изменение}, отрицательные
+        значения уменьшают итог, нулевые строки удаляются.
+        """
+        amounts = {key: value for key, value in amounts.items() if value}
+        if not user_ids or not amounts:
+            return
+        # Итоги пользователя меняются по очереди: иначе UPDATE одного
+        # запроса и удаление нулевых строк другим теряют прибавки.
+        # Вызывать нужно внутри транзакции.
+        list(User.objects.select_for_update().filter(
+            pk__in=user_ids
+        ).order_by('pk').values_list('pk', flat=True))
+        self.bulk_create(
+            (
+                self.model(
+                    user_id=user_id,
+                    ingredient_id=ingredient_id,
+                    total_amount=0
+                )
+                for user_id in user_ids
+                for ingredient_id, amount in amounts.items()
+                if amount > 0
+            ),
+            ignore_conflicts=True
+        )
+        rows = self.filter(user_id__in=user_ids, ingredient_id__in=amounts)
+        rows.update(total_amount=Greatest(
+            F('total_amount') + Case(
+                *(When(ingredient_id=ingredient_id, then=Value(amount))
+                  for ingredient_id, amount in amounts.items()),
+                output_field=IntegerField()
+            ),
+            Value(0)
+        ))
+        rows.filter(total_amount=0).delete()
+
+    def recipe_amounts(self, recipe, sign=1):
+        return {
+            ingredient_id: sign * amount
+            for ingredient_id, amount in recipe.recipe_ingredient.values_list(
+                'ingredient_id', 'amount'
+            )
+        }
+
+    def recipes_amounts(self, recipe_ids, sign=1):
+        return {
+            ingredient_id: sign * total
+            for ingredient_id, total in IngredientInRecipe.objects.filter(
+                recipe_id__in=recipe_ids
+            ).values('ingredient_id').annotate(
+                total=Sum('amount')
+            ).values_list('ingredient_id', 'total').order_by()
+        }
+
+    def add_recipe(self, user, recipe):
+        self.apply([user.id], self.recipe_amounts(recipe))
+
+    def remove_recipe(self, user_ids, recipe):
+        self.apply(user_ids, self.recipe_amounts(recipe, sign=-1))
+
+    def add_recipes(self, user, recipe_ids):
+        self.apply([user.id], self.recipes_amounts(recipe_ids))
+
+    def remove_recipes(self, user, recipe_ids):
+        self.apply([user.id], self.recipes_amounts(recipe_ids, sign=-1))
+
+
+class ShoppingListItem(models.Model):
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        verbose_name='Пользователь',
+        related_name='shopping_list'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        verbose_name='Ингридиент',
+        related_name='shopping_list'
+    )
+    total_amount = models.PositiveIntegerField(
+        'Общее количество',
+        default=0
+    )
+
+    objects = ShoppingListManager()
+
+    class Meta:
+        verbose_name = 'Позиция списка покупок'
+        verbose_name_plural = 'Список покупок'
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'ingredient'),
+                name='unique_shopping_list_item'
+            ),
+        )
+
+    def __str__(self):
+        return (
+            f'{self.user} - {self.ingredient} {self.total_amount}'
+        )[:STR_MAX_LENGTH]
@@ -0,0 +1,76 @@
+from django.db.models import F
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import receiver
+
+from .models import Ingredient, Recipe, Tag, tags_mask
+
+# Поисковый вектор рецепта пересчитывают сериализатор, админка и
+# seed_foodgram, один раз на рецепт. У IngredientInRecipe нет сигналов,
+# чтобы удаление строк оставалось одним DELETE.
+
+
+@receiver(pre_save, sender=Ingredient)
+def remember_ingredient_rename(sender, instance, update_fields, **kwargs):
+    instance.renamed = (
+        instance.pk is not None
+        and (update_fields is None or 'name' in update_fields)
+        and Ingredient.objects.filter(pk=instance.pk).exclude(
+            name=instance.name
+        ).exists()
+    )
+
+
+@receiver(post_save, sender=Ingredient)
+def update_renamed_ingredient_recipes(sender, instance, created, **kwargs):
+    """Название ингредиента входит в поисковые векторы его рецептов."""
+    if not created and instance.renamed:
+        Recipe.objects.update_search_vector(
+            instance.recipe_ingredient.values('recipe_id')
+        )
+
+
+@receiver(pre_delete, sender=Ingredient)
+def remember_ingredient_recipes(sender, instance, **kwargs):
+    instance.recipe_ids = list(
+        instance.recipe_ingredient.values_list('recipe_id', flat=True)
+    )
+
+
+@receiver(post_delete, sender=Ingredient)
+def update_ingredient_recipes(sender, instance, **kwargs):
+    """Строки рецептов удаляются каскадом, без пересчета вектора."""
+    Recipe.objects.update_search_vector(instance.recipe_ids)
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def update_recipe_tags_mask(sender, instance, action, reverse, pk_set,
+                            **kwargs):
+    if reverse:
+        if action == 'pre_clear':
+            instance.cleared_recipe_ids = list(
+                instance.recipes.values_list('pk', flat=True)
+            )
+        elif action == 'post_clear':
+            Recipe.objects.update_tags_mask(instance.cleared_recipe_ids)
+        elif action in ('post_add', 'post_remove'):
+            Recipe.objects.update_tags_mask(pk_set)
+        return
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        instance.tags_mask = tags_mask(
+            instance.tags.exclude(bit=None).values_list('bit', flat=True)
+        )
+        Recipe.objects.filter(pk=instance.pk).update(
+            tags_mask=instance.tags_mask
+        )
+
+
+@receiver(post_delete, sender=Tag)
+def clear_tag_bit(sender, instance, **kwargs):
+    """Связи с рецептами удаляются каскадом, без сигнала m2m_changed."""
+    if instance.bit is None:
+        return
+    bit = 1 << instance.bit
+    Recipe.objects.alias(
+        tag_bit=F('tags_mask').bitand(bit)
+    ).filter(tag_bit=bit).update(tags_mask=F('tags_mask') - bit)
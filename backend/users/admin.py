@@ -11,7 +11,7 @@ class UserAdmin(admin.ModelAdmin):
         'first_name',
         'last_name',
     )
-    search_fields = ('username', 'role',)
+    search_fields = ('username', 'email',)
     list_filter = ('username', 'email',)
     empty_value_display = '-пусто-'
 
@@ -0,0 +1,34 @@
+from django.db import migrations
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count(model, field):
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef('pk')}).order_by().values(
+            field
+        ).annotate(total=Count('pk')).values('total'),
+        output_field=IntegerField()
+    ), Value(0))
+
+
+def fill_user_counters(apps, schema_editor):
+    """Счетчики из 0007 для пользователей, созданных до нее."""
+    apps.get_model('users', 'User').objects.update(
+        recipes_count=count(apps.get_model('recipes', 'Recipe'), 'author'),
+        followers_count=count(
+            apps.get_model('users', 'Subscription'), 'author'
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_user_followers_count_user_recipes_count'),
+        ('recipes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_user_counters, migrations.RunPython.noop),
+    ]
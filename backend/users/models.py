@@ -23,6 +23,16 @@ class User(AbstractUser):
         'Пароль',
         max_length=150
     )
+    recipes_count = models.PositiveIntegerField(
+        'Рецептов',
+        default=0,
+        editable=False
+    )
+    followers_count = models.PositiveIntegerField(
+        'Подписчиков',
+        default=0,
+        editable=False
+    )
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ('username', 'first_name', 'last_name', 'password')
@@ -56,7 +66,16 @@ class Subscription(models.Model):
     )
 
     class Meta:
-        unique_together = ('author', 'subscriber')
+        constraints = (
+            models.UniqueConstraint(
+                fields=('subscriber', 'author'),
+                name='unique_subscription'
+            ),
+            models.CheckConstraint(
+                check=~models.Q(author=models.F('subscriber')),
+                name='prevent_self_subscription'
+            ),
+        )
         verbose_name = 'Подписка'
         verbose_name_plural = 'Подписки'
 